@@ -1,12 +1,37 @@
 from enum import IntEnum, auto
 import logging
 import os
+import struct
+import math
 import re
 
 os.system('')
 
 MAGIC = b'MCFN'
-FORMAT_VERSION = 4
+FORMAT_VERSION = 7
+SUPPORTED_VERSIONS = (4, 5, 6, 7)  # Versions the VM and the disassembler can read
+INDEXED_LAYOUT = 0x80  # Version flag of uncompressed executables with a function index
+CONSTANT_POOL_VERSION = 6  # First version whose operands are indices into a constant pool
+TYPED_CONSTANTS_VERSION = 7  # First version with int32, coordinate and range constants
+
+class Constant(IntEnum):
+    """Tags of the entries in the constant pool of an executable."""
+    string = 0      # UTF-8 text
+    json_text = 1   # Compiled JSON text, see doc/function.md
+    int32 = 2       # Zigzag varint
+    coordinate = 3  # <flags:1><offset:float64>, see COORDINATE_RELATIVE
+    range = 4       # <flags:1>[<min:zigzag varint>][<max:zigzag varint>], see RANGE_HAS_MIN
+
+# Flags of coordinate constants: "~<offset>" and "^<offset>"
+COORDINATE_RELATIVE = 1
+COORDINATE_CARET = 2
+
+# Flags of range constants: bounds that are present, open ones are left out
+RANGE_HAS_MIN = 1
+RANGE_HAS_MAX = 2
+
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
 
 class Instruction(IntEnum):
     # Executor instructions (from "as <entity>" and "at <entity>")
@@ -121,6 +146,45 @@ def setup_logger(name: str, log_level: int = logging.INFO) -> logging.Logger:
 # STYLES for JSON components
 STYLES = ["bold", "italic", "strikethrough", "underlined"]
 
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as an unsigned LEB128 varint, the lengths of format v5."""
+    if value < 0:
+        raise ValueError(f"Varints can't be negative: {value}")
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def encode_svarint(value: int) -> bytes:
+    """Encode a signed integer as a zigzag varint: 0, -1, 1, -2... become 0, 1, 2, 3..."""
+    return encode_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+def read_svarint(data: bytes, offset: int) -> tuple[int, int]:
+    """Read a zigzag varint, see encode_svarint(). Returns the value and the offset after it."""
+    value, offset = read_varint(data, offset)
+    return value >> 1 if not value & 1 else -(value >> 1) - 1, offset
+
+def read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """
+    Read an unsigned LEB128 varint.
+
+    Returns:
+        The value and the offset after it.
+    Raises:
+        IndexError: If data ends inside the varint.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
 def parse_target_selector(selector: str) -> dict:
     """
     Parse a target selector string into its components.
@@ -194,3 +258,125 @@ def parse_target_selector(selector: str) -> dict:
             result["args"][key] = value
     
     return result
+
+def parse_range(value_str: str) -> tuple[None | int, None | int]:
+    """
+    Parses a range specification string of the format "[<start>]..[<end>]".
+    If either bound is omitted, None is returned for that bound.
+
+    Args:
+        value_str (str): The range string, e.g. "[4]..[8]" or "..[8]".
+
+    Returns:
+        tuple: A tuple (start, end) where start and end are integers or None.
+    """
+
+    if '..' not in value_str:
+        # Handle single numeric values
+        try:
+            # Try to parse as a simple integer
+            num = int(value_str.strip())
+            return num, num
+        except ValueError:
+            # If it has brackets, try to strip them first
+            try:
+                stripped = value_str.strip()
+                if stripped.startswith('[') and stripped.endswith(']'):
+                    num = int(stripped[1:-1].strip())
+                    return num, num
+            except ValueError:
+                pass
+        raise ValueError(f"Invalid range specification: {value_str}")
+
+    range_parts = value_str.split('..')
+    if len(range_parts) != 2:
+        raise ValueError(f"Invalid range specification: {value_str}")
+
+    def strip_brackets(s: str) -> str:
+        s = s.strip()
+        if s.startswith('[') and s.endswith(']'):
+            return s[1:-1].strip()
+        return s
+
+    # Parse start value
+    start_str = strip_brackets(range_parts[0])
+    try:
+        start_value = int(start_str) if start_str != '' else None
+    except ValueError:
+        raise ValueError(f"Invalid range start: {range_parts[0]}")
+        
+    # Parse end value
+    end_str = strip_brackets(range_parts[1])
+    try:
+        end_value = int(end_str) if end_str != '' else None
+    except ValueError:
+        raise ValueError(f"Invalid range end: {range_parts[1]}")
+        
+    return start_value, end_value
+
+def _check_int32(value: int) -> int:
+    if not INT32_MIN <= value <= INT32_MAX:
+        raise ValueError(f"{value} is out of the int32 range")
+    return value
+
+def encode_constant(tag: Constant, text: str) -> bytes:
+    """
+    Encode the text of a typed operand as a constant of the given kind.
+
+    Raises:
+        ValueError: If the text isn't a valid literal of that kind.
+    """
+    if tag == Constant.int32:
+        return encode_svarint(_check_int32(int(text)))
+
+    if tag == Constant.coordinate:
+        flags = 0
+        if text[:1] == '~':
+            flags, text = COORDINATE_RELATIVE, text[1:] or '0'
+        elif text[:1] == '^':
+            flags, text = COORDINATE_CARET, text[1:] or '0'
+        offset = float(text)
+        if not math.isfinite(offset):
+            raise ValueError(f"Coordinate isn't finite: {text}")
+        return bytes([flags]) + struct.pack('>d', offset)
+
+    if tag == Constant.range:
+        start, end = parse_range(text)
+        encoded = bytearray([(start is not None) * RANGE_HAS_MIN | (end is not None) * RANGE_HAS_MAX])
+        for bound in (start, end):
+            if bound is not None:
+                encoded += encode_svarint(_check_int32(bound))
+        return bytes(encoded)
+
+    return text.encode('utf-8')
+
+def decode_number_constant(tag: Constant, data: bytes):
+    """
+    Decode an int32, coordinate or range constant, see encode_constant().
+
+    Returns:
+        The int, (offset, flags) for coordinates or (start, end) for ranges,
+        with None for open bounds.
+    Raises:
+        ValueError: If the tag isn't numeric or the constant is truncated.
+    """
+    try:
+        if tag == Constant.int32:
+            value, end = read_svarint(data, 0)
+        elif tag == Constant.coordinate:
+            value, end = (struct.unpack_from('>d', data, 1)[0], data[0]), 9
+        elif tag == Constant.range:
+            flags, end = data[0], 1
+            start = stop = None
+            if flags & RANGE_HAS_MIN:
+                start, end = read_svarint(data, end)
+            if flags & RANGE_HAS_MAX:
+                stop, end = read_svarint(data, end)
+            value = (start, stop)
+        else:
+            raise ValueError(f"Not a numeric constant tag: {tag}")
+    except (IndexError, struct.error):
+        raise ValueError(f"Truncated {Constant(tag).name} constant") from None
+    if end != len(data):
+        raise ValueError(f"Invalid {Constant(tag).name} constant: {data.hex()}")
+    return value
@@ -6,7 +6,10 @@ import zlib
 import json
 import sys
 import os
-from common import Instruction, MAGIC, FORMAT_VERSION, setup_logger, STYLES
+from common import (
+    Instruction, Constant, MAGIC, FORMAT_VERSION, INDEXED_LAYOUT, setup_logger, STYLES,
+    encode_varint, read_varint, encode_constant
+)
 
 level = logging.DEBUG
 log = setup_logger("MCFN", level)
@@ -316,9 +319,39 @@ def get_arg_letter(i: int) -> str:
         second = i % base
         return chr(ord('a') + first) + chr(ord('a') + second)
 
+# Numeric operands by instruction and position. create_executable() stores
+# them as typed constants, so the VM doesn't parse them.
+TYPED_OPERANDS = {
+    Instruction.add: {2: Constant.int32},
+    Instruction.remove: {2: Constant.int32},
+    Instruction.set_score: {2: Constant.int32},
+    Instruction.positioned: dict.fromkeys(range(3), Constant.coordinate),
+    Instruction.if_block: dict.fromkeys(range(3), Constant.coordinate),
+    Instruction.unless_block: dict.fromkeys(range(3), Constant.coordinate),
+    Instruction.summon: dict.fromkeys(range(1, 4), Constant.coordinate),
+}
+
+def operand_tag(opcode: Instruction, args: list, position: int) -> Constant:
+    """The constant kind of an operand: typed for numbers, string otherwise and for macro arguments."""
+    arg = args[position]
+    if isinstance(arg, bytes) and opcode == Instruction.tellraw and arg[:1] in (b'\0', b'\1', b'\2', b'\3'):
+        return Constant.json_text
+    if (arg.startswith('$') if isinstance(arg, str) else arg.startswith(b'$')):
+        return Constant.string
+    if (
+        opcode in (Instruction.if_score, Instruction.unless_score)
+        and position == 3 and len(args) == 4
+        and args[2] in ("matches", b"matches")
+    ):
+        return Constant.range
+    return TYPED_OPERANDS.get(opcode, {}).get(position, Constant.string)
+
 def compile_instr(cmd: str, args: list) -> bytes:
     """
-    Compiles a single instruction with its arguments into binary format.
+    Compiles a single instruction with its arguments into binary format:
+    <argCount:varint><instruction:1byte>, then <argLen:varint><argBytes> for each argument.
+    Numeric operands are validated here, see TYPED_OPERANDS, and the
+    instruction is dropped if one is invalid.
     """
     local = bytearray()
     try:
@@ -326,12 +359,18 @@ def compile_instr(cmd: str, args: list) -> bytes:
     except KeyError:
         return b''  # Drop instruction
 
-    if len(args) > 255:
-        log.error(f'Ignoring invalid command: {cmd} {args}')
-        log.error("Too many arguments in instruction.")
-        return b''
+    for position, arg in enumerate(args):
+        tag = operand_tag(instr_code, args, position) if isinstance(arg, str) else Constant.string
+        if tag == Constant.string:
+            continue
+        try:
+            encode_constant(tag, arg)
+        except ValueError as e:
+            log.error(f'Ignoring invalid command: {cmd} {args}')
+            log.error(f"Invalid {tag.name} operand {arg!r}: {e}")
+            return b''
 
-    local += struct.pack("B", len(args))
+    local += encode_varint(len(args))
     local += struct.pack("B", instr_code.value)
 
     for arg in args:
@@ -348,12 +387,7 @@ def compile_instr(cmd: str, args: list) -> bytes:
             else:
                 arg_bytes = arg.encode('utf-8')
 
-        if len(arg_bytes) > 255:
-            log.error(f'Ignoring invalid command: {cmd} {args}')
-            log.error(f"Argument too long. [{len(arg_bytes)}/255]")
-            return b''
-
-        local += struct.pack("B", len(arg_bytes))
+        local += encode_varint(len(arg_bytes))
         local += arg_bytes
 
     return bytes(local)
@@ -437,7 +471,11 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
                     x = tokens[i+1]
                     y = tokens[i+2]
                     z = tokens[i+3]
-                    exec_instructions += compile_instr("positioned", [x, y, z])
+                    clause = compile_instr("positioned", [x, y, z])
+                    if not clause:
+                        exec_instructions = None  # Invalid numeric operand
+                        break
+                    exec_instructions += clause
                     i += 4
 
                 elif token == "if":
@@ -458,7 +496,11 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
 
                         bx = tokens[i]; by = tokens[i+1]; bz = tokens[i+2]
                         block_id = tokens[i+3]
-                        exec_instructions += compile_instr("if_block", [bx, by, bz, block_id])
+                        clause = compile_instr("if_block", [bx, by, bz, block_id])
+                        if not clause:
+                            exec_instructions = None  # Invalid numeric operand
+                            break
+                        exec_instructions += clause
                         i += 4
 
                     elif condition == "entity":
@@ -492,7 +534,11 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
 
                         if operator == "matches":
                             range_spec = tokens[i+3]
-                            exec_instructions += compile_instr("if_score", [score_selector, objective, "matches", range_spec])
+                            clause = compile_instr("if_score", [score_selector, objective, "matches", range_spec])
+                            if not clause:
+                                exec_instructions = None  # Invalid numeric operand
+                                break
+                            exec_instructions += clause
                             i += 4
                         else:
                             if i + 4 >= len(tokens):
@@ -526,7 +572,11 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
 
                         bx = tokens[i]; by = tokens[i+1]; bz = tokens[i+2]
                         block_id = tokens[i+3]
-                        exec_instructions += compile_instr("unless_block", [bx, by, bz, block_id])
+                        clause = compile_instr("unless_block", [bx, by, bz, block_id])
+                        if not clause:
+                            exec_instructions = None  # Invalid numeric operand
+                            break
+                        exec_instructions += clause
                         i += 4
                     elif condition == "entity":
                         # Syntax: unless entity <selector>
@@ -556,7 +606,11 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
 
                         if operator == "matches":
                             range_spec = tokens[i+3]
-                            exec_instructions += compile_instr("unless_score", [score_selector, objective, "matches", range_spec])
+                            clause = compile_instr("unless_score", [score_selector, objective, "matches", range_spec])
+                            if not clause:
+                                exec_instructions = None  # Invalid numeric operand
+                                break
+                            exec_instructions += clause
                             i += 4
                         else:
                             if i + 4 >= len(tokens):
@@ -608,6 +662,9 @@ def compile_source(func_name, source):  # sourcery skip: low-code-quality
                     log.error(f"Unexpected token in execute clause: {tokens[i]}")
                     continue
 
+            if exec_instructions is None:
+                continue
+
             # Expect the "run" keyword
             if i >= len(tokens) or tokens[i].lower() != "run":
                 log.error(f'Ignoring invalid command in {func_name}: "{line}"')
@@ -850,78 +907,137 @@ def read_file(infile: str) -> str:
         with open(infile, 'r') as f:
             return f.read()
 
-def write_file(outfile: str, data: bytes) -> None:
+def write_file(outfile: str, data: bytes, compress: bool = True) -> None:
     """
     Compress and write binary data to a file.
     
     Args:
         outfile: Path to the output file
         data: Binary data to write
+        compress: Whether to compress the data. Executables in the indexed
+            layout are written uncompressed so the VM can memory map them.
         
     Raises:
         PermissionError: If the file can't be written
     """
-    data = zlib.compress(data, level=9)
+    if compress:
+        data = zlib.compress(data, level=9)
     with open(outfile, 'wb') as f:
         f.write(data)
 
-def write_value(exe: BytesIO, data: bytes, bytes_len: int) -> None:
+def write_value(exe: BytesIO, data: bytes) -> None:
     """
-    Write a length-prefixed value to a binary stream.
+    Write a value prefixed with its length as a varint to a binary stream.
     
     Args:
         exe: Binary stream to write to
         data: Actual data bytes to write
-        bytes_len: Number of bytes to use for the length prefix
     """
-    exe.write(len(data).to_bytes(bytes_len, 'big'))
+    exe.write(encode_varint(len(data)))
     exe.write(data)
 
-def create_executable(functions: dict[str, bytes], namespace: str) -> bytes:
+def pool_operands(block: bytes, constants: dict) -> bytes:
+    """
+    Rewrite an instruction block as compile_instr() writes it, with inline
+    arguments, so that each argument is the varint index of a constant.
+    Numeric operands become int32, coordinate and range constants.
+
+    Args:
+        block: The instruction block
+        constants: Maps (tag, bytes) of each constant to its index, and gets
+            the constants of the block that aren't in it yet
+
+    Returns:
+        The block with <argCount:varint><instruction:1byte><constIndex:varint>... instructions
+    """
+    pooled = bytearray()
+    offset = 0
+    while offset < len(block):
+        arg_count, offset = read_varint(block, offset)
+        opcode = block[offset]
+        offset += 1
+        pooled += encode_varint(arg_count)
+        pooled.append(opcode)
+        args = []
+        for _ in range(arg_count):
+            arg_len, offset = read_varint(block, offset)
+            args.append(block[offset:offset + arg_len])
+            offset += arg_len
+
+        for position, arg in enumerate(args):
+            tag = operand_tag(opcode, args, position)
+            if tag not in (Constant.string, Constant.json_text):
+                arg = encode_constant(tag, arg.decode('utf-8'))
+            index = constants.setdefault((tag, arg), len(constants))
+            pooled += encode_varint(index)
+    return bytes(pooled)
+
+def create_executable(functions: dict[str, bytes], namespace: str, indexed: bool = False) -> bytes:
     """
     Create a MCFN executable binary from compiled functions.
     
     The executable format is:
     - MAGIC header (4 bytes)
     - FORMAT_VERSION (1 byte)
-    - Namespace length (1 byte) + namespace bytes
-    - Function count (2 bytes)
+    - Namespace length (varint) + namespace bytes
+    - Constant count (varint)
+    - For each constant, each distinct argument of the functions:
+      - Tag (1 byte, see Constant) + length (varint) + constant bytes,
+        UTF-8 text or a binary number, see common.encode_constant()
+    - Function count (varint)
     - For each function:
-      - Function name length (1 byte) + name bytes
-      - Function data length (2 bytes) + function data
+      - Function name length (varint) + name bytes
+      - Function data length (varint) + function data, where arguments are
+        constant indices, see pool_operands()
+    
+    The indexed layout sets INDEXED_LAYOUT in the version and replaces the
+    function entries with an index followed by the function data:
+    - For each function:
+      - Function name length (varint) + name bytes
+      - Offset of the function data from the end of the index (varint)
+      - Function data length (varint)
     
     Args:
         functions: Dictionary mapping function names to their compiled bytecode
         namespace: Namespace string for the executable
+        indexed: Whether to use the indexed layout, which the VM loads lazily
         
     Returns:
         Complete executable as bytes
-        
-    Raises:
-        ValueError: If namespace is too long
     """
     exe = BytesIO()
 
     # Header
     exe.write(MAGIC)  # 4 bytes magic
-    exe.write(FORMAT_VERSION.to_bytes(1, 'big'))  # 1 byte version
+    version = FORMAT_VERSION | INDEXED_LAYOUT if indexed else FORMAT_VERSION
+    exe.write(version.to_bytes(1, 'big'))  # 1 byte version
 
     # Namespace
-    ns_bytes = namespace.encode('utf-8')
-    if len(ns_bytes) > 255:
-        error_msg = f"Namespace too long: {len(ns_bytes)} bytes (max 255)"
-        log.error(error_msg)
-        raise ValueError(error_msg)
-
-    exe.write(len(ns_bytes).to_bytes(1, 'big'))
-    exe.write(ns_bytes)
+    write_value(exe, namespace.encode('utf-8'))
+
+    # Constant pool
+    constants = {}
+    functions = {name: pool_operands(data, constants) for name, data in functions.items()}
+    exe.write(encode_varint(len(constants)))
+    for tag, data in constants:
+        exe.write(bytes([tag]))
+        write_value(exe, data)
+
+    exe.write(encode_varint(len(functions)))
+    if indexed:
+        offset = 0
+        for name, data in functions.items():
+            write_value(exe, name.encode('utf-8'))
+            exe.write(encode_varint(offset))
+            exe.write(encode_varint(len(data)))
+            offset += len(data)
+        for data in functions.values():
+            exe.write(data)
+        return exe.getvalue()
 
-    # Write function count as 2 bytes.
-    exe.write(len(functions).to_bytes(2, 'big'))
     for name, data in functions.items():
-        name = name.encode('utf-8')
-        write_value(exe, name, 1)
-        write_value(exe, data, 2)
+        write_value(exe, name.encode('utf-8'))
+        write_value(exe, data)
     return exe.getvalue()
 
 def print_functions(functions):  # sourcery skip: use-join
@@ -1,9 +1,11 @@
 from io import BytesIO
-import struct
 import zlib
 import sys
 import logging
-from common import Instruction, FORMAT_VERSION, setup_logger, STYLES
+from common import (
+    Instruction, Constant, FORMAT_VERSION, SUPPORTED_VERSIONS, INDEXED_LAYOUT, CONSTANT_POOL_VERSION,
+    COORDINATE_RELATIVE, COORDINATE_CARET, setup_logger, STYLES, decode_number_constant
+)
 
 log = setup_logger("MCFN_Disassembler", logging.INFO)
 
@@ -54,18 +56,59 @@ def disassemble_json(data: bytes) -> str:
 
     return f"UnknownType(0x{data.hex()})"
 
-def disassemble(bytecode: bytes) -> str:
+def read_length(stream: BytesIO, width: int, version: int) -> int | None:
+    """Read a length: width bytes in format v4, a varint since v5. None if the stream ends first."""
+    if version < 5:
+        data = stream.read(width)
+        return int.from_bytes(data, 'big') if len(data) == width else None
+
+    value = shift = 0
+    while byte := stream.read(1):
+        value |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+    return None
+
+def disassemble_constant(tag: int, data: bytes) -> str:
+    if tag == Constant.json_text:
+        return disassemble_json(data)
+    if tag == Constant.string:
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data.hex()
+    try:
+        if tag == Constant.int32:
+            return str(decode_number_constant(tag, data))
+        if tag == Constant.coordinate:
+            offset, flags = decode_number_constant(tag, data)
+            prefix = "^" if flags & COORDINATE_CARET else "~" if flags & COORDINATE_RELATIVE else ""
+            if prefix and not offset:
+                return prefix
+            return f"{prefix}{int(offset) if offset.is_integer() else offset}"
+        if tag == Constant.range:
+            start, end = decode_number_constant(tag, data)
+            if start is not None and start == end:
+                return str(start)
+            return f"{'' if start is None else start}..{'' if end is None else end}"
+    except ValueError:
+        pass
+    return f"UnknownConstant({tag}, 0x{data.hex()})"
+
+def disassemble(bytecode: bytes, version: int = FORMAT_VERSION, constants: list = None) -> str:
+    """Disassemble an instruction block. Since v6 its arguments are indices into constants."""
     stream = BytesIO(bytecode)
     lines = []
 
-    while True:
-        header = stream.read(2)
-        if len(header) < 2:
-            if header:
-                lines.append("; Incomplete instruction at end")
+    while stream.tell() < len(bytecode):
+        arg_count = read_length(stream, 1, version)
+        instr_byte = stream.read(1)
+        if arg_count is None or not instr_byte:
+            lines.append("; Incomplete instruction at end")
             break
 
-        arg_count, instr_val = header
+        instr_val = instr_byte[0]
         try:
             instr = Instruction(instr_val).name
         except ValueError:
@@ -73,11 +116,18 @@ def disassemble(bytecode: bytes) -> str:
 
         args = []
         for _ in range(arg_count):
-            bl = stream.read(1)
-            if not bl:
+            if version >= CONSTANT_POOL_VERSION:
+                index = read_length(stream, 1, version)
+                if index is None:
+                    args.append("; Missing argument bytes")
+                    break
+                args.append(constants[index] if index < len(constants) else f"; Invalid constant {index}")
+                continue
+
+            arg_len = read_length(stream, 1, version)
+            if arg_len is None:
                 args.append("; Missing argument bytes")
                 break
-            arg_len = bl[0]
             arg_bytes = stream.read(arg_len)
             if instr == "tellraw" and arg_bytes and arg_bytes[0] in (0, 1, 2, 3):
                 args.append(disassemble_json(arg_bytes))
@@ -104,54 +154,83 @@ def disassemble_executable(data: bytes) -> str:
     if not version_byte:
         return "Missing version."
     version = version_byte[0]
+    indexed = version & INDEXED_LAYOUT
+    version &= ~INDEXED_LAYOUT
 
     if magic != "MCFN":
         return f"Invalid magic bytes: {magic}"
-    if version != FORMAT_VERSION:
-        return f"Unsupported version: v{version}. Only v{FORMAT_VERSION} is supported."
+    if version not in SUPPORTED_VERSIONS:
+        supported = ", ".join(f"v{supported}" for supported in SUPPORTED_VERSIONS)
+        return f"Unsupported version: v{version}. Supported versions: {supported}."
 
     output.append(f'### Executable Header ###')
     output.append(f"Magic: {magic}")
     output.append(f"Version: {version}")
+    output.append(f"Layout: {'indexed' if indexed else 'sequential'}")
 
     # Read the namespace length and namespace bytes.
-    ns_len_byte = stream.read(1)
-    if len(ns_len_byte) != 1:
+    ns_len = read_length(stream, 1, version)
+    if ns_len is None:
         return "Missing namespace length."
-    ns_len = ns_len_byte[0]
     namespace_bytes = stream.read(ns_len)
     if len(namespace_bytes) != ns_len:
         return "Incomplete namespace bytes."
     namespace = namespace_bytes.decode('utf-8')
     output.append(f"Namespace: {namespace}")
 
-    # Read function count (2 bytes)
-    func_count_bytes = stream.read(2)
-    if len(func_count_bytes) != 2:
+    constants = []
+    if version >= CONSTANT_POOL_VERSION:
+        constant_count = read_length(stream, 2, version)
+        if constant_count is None:
+            return "Missing constant count."
+        for _ in range(constant_count):
+            tag = stream.read(1)
+            length = read_length(stream, 2, version)
+            constant = stream.read(length or 0)
+            if not tag or length is None or len(constant) != length:
+                return "Incomplete constant pool."
+            constants.append(disassemble_constant(tag[0], constant))
+        output.append(f"Constant Count: {constant_count}")
+
+    func_count = read_length(stream, 2, version)
+    if func_count is None:
         return "Missing function count bytes."
-    func_count = struct.unpack(">H", func_count_bytes)[0]
     output.append(f"Function Count: {func_count}")
     output.append('\n### Functions ###')
 
+    # (name, block) of each function, or (name, offset, length) in the indexed layout
+    entries = []
     for _ in range(func_count):
-        nlb = stream.read(1)
-        if not nlb:
+        name_len = read_length(stream, 1, version)
+        if name_len is None:
             output.append(";; Unexpected end while reading function entries.")
             break
 
-        name_len = nlb[0]
         func_name_bytes = stream.read(name_len)
         if len(func_name_bytes) != name_len:
             output.append(";; Incomplete function name data.")
             break
         func_name = func_name_bytes.decode('utf-8')
-        block_len_bytes = stream.read(2)
-        if len(block_len_bytes) != 2:
+
+        if indexed:
+            block_offset = read_length(stream, 4, version)
+            block_len = read_length(stream, 4, version)
+        else:
+            block_offset = None
+            block_len = read_length(stream, 2, version)
+        if block_len is None:
             output.append(f';; Incomplete header for "{func_name}" with length {name_len}')
             break
 
-        block_len = struct.unpack(">H", block_len_bytes)[0]
-        instr_block = stream.read(block_len)
+        if indexed:
+            entries.append((func_name, block_offset, block_len))
+        else:
+            entries.append((func_name, stream.read(block_len), block_len))
+
+    # Indexed blocks follow the index, v4 counts their offsets from the start
+    base = stream.tell() if version >= 5 else 0
+    for func_name, block, block_len in entries:
+        instr_block = data[base + block:base + block + block_len] if indexed else block
         if len(instr_block) != block_len:
             output.append(f";; Incomplete block for {func_name} (expected {block_len} bytes, got {len(instr_block)})")
             break
@@ -159,7 +238,7 @@ def disassemble_executable(data: bytes) -> str:
         output.append(f"## Function: {func_name} ##")
         output.append(f"  Length: {block_len} bytes")
         output.append("  Disassembly:")
-        function = disassemble(instr_block).splitlines()
+        function = disassemble(instr_block, version, constants).splitlines()
         functions[func_name] = function
         output.append("    " + "\n    ".join(function))
     output_text = "\n".join(output)
@@ -171,7 +250,9 @@ def main():
         sys.exit(1)
 
     with open(sys.argv[1], 'rb') as f:
-        bytecode = zlib.decompress(f.read())
+        bytecode = f.read()
+    if bytecode[:4] != b"MCFN":
+        bytecode = zlib.decompress(bytecode)
 
     print(disassemble_executable(bytecode))
 
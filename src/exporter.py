@@ -0,0 +1,73 @@
+from common import setup_logger
+import logging
+import vm
+
+log = setup_logger("MCFN_Exporter", logging.INFO)
+
+MODULE_FOOTER = '''
+def load() -> dict:
+    """Bind the functions for vm.run(), with their compiled versions attached."""
+    functions = {}
+    for name, instructions in FUNCTIONS.items():
+        program = functions[name] = vm.load_program(instructions)
+        program.compiled = COMPILED[name](program) if name in COMPILED else False
+    return functions
+
+def run(max_instructions:int=None, max_seconds:float=None) -> bool:
+    """Run the main function, see vm.run()."""
+    return vm.run(vm.root, load(), NAMESPACE, max_instructions, max_seconds)
+
+if __name__ == "__main__":
+    run()
+'''
+
+def export_executable(executable: bytes) -> str:
+    """
+    Export an executable as the source of a Python module.
+
+    Every function the Python tier can translate becomes a Python function,
+    see vm.function_source(). The module keeps the decoded instructions of all
+    functions as literals, so importing it doesn't parse any bytecode, and
+    runs them on the vm module: functions that weren't translated, and main,
+    are interpreted.
+
+    Args:
+        executable: The decompressed executable, see vm.read_executable()
+
+    Returns:
+        The module source. Import it with src on the path and call run().
+    """
+    namespace, functions = vm.parse_executable(executable)
+
+    lines = [
+        '# Generated by mcfn.py build. Do not edit.',
+        'import vm',
+        'from common import Instruction as I',
+        '',
+        f'NAMESPACE = {namespace!r}',
+        '',
+        'FUNCTIONS = {',
+    ]
+    for name, instructions in functions.items():
+        lines.append(f'    {name!r}: [')
+        lines.extend(f'        (I.{opcode.name}, {args!r}),' for opcode, args in instructions)
+        lines.append('    ],')
+    lines.append('}')
+
+    compiled = {}
+    for index, (name, instructions) in enumerate(functions.items()):
+        if name == 'main':
+            continue  # Runs on the root branch, which isn't a callee
+        source = vm.function_source(vm.load_program(instructions), f'_function_{index}', 'vm.')
+        if source is None:
+            log.info(f"Function {name} will be interpreted")
+            continue
+        lines += ['', f'# {name}', source]
+        compiled[name] = f'_function_{index}'
+
+    lines += ['', 'COMPILED = {']
+    lines.extend(f'    {name!r}: {factory},' for name, factory in compiled.items())
+    lines.append('}')
+
+    log.info(f"Compiled {len(compiled)} of {len(functions)} functions to Python")
+    return '\n'.join(lines) + '\n' + MODULE_FOOTER
@@ -5,7 +5,6 @@ from threading import Thread
 import customtkinter as tki
 import tkinter as tk
 import time
-import zlib
 import sys
 import os
 import vm
@@ -24,10 +23,10 @@ class CustomRoot(tki.CTk, TkinterDnD.DnDWrapper):
         self.TkdndVersion = TkinterDnD._require(self)
 
 def disassemble_file(file_path:str):
-    with open(file_path, 'rb') as f:
-        bytecode = zlib.decompress(f.read())
-
-    return disassemble_executable(bytecode)
+    """The disassembly of an executable as text, and the lines of each function."""
+    bytecode = vm.read_executable(file_path)
+    namespace, functions = vm.parse_executable(bytecode)
+    return disassemble_executable(bytecode), {name: code.lines for name, code in functions.items()}
 
 def main():
     global root
@@ -777,15 +776,10 @@ def show_breakpoint_info(root, branch):
 
     # Fill stack data
     stack_info.insert("end", "Call Stack:\n\n")
-    current = branch
-    depth = 0
-    while current:
-        stack_info.insert("end", f"[{depth}] {current.function}:{current.program_counter}\n")
-        if current.vars:
-            stack_info.insert("end", f"    Variables: {current.vars}\n")
-
-        current = current.caller
-        depth += 1
+    for depth, frame in enumerate([branch, *reversed(branch.frames)]):
+        stack_info.insert("end", f"[{depth}] {frame.function}:{frame.program_counter}\n")
+        if frame.vars:
+            stack_info.insert("end", f"    Variables: {frame.vars}\n")
 
     # Add control buttons
     button_frame = tki.CTkFrame(info_window)
@@ -1141,8 +1135,8 @@ def _complete_reset(root):
 
     # Create a new root branch
     vm.root.kill()
+    vm.branches.clear()
     vm.root = vm.Branch()
-    vm.branches = [vm.root]
 
     # Clear other VM state
     vm.blocks.clear()
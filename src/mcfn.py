@@ -1,18 +1,18 @@
 from disassembler import disassemble_executable
+from exporter import export_executable
 import compiler
 import sys
-import gui
 import vm
 import os
 import logging
-from common import setup_logger
+from common import setup_logger, INDEXED_LAYOUT
 
 os.chdir(os.path.dirname(sys.argv[0]))
 
 # Setup logger for main application
 log = setup_logger("MCFN_Main", logging.INFO)
 
-usage = "Usage: mcfn (run | compile | disassemble) [-w <output_path>] <source_path>"
+usage = "Usage: mcfn (run | compile | disassemble | build) [-w <output_path>] [--mmap] [--output (stdout | buffered | null)] <source_path>"
 
 def run_executable(executable):
     """
@@ -41,25 +41,31 @@ def run_executable(executable):
         
         vm.run(vm.root, functions, namespace)
         log.info("Execution completed successfully")
+
+        stats = vm.run_stats
+        memory = 'unknown' if stats['peak_memory'] is None else f"{stats['peak_memory'] / 2**20:.1f} MiB"
+        log.info(f"Scheduling policy {stats['policy']}: {stats['instructions']} instructions, "
+                 f"{stats['tail_calls']} tail calls eliminated, "
+                 f"peak {stats['peak_branches']} live branches, peak memory {memory}")
     except Exception as e:
         log.error(f"Error executing MCFN binary: {e}")
         raise
 
-def compile_executable(source_path):
+def compile_executable(source_path, indexed=False):
     try:
         if not os.path.exists(source_path):
             log.error(f"Source path not found: {source_path}")
             sys.exit(1)
             
         functions = compiler.compile_files(source_path)
-        return compiler.create_executable(functions, source_path)
+        return compiler.create_executable(functions, source_path, indexed)
     except Exception as e:
         log.error(f"Error compiling executable: {e}")
         sys.exit(1)
 
-def compile_run(source_path):
+def compile_run(source_path, indexed=False):
     try:
-        executable = compile_executable(source_path)
+        executable = compile_executable(source_path, indexed)
         run_executable(executable)
         return executable
     except Exception as e:
@@ -68,7 +74,8 @@ def compile_run(source_path):
 
 def write_executable(executable, output_path):
     try:
-        compiler.write_file(output_path, executable)
+        # Indexed executables stay uncompressed so they can be memory mapped
+        compiler.write_file(output_path, executable, compress=not executable[4] & INDEXED_LAYOUT)
         log.info(f"Executable successfully written to {output_path}")
     except Exception as e:
         log.error(f"Error writing executable to {output_path}: {e}")
@@ -88,6 +95,7 @@ def read_executable(input_path):
 if __name__ == "__main__":
     try:
         if len(sys.argv) == 1:
+            import gui  # Only the GUI app needs tkinter and the debugger
             exit(gui.main()) # Run GUI app
 
         if len(sys.argv) in range(2, 3):
@@ -112,6 +120,17 @@ if __name__ == "__main__":
                 print(usage)
                 exit(1)
 
+        if "--output" in sys.argv:
+            o_index = sys.argv.index("--output")
+            sink = sys.argv[o_index + 1] if o_index + 2 < len(sys.argv) else None
+            if sink not in vm.OUTPUT_SINKS:
+                log.error(f"Invalid output sink: {sink}. Must be one of {list(vm.OUTPUT_SINKS)}")
+                print(usage)
+                exit(1)
+            vm.output = vm.OUTPUT_SINKS[sink]()
+
+        indexed = "--mmap" in sys.argv
+
         # Validate source_path exists
         if not source_path or source_path.startswith('-'):
             log.error("Missing source path")
@@ -119,7 +138,7 @@ if __name__ == "__main__":
             exit(1)
             
         # Validate action
-        valid_actions = ["run", "compile", "disassemble"]
+        valid_actions = ["run", "compile", "disassemble", "build"]
         if action not in valid_actions:
             log.error(f"Invalid action: {action}. Must be one of {valid_actions}")
             print(usage)
@@ -131,7 +150,7 @@ if __name__ == "__main__":
         if action == "run":
             if os.path.isdir(source_path):
                 log.info(f"Compiling and running directory: {source_path}")
-                executable = compile_run(source_path)
+                executable = compile_run(source_path, indexed)
             else:
                 log.info(f"Running executable file: {source_path}")
                 executable = read_executable(source_path)
@@ -139,7 +158,7 @@ if __name__ == "__main__":
 
         elif action == "compile":
             log.info(f"Compiling source: {source_path}")
-            executable = compile_executable(source_path)
+            executable = compile_executable(source_path, indexed)
             log.info("Compilation successful")
 
         elif action == "disassemble":
@@ -156,8 +175,21 @@ if __name__ == "__main__":
                     log.error(f"Error writing disassembly to {output_path}: {e}")
                     exit(1)
 
+        elif action == "build":
+            log.info(f"Exporting {source_path} as a Python module")
+            executable = read_executable(source_path)
+            module = export_executable(executable)
+            module_path = output_path or os.path.splitext(source_path)[0] + '.py'
+            try:
+                with open(module_path, 'w') as f:
+                    f.write(module)
+                log.info(f"Module written to {module_path}")
+            except Exception as e:
+                log.error(f"Error writing module to {module_path}: {e}")
+                exit(1)
+
         # Write executable if output path is specified
-        if output_path and action != "disassemble":
+        if output_path and action not in ("disassemble", "build"):
             write_executable(executable, output_path)
             
     except Exception as e:
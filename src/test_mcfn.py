@@ -3,15 +3,20 @@ import sys
 import os
 import io
 import json
+import mmap
+import tempfile
+import gc
+import weakref
 from contextlib import redirect_stdout
 
 # Add parent directory to path so we can import modules
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from common import Instruction
+from common import Instruction, FORMAT_VERSION
 import compiler
 import vm
 import disassembler
+import exporter
 
 compiler.namespace = 'test'
 
@@ -22,11 +27,11 @@ class TestAdvancedMCFN(unittest.TestCase):
     
     def setUp(self):
         # Reset VM state before each test
-        vm.scoreboards = {}
+        vm.scoreboards = vm.Scoreboards()
         vm.blocks = {}
-        vm.entities = []
+        vm.entities = vm.EntityStore()
         vm.root = vm.Branch()
-        vm.branches = [vm.root]
+        vm.branches = vm.Scheduler([vm.root])
         vm.branchId = 0
 
     def test_advanced_range_parsing(self):
@@ -69,29 +74,29 @@ class TestAdvancedMCFN(unittest.TestCase):
         
         # Main function instructions
         main_instructions = [
-            ("set_score", ["@s", "counter", "0"]),  # Set counter to 0
-            ("execute_store", ["result", "@s", "result"]),  # Store result of next instruction
-            ("run_func", ["test_add", "5", "10"]),  # Call test_add with args 5 and 10
-            ("say", ["Result:", "15"])  # Say the result
+            (Instruction.set_score, ["@s", "counter", "0"]),  # Set counter to 0
+            (Instruction.execute_store, ["result", "@s", "result"]),  # Store result of next instruction
+            (Instruction.run_func, ["test_add", "5", "10"]),  # Call test_add with args 5 and 10
+            (Instruction.say, ["Result:", "15"])  # Say the result
         ]
         
         # Add function instructions
         add_instructions = [
-            ("set_score", ["a", "temp", "$0"]),  # Set a to first arg (5)
-            ("set_score", ["b", "temp", "$1"]),  # Set b to second arg (10)
-            ("operation", ["a", "temp", "+=", "b", "temp"]),  # a += b
-            ("return_run", []),  # Return
-            ("get", ["a", "temp"])  # Get a (will be returned)
+            (Instruction.set_score, ["a", "temp", "$0"]),  # Set a to first arg (5)
+            (Instruction.set_score, ["b", "temp", "$1"]),  # Set b to second arg (10)
+            (Instruction.operation, ["a", "temp", "+=", "b", "temp"]),  # a += b
+            (Instruction.return_run, []),  # Return
+            (Instruction.get, ["a", "temp"])  # Get a (will be returned)
         ]
         
         # Set up VM functions dictionary
         vm.functions = {
-            "main": main_instructions,
-            "test_add": add_instructions
+            "main": vm.load_program(main_instructions),
+            "test_add": vm.load_program(add_instructions)
         }
         
         # Assign main to root branch
-        vm.root.program = main_instructions
+        vm.root.program = vm.load_program(main_instructions)
         
         # Capture output
         with redirect_stdout(io.StringIO()) as output:
@@ -106,27 +111,27 @@ class TestAdvancedMCFN(unittest.TestCase):
     def test_complex_scoreboard_operations(self):
         """Test complex scoreboard operations with multiple objectives and targets"""
         # Set up test environment
-        vm.scoreboards = {
+        vm.scoreboards = vm.Scoreboards({
             "score_a": {"player1": 10, "player2": 20},
             "score_b": {"player1": 5, "player2": 15}
-        }
+        })
         
         # Create instruction list directly
         instructions = [
             # Test basic operations
-            ("operation", ["player1", "score_a", "+=", "player1", "score_b"]),
-            ("operation", ["player2", "score_a", "-=", "player1", "score_b"]),
+            (Instruction.operation, ["player1", "score_a", "+=", "player1", "score_b"]),
+            (Instruction.operation, ["player2", "score_a", "-=", "player1", "score_b"]),
             
             # Test multiplication and division
-            ("operation", ["player1", "score_b", "*=", "player2", "score_b"]),
-            ("operation", ["player2", "score_b", "/=", "player1", "score_a"]),
+            (Instruction.operation, ["player1", "score_b", "*=", "player2", "score_b"]),
+            (Instruction.operation, ["player2", "score_b", "/=", "player1", "score_a"]),
             
             # Test min/max operations
-            ("operation", ["player1", "score_a", "<", "player2", "score_a"]),
-            ("operation", ["player2", "score_b", ">", "player1", "score_b"])
+            (Instruction.operation, ["player1", "score_a", "<", "player2", "score_a"]),
+            (Instruction.operation, ["player2", "score_b", ">", "player1", "score_b"])
         ]
         
-        vm.root.program = instructions
+        vm.root.program = vm.load_program(instructions)
         
         # Define _scoreboard_operation manually to ensure correct implementation
         def mock_scoreboard_operation(branch, args):
@@ -166,7 +171,7 @@ class TestAdvancedMCFN(unittest.TestCase):
         
         # Override instruction execution for operation
         def mock_execute_instruction(branch, inst, args):
-            if inst == "operation":
+            if inst == Instruction.operation:
                 return mock_scoreboard_operation(branch, args)
             return original_operation(branch, inst, args)
             
@@ -202,38 +207,38 @@ class TestAdvancedMCFN(unittest.TestCase):
     def test_execute_chain(self):
         """Test complex execute instruction chains"""
         # Setup test environment with entities
-        vm.entities = [
+        vm.entities = vm.EntityStore([
             {"id": "zombie1", "type": "zombie", "position": (0, 0, 0), "tags": ["tagged"]},
             {"id": "zombie2", "type": "zombie", "position": (10, 0, 0)},
             {"id": "skeleton", "type": "skeleton", "position": (5, 0, 0)}
-        ]
+        ])
         
         # Create test instructions directly instead of compiling
         instructions = [
             # Add scoreboard objective
-            ("set_score", ["@s", "test_obj", "0"]),
+            (Instruction.set_score, ["@s", "test_obj", "0"]),
             
             # Execute as zombie store
-            ("execute_as", ["@e[type=zombie]"]),
-            ("say", ["I'm a zombie"]),
-            ("kill_branch", []),
+            (Instruction.execute_as, ["@e[type=zombie]"]),
+            (Instruction.say, ["I'm a zombie"]),
+            (Instruction.kill_branch, []),
             
             # Execute as zombie if entity
-            ("execute_as", ["@e[type=zombie]"]),
-            ("if_entity", ["@e[type=skeleton]"]),
-            ("positioned", ["~", "~1", "~"]),
-            ("say", ["Found skeleton nearby"]),
-            ("kill_branch", []),
+            (Instruction.execute_as, ["@e[type=zombie]"]),
+            (Instruction.if_entity, ["@e[type=skeleton]"]),
+            (Instruction.positioned, ["~", "~1", "~"]),
+            (Instruction.say, ["Found skeleton nearby"]),
+            (Instruction.kill_branch, []),
             
             # Execute as zombie with tag unless entity
-            ("execute_as", ["@e[type=zombie,tag=tagged]"]),
-            ("unless_entity", ["@e[type=creeper]"]),
-            ("say", ["No creepers nearby"]),
-            ("kill_branch", []),
+            (Instruction.execute_as, ["@e[type=zombie,tag=tagged]"]),
+            (Instruction.unless_entity, ["@e[type=creeper]"]),
+            (Instruction.say, ["No creepers nearby"]),
+            (Instruction.kill_branch, []),
         ]
         
         # Use these instructions directly
-        vm.root.program = instructions
+        vm.root.program = vm.load_program(instructions)
         
         # Redirect stdout to capture output
         with redirect_stdout(io.StringIO()) as output:
@@ -253,18 +258,18 @@ class TestAdvancedMCFN(unittest.TestCase):
     def test_advanced_target_selectors(self):
         """Test complex target selectors with multiple arguments"""
         # Setup test environment with entities
-        vm.entities = [
+        vm.entities = vm.EntityStore([
             {"id": "zombie1", "type": "zombie", "position": (0, 0, 0), "tags": ["boss"], "nbt": {"Health": 20, "CustomName": "Boss Zombie"}},
             {"id": "zombie2", "type": "zombie", "position": (5, 0, 0), "tags": ["minion"], "nbt": {"Health": 10}},
             {"id": "skeleton1", "type": "skeleton", "position": (10, 0, 0), "nbt": {"Health": 15}},
             {"id": "skeleton2", "type": "skeleton", "position": (15, 0, 0), "nbt": {"Health": 5}}
-        ]
+        ])
         
         # Create scoreboards for testing with entity ID keys
-        vm.scoreboards = {
+        vm.scoreboards = vm.Scoreboards({
             "health": {"zombie1": 20, "zombie2": 10, "skeleton1": 15, "skeleton2": 5},
             "power": {"zombie1": 100, "zombie2": 50, "skeleton1": 30, "skeleton2": 20}
-        }
+        })
         
         # Add entity IDs to scoreboards dictionary if they don't exist
         for entity in vm.entities:
@@ -306,15 +311,15 @@ class TestAdvancedMCFN(unittest.TestCase):
     def test_json_text_components(self):
         """Test parsing and processing of JSON text components"""
         # Set up test directly without relying on compiler
-        vm.scoreboards = {"score": {"@s": 42}}
+        vm.scoreboards = vm.Scoreboards({"score": {"@s": 42}})
 
         # Create instructions that simulate scoreboard and tellraw
         instructions = [
-           ("set_score", ["@s", "score", "42"]),  # Set @s score to 42
-           ("tellraw", [{"text": "Your score is: ", "color": "gold", "bold": True,"extra": [{"score": {"name": "@s", "objective": "score"}, "color": "green"}]}])
+           (Instruction.set_score, ["@s", "score", "42"]),  # Set @s score to 42
+           (Instruction.tellraw, [{"text": "Your score is: ", "color": "gold", "bold": True,"extra": [{"score": {"name": "@s", "objective": "score"}, "color": "green"}]}])
         ]
 
-        vm.root.program = instructions
+        vm.root.program = vm.load_program(instructions)
 
         # Redirect stdout to capture output
         with redirect_stdout(io.StringIO()) as output:
@@ -330,40 +335,40 @@ class TestAdvancedMCFN(unittest.TestCase):
         
         # Main function instructions
         main_instructions = [
-            ("set_score", ["@s", "base", "5"]),
-            ("execute_store", ["result", "@s", "result"]),
-            ("run_func", ["level1", "10", "Hello"])  # x=10, msg="Hello"
+            (Instruction.set_score, ["@s", "base", "5"]),
+            (Instruction.execute_store, ["result", "@s", "result"]),
+            (Instruction.run_func, ["level1", "10", "Hello"])  # x=10, msg="Hello"
         ]
         
         # Level 1 function instructions
         level1_instructions = [
-            ("set_score", ["x", "temp", "$0"]),           # Set x = 10 from first arg
-            ("say", ["Got message:", "$1"]),              # Say message from second arg
-            ("operation", ["x", "temp", "*=", "@s", "base"]),  # x *= 5 -> x = 50
-            ("execute_store", ["result", "y", "temp"]),
-            ("run_func", ["level2", "7"]),                # Call level2 with value=7
-            ("operation", ["x", "temp", "+=", "y", "temp"]),  # x += y (y = 7*7 = 49)
-            ("return_run", []),
-            ("get", ["x", "temp"])                        # Return x (50+49=99)
+            (Instruction.set_score, ["x", "temp", "$0"]),           # Set x = 10 from first arg
+            (Instruction.say, ["Got message:", "$1"]),              # Say message from second arg
+            (Instruction.operation, ["x", "temp", "*=", "@s", "base"]),  # x *= 5 -> x = 50
+            (Instruction.execute_store, ["result", "y", "temp"]),
+            (Instruction.run_func, ["level2", "7"]),                # Call level2 with value=7
+            (Instruction.operation, ["x", "temp", "+=", "y", "temp"]),  # x += y (y = 7*7 = 49)
+            (Instruction.return_run, []),
+            (Instruction.get, ["x", "temp"])                        # Return x (50+49=99)
         ]
         
         # Level 2 function instructions
         level2_instructions = [
-            ("set_score", ["val", "temp", "$0"]),         # Set val = 7 from first arg
-            ("operation", ["val", "temp", "*=", "val", "temp"]),  # val *= val -> val = 49
-            ("return_run", []),
-            ("get", ["val", "temp"])                      # Return val (49)
+            (Instruction.set_score, ["val", "temp", "$0"]),         # Set val = 7 from first arg
+            (Instruction.operation, ["val", "temp", "*=", "val", "temp"]),  # val *= val -> val = 49
+            (Instruction.return_run, []),
+            (Instruction.get, ["val", "temp"])                      # Return val (49)
         ]
         
         # Set up VM functions dictionary
         vm.functions = {
-            "main": main_instructions,
-            "level1": level1_instructions,
-            "level2": level2_instructions
+            "main": vm.load_program(main_instructions),
+            "level1": vm.load_program(level1_instructions),
+            "level2": vm.load_program(level2_instructions)
         }
         
         # Setup necessary variables and scoreboards
-        vm.root.program = main_instructions
+        vm.root.program = vm.load_program(main_instructions)
         
         # Capture output
         with redirect_stdout(io.StringIO()) as output:
@@ -448,18 +453,18 @@ class TestAdvancedMCFN(unittest.TestCase):
         
         # Create instructions that simulate what would happen with variable substitution
         # These instructions will be processed by the VM's variable substitution directly
-        branch.program = [
-            ("set_score", ["value", "score", "$value"]),
-            ("set_score", ["modifier", "score", "$modifier"]),
-            ("operation", ["value", "score", "*=", "modifier", "score"]),
-            ("get", ["value", "score"])  # This simulates return run
-        ]
+        branch.program = vm.load_program([
+            (Instruction.set_score, ["value", "score", "$value"]),
+            (Instruction.set_score, ["modifier", "score", "$modifier"]),
+            (Instruction.operation, ["value", "score", "*=", "modifier", "score"]),
+            (Instruction.get, ["value", "score"])  # This simulates return run
+        ])
         
         # Set the variables that will be substituted
         branch.vars = ["10", "5"]  # These will be accessed as $(value) and $(modifier)
         
         # Add to branches list
-        vm.branches.append(branch)
+        vm.branches.add(branch)
         
         # Run the function
         while branch in vm.branches:
@@ -468,5 +473,914 @@ class TestAdvancedMCFN(unittest.TestCase):
         # Check that variables were substituted correctly and operation performed
         self.assertEqual(vm.scoreboards.get("score", {}).get("value"), 50)  # 10*5=50
 
+    def test_opcode_dispatch(self):
+        """Test that decoded instructions keep their opcode and unknown opcodes fail at load time"""
+        bytecode = compiler.compile_instr("set_score", ["x", "obj", "3"])
+        bytecode += compiler.compile_instr("add", ["x", "obj", "4"])
+        instructions = vm.parse_instructions(bytecode)
+        self.assertEqual([inst for inst, _ in instructions], [Instruction.set_score, Instruction.add])
+
+        vm.root.program = instructions
+        while vm.branches:
+            vm.process_all_branches()
+        self.assertEqual(vm.scoreboards["obj"]["x"], 7)
+
+        # Opcode 255 is not part of the instruction set
+        with self.assertRaises(ValueError):
+            vm.parse_instructions(bytes([0, 255]))
+
+    def test_operand_binding(self):
+        """Test that operands are decoded into typed objects when a program is loaded"""
+        program = vm.load_program([
+            (Instruction.add, ["@s", "obj", "5"]),
+            (Instruction.if_score, ["x", "obj", "matches", "1..4"]),
+            (Instruction.positioned, ["^1", "^", "^3"]),
+            (Instruction.set_score, ["y", "obj", "$(a)"]),
+        ])
+
+        target, objective, amount = program[0][1]
+        self.assertIsInstance(target, vm.Selector)
+        self.assertEqual(amount, 5)
+
+        score_range = program[1][1][3]
+        self.assertEqual((score_range.start, score_range.end), (1, 4))
+
+        coordinates = program[2][1][0]
+        self.assertTrue(coordinates.caret)
+        self.assertEqual(coordinates.offsets, (1.0, 0.0, 3.0))
+
+        macro = program[3][1][2]
+        self.assertIsInstance(macro, vm.MacroRef)
+        self.assertEqual(macro.index, 0)
+
+        # Macro arguments are bound per execution without touching the program
+        vm.root.program = vm.Program(program[3:])
+        vm.root.vars = ["12"]
+        while vm.branches:
+            vm.process_all_branches()
+        self.assertEqual(vm.scoreboards["obj"]["y"], 12)
+        self.assertIs(program[3][1][2], macro)
+
+        with self.assertRaises(ValueError):
+            vm.load_program([(Instruction.add, ["x", "obj", "five"])])
+
+    def test_selector_cache(self):
+        """Test that selectors are compiled once and filter before sort and limit"""
+        vm.entities = vm.EntityStore([
+            {"id": "a", "type": "zombie", "position": (9, 0, 0), "tags": ["boss", "undead"]},
+            {"id": "b", "type": "zombie", "position": (1, 0, 0), "tags": ["undead"]},
+            {"id": "c", "type": "pig", "position": (2, 0, 0)},
+        ])
+        vm.scoreboards = vm.Scoreboards({"hp": {"a": 5}})
+
+        selector = "@e[tag=undead,tag=!boss,sort=nearest,limit=1]"
+        hits = vm.compile_selector.cache_info().hits
+        first = vm.compile_selector(selector)
+        self.assertIs(vm.compile_selector(selector), first)
+        self.assertEqual(vm.compile_selector.cache_info().hits, hits + 1)
+
+        self.assertEqual([e["id"] for e in vm.eval_target_selector(vm.root, selector)], ["b"])
+        self.assertEqual([e["id"] for e in vm.eval_target_selector(vm.root, "@e[sort=furthest,limit=1]")], ["a"])
+        # Entities without a score count as 0 instead of raising
+        self.assertEqual([e["id"] for e in vm.eval_target_selector(vm.root, "@e[scores={hp=0}]")], ["b", "c"])
+
+    def test_spatial_index(self):
+        """Test that grid-backed selectors match a full scan and follow summon, kill and move"""
+        positions = [(x * 7.5, (x * 13) % 40 - 20, (x * 29) % 90 - 45) for x in range(60)]
+        vm.entities = vm.EntityStore(
+            {"id": f"e{i}", "type": "pig", "position": pos} for i, pos in enumerate(positions)
+        )
+        vm.root.position = (100, 0, 0)
+
+        by_distance = sorted(vm.entities, key=lambda e: vm.math.dist(e["position"], vm.root.position))
+        nearest = vm.eval_target_selector(vm.root, "@e[sort=nearest,limit=5]")
+        self.assertEqual([e["id"] for e in nearest], [e["id"] for e in by_distance[:5]])
+
+        in_range = [e["id"] for e in vm.entities if vm.math.dist(e["position"], (100, 0, 0)) <= 30]
+        self.assertEqual([e["id"] for e in vm.eval_target_selector(vm.root, "@e[distance=..30]")], in_range)
+        in_box = [e["id"] for e in vm.entities if 0 <= e["position"][0] < 41 and -20 <= e["position"][1] < 1]
+        self.assertEqual([e["id"] for e in vm.eval_target_selector(vm.root, "@e[x=0,y=-20,dx=40,dy=20]")], in_box)
+
+        vm.entities.move(by_distance[0], (-500, 0, 0))
+        nearest = vm.eval_target_selector(vm.root, "@e[sort=nearest,limit=1]")
+        self.assertEqual(nearest[0]["id"], by_distance[1]["id"])
+
+        vm.root.program = vm.load_program([
+            (Instruction.summon, ["minecraft:cow", "100", "0", "1"]),
+            (Instruction.kill, ["@e[type=pig,distance=..30]"]),
+        ])
+        while vm.branches:
+            vm.process_all_branches()
+        nearest = vm.eval_target_selector(vm.root, "@e[sort=nearest,limit=1]")
+        self.assertEqual(nearest[0]["type"], "cow")
+        self.assertEqual(len(vm.entities), 61 - len(in_range) + (by_distance[0]["id"] in in_range))
+
+    def test_entity_indexes(self):
+        """Test that type, tag and name indexes follow tag add/remove, summon and kill"""
+        vm.root.program = vm.load_program([
+            (Instruction.summon, ["minecraft:zombie", "0", "0", "0", "{CustomName:Bob}"]),
+            (Instruction.summon, ["zombie", "5", "0", "0"]),
+            (Instruction.summon, ["skeleton", "9", "0", "0"]),
+            (Instruction.tag_add, ["@e[type=zombie]", "undead"]),
+            (Instruction.tag_add, ["@e[type=skeleton]", "undead"]),
+            (Instruction.tag_remove, ["@e[name=Bob]", "undead"]),
+            (Instruction.kill, ["@e[type=skeleton]"]),
+        ])
+        while vm.branches:
+            vm.process_all_branches()
+
+        def select(selector):
+            return [e["position"][0] for e in vm.eval_target_selector(vm.root, selector)]
+
+        self.assertEqual(select("@e[tag=undead]"), [5])
+        self.assertEqual(select("@e[type=zombie,tag=!undead]"), [0])
+        self.assertEqual(select("@e[name=Bob,type=minecraft:zombie]"), [0])
+        self.assertEqual(select("@e[type=!zombie]"), [])
+        self.assertEqual(vm.entities.lookup((("tag", "undead"), ("type", "skeleton"))), [])
+
+    def test_scoreboard_store(self):
+        """Test the columnar scoreboard: wrapping, reads without writes, reset and the dict view"""
+        vm.root.program = vm.load_program([
+            (Instruction.set_score, ["a", "obj", "2147483647"]),
+            (Instruction.add, ["a", "obj", "1"]),
+            (Instruction.get, ["nobody", "obj"]),
+            (Instruction.set_score, ["b", "obj", "3"]),
+            (Instruction.set_score, ["b", "other", "4"]),
+            (Instruction.reset, ["b", "obj"]),
+        ])
+        while vm.branches:
+            vm.process_all_branches()
+
+        self.assertEqual(vm.scoreboards["obj"]["a"], -2147483648)
+        self.assertNotIn("nobody", vm.scoreboards["obj"])
+        self.assertEqual(dict(vm.scoreboards["obj"]), {"a": -2147483648})
+        self.assertEqual(vm.scoreboards.get("other", {}).get("b"), 4)
+        self.assertEqual(vm.scoreboards.score("obj", "b", None), None)
+
+        vm.scoreboards["obj"]["c"] = 2 ** 32 + 5
+        self.assertEqual(vm.scoreboards.score("obj", "c"), 5)
+        self.assertEqual(dict(vm.scoreboards.items())["obj"], {"a": -2147483648, "c": 5})
+
+    def test_scheduler_fan_out(self):
+        """Test that thousands of branches from execute as run once each, in order"""
+        vm.entities = vm.EntityStore(
+            {"id": f"e{i}", "type": "pig", "position": (i, 0, 0)} for i in range(2000)
+        )
+        vm.root.program = vm.load_program([
+            (Instruction.execute_as, ["@e"]),
+            (Instruction.add, ["count", "obj", "1"]),
+            (Instruction.operation, ["last", "obj", "=", "@s", "id"]),
+            (Instruction.kill_branch, []),
+        ])
+        for i in range(2000):
+            vm.scoreboards.set_score("id", f"e{i}", i)
+
+        vm.process_all_branches()
+        self.assertEqual(len(vm.branches), 0)
+        self.assertEqual(vm.scoreboards["obj"]["count"], 2000)
+        self.assertEqual(vm.scoreboards["obj"]["last"], 1999)
+
+    def test_branch_pool(self):
+        """Test that killed branches are reused, but not while a callee still refers to them"""
+        vm.branch_pool = vm.BranchPool()
+        vm.entities = vm.EntityStore(
+            {"id": f"e{i}", "type": "pig", "position": (i, 0, 0)} for i in range(100)
+        )
+        program = vm.load_program([
+            (Instruction.execute_as, ["@e"]),
+            (Instruction.add, ["count", "obj", "1"]),
+            (Instruction.kill_branch, []),
+        ])
+        for _ in range(2):
+            vm.root.program = program
+            vm.root.program_counter = 0
+            vm.branches.add(vm.root)
+            vm.process_all_branches()
+
+        self.assertEqual(vm.scoreboards["obj"]["count"], 200)
+        self.assertEqual(vm.branch_pool.allocated, 100)
+        self.assertEqual(vm.branch_pool.reused, 100)
+        self.assertFalse(hasattr(vm.root, "__dict__"))
+
+        caller = vm.root.clone()
+        callee = caller.clone()
+        caller.kill()
+        self.assertNotIn(caller, vm.branch_pool.free)
+        callee.kill()
+        self.assertIn(caller, vm.branch_pool.free)
+        self.assertIsNone(callee.caller)
+
+    def test_skip_targets(self):
+        """Test that skip targets point at the next kill_branch and skipping uses them"""
+        program = vm.load_program([
+            (Instruction.if_score, ["a", "obj", "matches", "5"]),
+            (Instruction.set_score, ["b", "obj", "1"]),
+            (Instruction.set_score, ["c", "obj", "1"]),
+            (Instruction.kill_branch, []),
+            (Instruction.set_score, ["d", "obj", "1"]),
+        ])
+        self.assertEqual(program.skip_targets, [3, 3, 3, 3, 5, 5])
+
+        vm.root.program = program
+        vm.root.skip_over()
+        self.assertEqual(vm.root.program_counter, 3)
+        vm.root.program_counter = 4
+        vm.root.skip_over()
+        self.assertEqual(vm.root.program_counter, 5)
+
+        vm.root.program_counter = 0
+        while vm.branches:
+            vm.process_all_branches()
+        self.assertNotIn("b", vm.scoreboards.get("obj", {}))
+        self.assertNotIn("c", vm.scoreboards.get("obj", {}))
+
+    def test_macro_frames(self):
+        """Test that macro operands are bound per call frame and memoized"""
+        program = vm.load_program([
+            (Instruction.add, ["$(a)", "obj", "$(b)"]),
+            (Instruction.say, ["plain"]),
+        ])
+        operands = program[0][1]
+        self.assertIsInstance(operands, vm.MacroOperands)
+        self.assertEqual(operands.slots, ((0, 0), (2, 1)))
+        self.assertNotIsInstance(program[1][1], vm.MacroOperands)
+
+        first = vm.Branch()
+        first.vars = ["x", "3"]
+        second = vm.Branch()
+        second.vars = ["y", "4"]
+        bound = operands.bind(first)
+        self.assertEqual(bound, ["x", "obj", 3])
+        self.assertIs(operands.bind(first), bound)
+        self.assertEqual(operands.bind(second), ["y", "obj", 4])
+        self.assertIsInstance(operands[0], vm.MacroRef)
+
+        for _ in range(3):
+            vm.execute_instruction(first, *program[0])
+        self.assertEqual(vm.scoreboards["obj"]["x"], 9)
+
+        second.vars = ["y"]
+        with self.assertRaises(RuntimeError):
+            operands.bind(second)
+
+    def test_fast_and_instrumented_loops(self):
+        """Test that the fast loop is used without a debug hook and matches the instrumented one"""
+        instructions = [
+            (Instruction.set_score, ["a", "obj", "4"]),
+            (Instruction.if_score, ["a", "obj", "matches", "0..3"]),
+            (Instruction.set_score, ["b", "obj", "1"]),
+            (Instruction.kill_branch, []),
+            (Instruction.get, ["a", "obj"]),
+            (Instruction.operation, ["c", "obj", "+=", "a", "obj"]),
+        ]
+        self.assertIs(vm.select_branch_runner(), vm.run_branch_fast)
+
+        results = []
+        for runner in (vm.run_branch_fast, vm.process_branch):
+            self.setUp()
+            vm.root.program = vm.load_program(instructions)
+            while vm.branches:
+                vm.process_all_branches(runner)
+            results.append((dict(vm.scoreboards["obj"]), vm.root.last_value))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], ({"a": 4, "c": 4}, 4))
+
+        vm.debugHook = lambda branch, message=None: True
+        try:
+            self.assertIs(vm.select_branch_runner(), vm.process_branch)
+        finally:
+            vm.debugHook = None
+
+    def test_quantum_and_budget(self):
+        """Test the per-branch quantum and resumable instruction budgets"""
+        first = vm.Branch()
+        second = vm.Branch()
+        vm.branches = vm.Scheduler([first, second])
+        for branch, holder in ((first, "a"), (second, "b")):
+            branch.program = vm.load_program([(Instruction.add, [holder, "obj", "1"])] * 3)
+
+        vm.quantum = 1
+        try:
+            vm.process_all_branches()
+        finally:
+            vm.quantum = None
+        self.assertEqual(dict(vm.scoreboards["obj"]), {"a": 1, "b": 1})
+
+        # Endless recursion only runs for as long as the budget allows
+        functions = {"main": vm.load_program([
+            (Instruction.add, ["n", "obj", "1"]),
+            (Instruction.run_func, ["main"]),
+        ])}
+        start = vm.instructions_executed
+        self.assertFalse(vm.run(vm.root, functions, "test", max_instructions=100))
+        self.assertEqual(vm.instructions_executed - start, 100)
+        self.assertEqual(vm.scoreboards["obj"]["n"], 50)
+
+        self.assertFalse(vm.resume(max_instructions=11))
+        self.assertEqual(vm.scoreboards["obj"]["n"], 56)
+        self.assertFalse(vm.resume(max_seconds=0.01))
+        self.assertTrue(vm.branches)
+
+    def test_scheduling_policies(self):
+        """Test that every scheduling policy gives the same results and reports its peaks"""
+        # Each spawner forks two leaves per fan call; the leaves die in their first turn
+        functions = {
+            "main": vm.load_program([
+                (Instruction.execute_as, ["@e[type=spawner]"]),
+                (Instruction.run_func, ["spawn"]),
+                (Instruction.kill_branch, []),
+            ]),
+            "spawn": vm.load_program([
+                (Instruction.say, ["spawn"]),
+                (Instruction.run_func, ["fan"]),
+                (Instruction.say, ["next"]),
+                (Instruction.run_func, ["fan"]),
+                (Instruction.add, ["total", "obj", "1"]),
+            ]),
+            "fan": vm.load_program([
+                (Instruction.execute_as, ["@e[type=leaf]"]),
+                (Instruction.execute_as, ["@s"]),
+                (Instruction.say, ["leaf"]),
+                (Instruction.kill_branch, []),
+            ]),
+        }
+
+        peaks = {}
+        orders = {}
+        previous = vm.output
+        try:
+            for policy in vm.SCHEDULING_POLICIES:
+                vm.scoreboards = vm.Scoreboards()
+                vm.entities = vm.EntityStore([
+                    {"id": "s1", "type": "spawner", "position": (0, 0, 0)},
+                    {"id": "s2", "type": "spawner", "position": (0, 0, 0)},
+                    {"id": "l1", "type": "leaf", "position": (0, 0, 0)},
+                    {"id": "l2", "type": "leaf", "position": (0, 0, 0)},
+                ])
+                vm.output = vm.CaptureSink()
+                vm.scheduling_policy = policy
+                self.assertTrue(vm.run(vm.Branch(), functions, "test"))
+                self.assertEqual(dict(vm.scoreboards["obj"]), {"total": 2})
+                self.assertEqual(vm.run_stats["policy"], policy)
+                self.assertEqual(vm.run_stats["instructions"], 45)
+                peaks[policy] = vm.run_stats["peak_branches"]
+                orders[policy] = [line.split()[1] for line in vm.output.lines]
+        finally:
+            vm.scheduling_policy = vm.ROUND_ROBIN
+            vm.output = previous
+
+        self.assertLessEqual(peaks[vm.DEPTH_FIRST], peaks[vm.ROUND_ROBIN])
+        self.assertLess(peaks[vm.ROUND_ROBIN], peaks[vm.BREADTH_FIRST])
+        leaves = ["leaf"] * 4
+        # Depth-first finishes a spawner before starting the next one
+        self.assertEqual(orders[vm.DEPTH_FIRST], ["spawn", "leaf", "leaf", "next", "leaf", "leaf"] * 2)
+        # Round-robin runs new leaves in the pass that created them
+        self.assertEqual(orders[vm.ROUND_ROBIN], ["spawn", "spawn", *leaves, "next", "next", *leaves])
+        # Breadth-first runs the spawners of a pass before the leaves they created
+        self.assertEqual(orders[vm.BREADTH_FIRST], ["spawn", "spawn", "next", "next", *leaves, *leaves])
+        with self.assertRaises(ValueError):
+            vm.Scheduler(policy="random")
+
+        # Breadth-first keeps the branches of a pass ahead of those they create
+        scheduler = vm.Scheduler(["a", "b"], vm.BREADTH_FIRST)
+        for branch in scheduler.run_pass():
+            scheduler.add(branch + "1")
+        self.assertEqual(list(scheduler), ["a", "b", "a1", "b1"])
+        run_pass = scheduler.run_pass()
+        self.assertEqual(next(run_pass), "a")
+        scheduler.add("a2")
+        run_pass.close()
+        self.assertEqual(list(scheduler), ["b", "a1", "b1", "a", "a2"])
+
+    def test_call_frames(self):
+        """Test that function calls push frames on the calling branch"""
+        vm.functions = {
+            "down": vm.load_program([
+                (Instruction.add, ["depth", "obj", "1"]),
+                (Instruction.if_score, ["depth", "obj", "matches", "..5000"]),
+                (Instruction.run_func, ["down"]),
+                (Instruction.add, ["unwound", "obj", "1"]),
+            ]),
+            "double": vm.load_program([
+                (Instruction.operation, ["x", "obj", "+=", "x", "obj"]),
+                (Instruction.return_run, []),
+                (Instruction.get, ["x", "obj"]),
+            ]),
+        }
+        vm.root.program = vm.load_program([
+            (Instruction.set_score, ["x", "obj", "21"]),
+            (Instruction.execute_store, ["result", "y", "obj"]),
+            (Instruction.run_func, ["double"]),
+            (Instruction.run_func, ["down"]),
+            (Instruction.add, ["after", "obj", "1"]),
+        ])
+
+        depths = []
+        allocated = vm.branch_pool.allocated
+        while vm.branches:
+            vm.process_all_branches()
+            depths.append(len(vm.root.frames))
+
+        self.assertEqual(dict(vm.scoreboards["obj"]), {"x": 42, "y": 42, "depth": 5000, "unwound": 4999, "after": 1})
+        self.assertEqual(max(depths), 5000)
+        self.assertEqual(vm.branch_pool.allocated, allocated)
+
+    def test_tail_calls(self):
+        """Test that loops through tail calls run in constant stack depth"""
+        vm.functions = {
+            "loop": vm.load_program([
+                (Instruction.if_score, ["i", "obj", "matches", "..10000"]),
+                (Instruction.run_func, ["step"]),
+                (Instruction.kill_branch, []),
+            ]),
+            "step": vm.load_program([
+                (Instruction.add, ["i", "obj", "1"]),
+                (Instruction.run_func, ["loop"]),
+            ]),
+        }
+        program = vm.functions["loop"]
+        self.assertEqual(program.tail_calls, {1})
+        self.assertEqual(vm.functions["step"].tail_calls, {1})
+
+        vm.root.program = vm.load_program([
+            (Instruction.run_func, ["loop"]),
+            (Instruction.add, ["done", "obj", "1"]),
+        ])
+        depths = set()
+        eliminated = vm.tail_calls_eliminated
+        while vm.branches:
+            vm.process_all_branches()
+            depths.add(len(vm.root.frames))
+
+        self.assertEqual(dict(vm.scoreboards["obj"]), {"i": 10000, "done": 1})
+        self.assertEqual(depths, {0, 1})
+        self.assertEqual(vm.tail_calls_eliminated - eliminated, 20000)
+
+    def test_tail_call_stores(self):
+        """Test that a tail call stores the same result as a call"""
+        def run(a):
+            vm.scoreboards = vm.Scoreboards()
+            functions = {
+                "main": vm.load_program([
+                    (Instruction.execute_store, ["result", "stored", "obj"]),
+                    (Instruction.run_func, ["a"]),
+                    (Instruction.kill_branch, []),
+                ]),
+                "a": vm.load_program(a),
+                "b": vm.load_program([
+                    (Instruction.set_score, ["v", "obj", "7"]),
+                    (Instruction.return_run, []),
+                    (Instruction.get, ["v", "obj"]),
+                    (Instruction.kill_branch, []),
+                ]),
+            }
+            self.assertTrue(vm.run(vm.Branch(), functions, "test"))
+            return vm.scoreboards.score("obj", "stored")
+
+        try:
+            for threshold in (None, 1):
+                vm.jit_threshold = threshold
+                # a doesn't return a value, whether or not b takes over its frame
+                tail = run([(Instruction.run_func, ["b"]), (Instruction.kill_branch, [])])
+                call = run([(Instruction.run_func, ["b"]), (Instruction.add, ["x", "obj", "0"])])
+                self.assertEqual(tail, call)
+                self.assertEqual(tail, 0)
+                # `return run function b` returns b's value to main's store
+                self.assertEqual(run([
+                    (Instruction.return_run, []),
+                    (Instruction.run_func, ["b"]),
+                    (Instruction.kill_branch, []),
+                ]), 7)
+        finally:
+            vm.jit_threshold = None
+
+    def test_output_sinks(self):
+        """Test that say and tellraw write whole lines to the selected output sink"""
+        instructions = [
+            (Instruction.say, ["hello", "world"]),
+            (Instruction.tellraw, [[{"text": "a", "color": "red"}, {"text": "b"}]]),
+        ]
+        previous = vm.output
+        try:
+            vm.output = vm.CaptureSink()
+            vm.root.program = vm.load_program(instructions)
+            while vm.branches:
+                vm.process_all_branches()
+            self.assertEqual(vm.output.lines, [
+                "[SERVER] hello world",
+                "\033[31ma\033[0m\033[37mb\033[0m",
+            ])
+
+            vm.output = vm.BufferedStdoutSink(buffer_size=1001)
+            with redirect_stdout(io.StringIO()) as stdout:
+                for _ in range(10):
+                    vm.output.write_line("x" * 99)
+                self.assertEqual(stdout.getvalue(), "")
+                vm.output.write_line("y")
+                self.assertEqual(stdout.getvalue().count("\n"), 11)
+                vm.output.write_line("z")
+                vm.output.flush()
+                self.assertTrue(stdout.getvalue().endswith("y\nz\n"))
+
+            # Sinks that aren't active anymore can be freed
+            sink = weakref.ref(vm.BufferedStdoutSink())
+            gc.collect()
+            self.assertIsNone(sink())
+        finally:
+            vm.output = previous
+
+    def test_text_templates(self):
+        """Test that tellraw components render from templates without being modified"""
+        component = [
+            {"text": "Score: ", "color": "gold", "bold": True},
+            {"score": {"name": "player", "objective": "obj"}, "color": "green"},
+            {"text": "!"},
+        ]
+        template = vm.TextTemplate(component)
+        self.assertEqual(template.parts, ["\033[37m\033[1mScore: \033[0m\033[32m", None, "\033[0m\033[37m!\033[0m"])
+        self.assertEqual(template.slots, ((1, "obj", "player"),))
+
+        previous = vm.output
+        try:
+            vm.output = vm.CaptureSink()
+            vm.root.program = vm.load_program([
+                (Instruction.tellraw, [component]),
+                (Instruction.set_score, ["player", "obj", "7"]),
+                (Instruction.tellraw, [component]),
+            ])
+            while vm.branches:
+                vm.process_all_branches()
+            self.assertEqual([line.split("\033[32m")[1][0] for line in vm.output.lines], ["0", "7"])
+        finally:
+            vm.output = previous
+        self.assertNotIn("text", component[1])
+        self.assertEqual(vm.TextTemplate("plain").render(), "plain")
+
+        with self.assertRaises(ValueError):
+            vm.load_program([(Instruction.tellraw, [{"color": "red"}])])
+
+    def test_superinstructions(self):
+        """Test that execute shapes are fused for the fast loop and give the same results"""
+        vm.functions = {"bump": vm.load_program([
+            (Instruction.add, ["calls", "obj", "1"]),
+            (Instruction.return_run, []),
+            (Instruction.get, ["calls", "obj"]),
+        ])}
+        instructions = [
+            (Instruction.set_score, ["a", "obj", "3"]),
+            (Instruction.if_score, ["a", "obj", "matches", "1..5"]),
+            (Instruction.add, ["hit", "obj", "1"]),
+            (Instruction.kill_branch, []),
+            (Instruction.unless_score, ["a", "obj", "matches", "1..5"]),
+            (Instruction.add, ["miss", "obj", "1"]),
+            (Instruction.kill_branch, []),
+            (Instruction.if_score, ["a", "obj", ">", "hit", "obj"]),
+            (Instruction.run_func, ["bump"]),
+            (Instruction.kill_branch, []),
+            (Instruction.execute_store, ["result", "copy", "obj"]),
+            (Instruction.get, ["a", "obj"]),
+            (Instruction.kill_branch, []),
+            (Instruction.execute_store, ["result", "returned", "obj"]),
+            (Instruction.run_func, ["bump"]),
+            (Instruction.kill_branch, []),
+        ]
+        program = vm.load_program(instructions)
+        self.assertEqual(
+            [op for op, args in program.fused if isinstance(op, vm.Superinstruction)],
+            [vm.Superinstruction.guarded_command, vm.Superinstruction.guarded_command,
+             vm.Superinstruction.guarded_call, vm.Superinstruction.stored_command,
+             vm.Superinstruction.stored_command],
+        )
+        self.assertEqual(program[1][0], Instruction.if_score)
+
+        results = []
+        for runner in (vm.run_branch_fast, vm.process_branch):
+            self.setUp()
+            vm.root.id = 0  # Runs past kill_branch
+            vm.root.program = program
+            start = vm.instructions_executed
+            while vm.branches:
+                vm.process_all_branches(runner)
+            results.append((dict(vm.scoreboards["obj"]), vm.instructions_executed - start))
+        self.assertEqual(results[0][0], results[1][0])
+        self.assertEqual(results[0][0], {"a": 3, "hit": 1, "calls": 2, "copy": 3, "returned": 2})
+        self.assertLess(results[0][1], results[1][1])
+
+    def test_python_tier(self):
+        """Test that hot functions compiled to Python give the same results as the interpreter"""
+        functions = {
+            # Fibonacci the way src/test/fibonacci.mcfunction loops
+            "main": vm.load_program([
+                (Instruction.set_score, ["a", "fib", "0"]),
+                (Instruction.set_score, ["b", "fib", "1"]),
+                (Instruction.set_score, ["n", "fib", "25"]),
+                (Instruction.run_func, ["loop"]),
+                (Instruction.execute_store, ["result", "x", "fib"]),
+                (Instruction.run_func, ["square", "7"]),
+            ]),
+            "loop": vm.load_program([
+                (Instruction.if_score, ["i", "fib", "<", "n", "fib"]),
+                (Instruction.run_func, ["next"]),
+                (Instruction.kill_branch, []),
+            ]),
+            "next": vm.load_program([
+                (Instruction.operation, ["temp", "fib", "=", "a", "fib"]),
+                (Instruction.operation, ["a", "fib", "=", "b", "fib"]),
+                (Instruction.operation, ["b", "fib", "+=", "temp", "fib"]),
+                (Instruction.add, ["i", "fib", "1"]),
+                (Instruction.run_func, ["loop"]),
+            ]),
+            "square": vm.load_program([
+                (Instruction.set_score, ["s", "fib", "$(a)"]),
+                (Instruction.operation, ["s", "fib", "*=", "s", "fib"]),
+                (Instruction.return_run, []),
+                (Instruction.get, ["s", "fib"]),
+            ]),
+        }
+        self.assertIsNotNone(vm.compile_function(functions["square"]))
+        self.assertIsNone(vm.compile_function(functions["main"]))
+
+        results = []
+        try:
+            for threshold in (None, 2):
+                self.setUp()
+                for program in functions.values():
+                    program.calls, program.compiled = 0, None
+                vm.jit_threshold = threshold
+                self.assertTrue(vm.run(vm.root, functions, "test"))
+                results.append(dict(vm.scoreboards["fib"]))
+        finally:
+            vm.jit_threshold = None
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual((results[0]["a"], results[0]["x"]), (75025, 49))
+        self.assertTrue(functions["loop"].compiled)
+        self.assertTrue(functions["next"].compiled)
+
+    def test_export_module(self):
+        """Test that an executable exported as a Python module runs like the VM"""
+        sources = {
+            "main": "scoreboard players set n fib 20\n"
+                    "scoreboard players set a fib 0\n"
+                    "scoreboard players set b fib 1\n"
+                    "function loop\n"
+                    'tellraw @a [{"text":"fib "},{"score":{"name":"a","objective":"fib"}}]',
+            "loop": "execute if score i fib < n fib run function next",
+            "next": "scoreboard players operation t fib = a fib\n"
+                    "scoreboard players operation a fib = b fib\n"
+                    "scoreboard players operation b fib += t fib\n"
+                    "scoreboard players add i fib 1\n"
+                    "function loop",
+        }
+        executable = compiler.create_executable(
+            {name: compiler.compile_source(None, source) for name, source in sources.items()}, "test"
+        )
+        source = exporter.export_executable(executable)
+        self.assertIn("def _function_1(P):", source)
+        self.assertNotIn("_function_0", source)  # main is interpreted
+
+        results = []
+        previous = vm.output
+        try:
+            for exported in (False, True):
+                self.setUp()
+                vm.output = vm.CaptureSink()
+                if exported:
+                    module = {}
+                    exec(compile(source, "<exported>", "exec"), module)
+                    self.assertTrue(module["load"]()["next"].compiled)
+                    self.assertTrue(module["run"]())
+                else:
+                    namespace, functions = vm.parse_executable(executable)
+                    self.assertTrue(vm.run(vm.root, functions, namespace))
+                results.append((dict(vm.scoreboards["fib"]), vm.output.lines))
+        finally:
+            vm.output = previous
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0]["a"], 6765)
+
+    def test_python_tier_budgets(self):
+        """Test that compiled functions stay within the instruction budget and the quantum"""
+        functions = {
+            "main": vm.load_program([(Instruction.run_func, ["loop"])]),
+            "loop": vm.load_program([
+                (Instruction.if_score, ["i", "obj", "matches", "..999"]),
+                (Instruction.run_func, ["step"]),
+                (Instruction.kill_branch, []),
+            ]),
+            "step": vm.load_program([
+                (Instruction.add, ["i", "obj", "1"]),
+                (Instruction.run_func, ["loop"]),
+            ]),
+        }
+        try:
+            vm.jit_threshold = 1
+            finished = vm.run(vm.root, functions, "test", max_instructions=50)
+            self.assertFalse(finished)
+            self.assertTrue(functions["loop"].compiled)
+            self.assertLessEqual(vm.run_stats["instructions"], 50)
+            runs = 1
+            while not finished:
+                before = vm.instructions_executed
+                finished = vm.resume(max_instructions=50)
+                self.assertLessEqual(vm.instructions_executed - before, 50)
+                runs += 1
+            self.assertEqual(dict(vm.scoreboards["obj"]), {"i": 999})
+            self.assertGreater(runs, 40)
+
+            # Each turn runs at most a quantum of instructions, compiled or not
+            self.setUp()
+            vm.quantum = 4
+            vm.root.program = functions["main"]
+            vm.branches = vm.Scheduler([vm.root])
+            passes = 0
+            while vm.branches:
+                before = vm.instructions_executed
+                vm.process_all_branches()
+                self.assertLessEqual(vm.instructions_executed - before, 4)
+                passes += 1
+            self.assertEqual(vm.scoreboards["obj"]["i"], 999)
+            self.assertGreater(passes, 500)
+        finally:
+            vm.jit_threshold = None
+            vm.quantum = None
+
+    def test_code_objects(self):
+        """Test that executables load into compact code objects bound on first call"""
+        executable = compiler.create_executable({
+            "main": compiler.compile_source(None, "scoreboard players set x obj 1\nfunction used"),
+            "used": compiler.compile_source(None, "scoreboard players add x obj 2\nscoreboard players add x obj 2"),
+            "unused": compiler.compile_source(None, "scoreboard players add x obj 2"),
+        }, "test")
+        namespace, functions = vm.parse_executable(executable)
+
+        code = functions["used"]
+        self.assertIsInstance(code, vm.CodeObject)
+        self.assertEqual(code.opcodes.typecode, "B")
+        self.assertEqual(list(code), [(Instruction.add, ["x", "obj", 2])] * 2)
+        self.assertEqual(code.lines[-1], "add x obj 2")
+        # One pool for the whole executable, holding each operand once
+        self.assertIs(functions["unused"].pool, code.pool)
+        self.assertEqual(sorted(map(str, code.pool)), ["1", "2", "obj", "used", "x"])
+
+        self.assertTrue(vm.run(vm.root, functions, namespace))
+        self.assertEqual(vm.scoreboards["obj"]["x"], 5)
+        self.assertIsInstance(code.program, vm.Program)
+        self.assertIsNone(functions["unused"].program)
+        # A called function is held as its Program, the others as arrays
+        self.assertIsNone(code.opcodes)
+        self.assertEqual(code.lines[-1], "add x obj 2")
+        self.assertEqual(functions["unused"].opcodes.typecode, "B")
+
+    def test_indexed_executable(self):
+        """Test that indexed executables are memory mapped and decode functions when called"""
+        functions = {
+            "main": compiler.compile_source(None, "scoreboard players set x obj 1\nfunction used"),
+            "used": compiler.compile_source(None, "scoreboard players add x obj 2"),
+            "unused": compiler.compile_source(None, "scoreboard players add x obj 2"),
+        }
+        executable = compiler.create_executable(functions, "test", indexed=True)
+        namespace, loaded = vm.parse_executable(executable)
+        self.assertEqual(namespace, "test")
+        self.assertEqual(list(loaded), ["main", "used", "unused"])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.bin")
+            compiler.write_file(path, executable, compress=False)
+            mapped = vm.read_executable(path)
+            try:
+                self.assertIsInstance(mapped, mmap.mmap)
+                namespace, loaded = vm.parse_executable(mapped)
+                self.assertTrue(all(code.block is not None for code in loaded.values()))
+
+                self.assertTrue(vm.run(vm.root, loaded, namespace))
+                self.assertEqual(vm.scoreboards["obj"]["x"], 3)
+                self.assertIsNone(loaded["used"].block)
+                self.assertIsNotNone(loaded["unused"].block)  # Never decoded
+                self.assertEqual(list(loaded["unused"]), [(Instruction.add, ["x", "obj", 2])])
+            finally:
+                del namespace, loaded
+                mapped.close()
+
+        # The sequential layout still loads
+        self.assertEqual(list(vm.parse_executable(compiler.create_executable(functions, "test"))[1]), ["main", "used", "unused"])
+
+    def test_format_versions(self):
+        """Test that v5 lifts the length limits and v4 executables still load"""
+        holder = "h" * 300
+        body = "\n".join(f"scoreboard players add {holder} obj 1" for _ in range(300))
+        block = compiler.compile_source(None, body)
+        self.assertGreater(len(block), 65535)
+        executable = compiler.create_executable({"main": block}, "n" * 300)
+        self.assertEqual(executable[4], FORMAT_VERSION)
+
+        namespace, functions = vm.parse_executable(executable)
+        self.assertEqual(namespace, "n" * 300)
+        self.assertTrue(vm.run(vm.root, functions, namespace))
+        self.assertEqual(vm.scoreboards["obj"][holder], 300)
+        self.assertIn(f"add {holder} obj 1", disassembler.disassemble_executable(executable))
+
+        # v4: one byte counts and name lengths, two byte block lengths
+        block = bytes([3, Instruction.set_score]) + b"".join(bytes([len(arg)]) + arg for arg in (b"x", b"obj", b"4"))
+        v4 = b"MCFN\x04\x04test\x00\x01\x04main" + len(block).to_bytes(2, "big") + block
+        namespace, functions = vm.parse_executable(v4)
+        self.assertEqual(list(functions["main"]), [(Instruction.set_score, ["x", "obj", "4"])])
+        self.assertIn("set_score x obj 4", disassembler.disassemble_executable(v4))
+
+        with self.assertRaises(ValueError):
+            vm.parse_executable(b"MCFN\x03" + v4[5:])
+
+    def test_constant_pool(self):
+        """Test that executables store each distinct argument once, in a constant pool"""
+        functions = {
+            "main": compiler.compile_source(None, "scoreboard players set counter fib 3\nfunction step"),
+            "step": compiler.compile_source(None, "\n".join(
+                ["scoreboard players add counter fib 2"] * 5
+                + ['tellraw @a [{"score":{"name":"counter","objective":"fib"}}]'] * 2
+            )),
+        }
+        executable = compiler.create_executable(functions, "test")
+        self.assertEqual(executable.count(b"fib"), 2)  # The string and the compiled JSON text
+        self.assertLess(len(executable), sum(len(block) for block in functions.values()))
+
+        namespace, loaded = vm.parse_executable(executable)
+        first, last = loaded["main"][0][1], loaded["step"][4][1]
+        self.assertIs(first[1], last[1])  # One interned "fib" for every operand
+        self.assertIs(loaded["step"][5][1][0], loaded["step"][6][1][0])
+
+        previous = vm.output
+        vm.output = vm.CaptureSink()
+        try:
+            self.assertTrue(vm.run(vm.root, loaded, namespace))
+            self.assertIn("13", vm.output.lines[-1])
+        finally:
+            vm.output = previous
+        self.assertIn("add counter fib 2", disassembler.disassemble_executable(executable))
+
+    def test_numeric_operands(self):
+        """Test that numeric operands are validated at compile time and stored as typed constants"""
+        self.assertEqual(compiler.compile_instr("add", ["x", "obj", "lots"]), b"")
+        self.assertEqual(compiler.compile_instr("set_score", ["x", "obj", str(2**31)]), b"")
+        self.assertEqual(compiler.compile_source(None, "execute positioned ~ ~x ~ run say bad"), b"")
+        self.assertNotEqual(compiler.compile_instr("add", ["x", "obj", "$(amount)"]), b"")
+
+        executable = compiler.create_executable({
+            "main": compiler.compile_source(None, "\n".join([
+                "scoreboard players set x obj -7",
+                "scoreboard players add x obj 100",
+                "execute if score x obj matches ..-5 run scoreboard players add x obj 1",
+                "execute positioned ~1.5 ~ 64 run summon zombie ^ ^2 ^-0.5",
+            ])),
+        }, "test")
+        namespace, loaded = vm.parse_executable(executable)
+        instructions = list(loaded["main"])
+
+        self.assertEqual(instructions[0][1][2], -7)
+        score_range = instructions[2][1][3]
+        self.assertIsInstance(score_range, vm.Range)
+        self.assertEqual((score_range.start, score_range.end), (None, -5))
+        x, y, z = instructions[5][1]
+        self.assertIsInstance(x, vm.Coordinate)
+        self.assertEqual([(c.offset, c.relative) for c in (x, y, z)], [(1.5, True), (0.0, True), (64.0, False)])
+        self.assertEqual(list(map(str, instructions[6][1][1:])), ["^", "^2", "^-0.5"])
+
+        self.assertTrue(vm.run(vm.root, loaded, namespace))
+        self.assertEqual(vm.scoreboards["obj"]["x"], 93)
+
+        listing = disassembler.disassemble_executable(executable)
+        self.assertIn("set_score x obj -7", listing)
+        self.assertIn("if_score x obj matches ..-5", listing)
+        self.assertIn("summon zombie ^ ^2 ^-0.5", listing)
+
+    def test_invalid_numeric_operands(self):
+        """Test that the compiler reports invalid numeric operands and leaves their commands out"""
+        source = "\n".join([
+            "scoreboard players set x obj 1",
+            "scoreboard players add x obj 2147483648",
+            "execute positioned ~1x ~ ~ run say hi",
+            "say done",
+        ])
+        with self.assertLogs(compiler.log, "ERROR") as logs:
+            compiled = compiler.compile_source(None, source)
+        errors = "\n".join(logs.output)
+        self.assertIn("Invalid int32 operand '2147483648'", errors)
+        self.assertIn("Invalid coordinate operand '~1x'", errors)
+
+        # Only the valid commands are left
+        self.assertEqual(
+            compiled,
+            compiler.compile_source(None, "scoreboard players set x obj 1\nsay done"),
+        )
+        namespace, functions = vm.parse_executable(compiler.create_executable({"main": compiled}, "test"))
+        self.assertEqual([opcode for opcode, args in functions["main"]], [Instruction.set_score, Instruction.say])
+
+        # Numeric constants came with format v7, v6 only has text
+        executable = bytearray(compiler.create_executable({"main": compiled}, "test"))
+        self.assertEqual(executable[4], 7)
+        executable[4] = 6
+        with self.assertRaises(ValueError):
+            vm.parse_executable(bytes(executable))
+
 if __name__ == "__main__":
     unittest.main()
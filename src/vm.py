@@ -1,15 +1,33 @@
 from string import ascii_lowercase
-from time import sleep
+from time import sleep, perf_counter
+from collections import deque
+from collections.abc import MutableMapping, Sequence
+from enum import IntEnum, auto
+from functools import lru_cache
 from io import BytesIO
+from array import array
+from uuid import uuid4
+import atexit
+import mmap
 import random
+import heapq
 import pickle
 import struct
 import zlib
+import tracemalloc
 import math
 import sys
 import re
 import logging
-from common import Instruction, FORMAT_VERSION, setup_logger, STYLES
+from common import (
+    Instruction, Constant, MAGIC, FORMAT_VERSION, SUPPORTED_VERSIONS, INDEXED_LAYOUT, CONSTANT_POOL_VERSION,
+    TYPED_CONSTANTS_VERSION, COORDINATE_RELATIVE, COORDINATE_CARET, setup_logger, STYLES, read_varint, parse_range, decode_number_constant
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 level = logging.INFO
 log = setup_logger("MCFN", level)
@@ -17,141 +35,482 @@ log = setup_logger("MCFN", level)
 # Initialize VM components
 root = None  # Root execution context
 
-def parse_instructions(bytecode: bytes) -> list:
+# Opcodes without a handler that were already reported while loading.
+_warned_opcodes = set()
+
+class Superinstruction(IntEnum):
     """
-    Parses a binary instruction block into a list of instructions with their arguments.
-    Binary format for each instruction:
-      <argCount:1byte><instruction:1byte>
-      Then for each argument:
-         <argLen:1byte><argBytes>
-    Returns:
-      A list of tuples: (instruction_name, [arg1, arg2, ...])
+    VM-only opcodes for `<prefix>; <command>; kill_branch`, the shape every
+    `execute ... run <command>` compiles to. They never appear in executables.
     """
-    instructions = []
-    stream = BytesIO(bytecode)
-    while True:
-        header = stream.read(2)
-        if len(header) < 2:
-            break
-        arg_count = header[0]
-        instr_code = header[1]
-        try:
-            instr_name = Instruction(instr_code).name
-        except ValueError:
-            instr_name = f"UNKNOWN({instr_code})"
-        args = []
-        for _ in range(arg_count):
-            len_byte = stream.read(1)
-            if not len_byte:
-                break
-            arg_len = len_byte[0]
-            arg_data = stream.read(arg_len)
-            try:
-                arg_text = arg_data.decode("utf-8")
-            except UnicodeDecodeError:
-                arg_text = arg_data.hex()
-            # If the instruction is tellraw, attempt to parse JSON text format.
+    guarded_command = max(Instruction) + 1  # if/unless score ... run <command>
+    guarded_call = auto()                   # if/unless score ... run function
+    stored_command = auto()                 # execute store ... run <command>
+    forked_command = auto()                 # execute as/at ... run <command>
+
+# Prefixes that either fall through to the command or skip to the kill_branch.
+FUSABLE_PREFIXES = {
+    Instruction.if_score: Superinstruction.guarded_command,
+    Instruction.unless_score: Superinstruction.guarded_command,
+    Instruction.execute_store: Superinstruction.stored_command,
+    Instruction.execute_as: Superinstruction.forked_command,
+    Instruction.execute_at: Superinstruction.forked_command,
+}
+
+# Commands that don't jump, so they can run inside a superinstruction.
+FUSABLE_COMMANDS = frozenset({
+    Instruction.add, Instruction.remove, Instruction.set_score, Instruction.get,
+    Instruction.operation, Instruction.reset, Instruction.list_scores,
+    Instruction.say, Instruction.tellraw, Instruction.summon, Instruction.kill,
+    Instruction.tag_add, Instruction.tag_remove, Instruction.run_func,
+})
+
+class Program(list):
+    """
+    A list of (opcode, operands) tuples with jump targets computed at load time.
+
+    skip_targets[pc] is the index of the first kill_branch at or after pc, or
+    len(program) when there is none, so Branch.skip_over() is one lookup.
+    tail_calls holds the pcs of run_func instructions in tail position, that
+    is followed only by the end of the function or by kill_branch.
+    fused is the program run by the fast loop: a copy where the prefix of
+    every `<prefix>; <command>; kill_branch` is replaced by a Superinstruction
+    running all three, or the program itself if there is nothing to fuse.
+    The instructions stay in place so every pc keeps its meaning.
+    calls counts calls until the function is hot and compiled holds its
+    Python version, see compile_function().
+    The program must not be modified after it is created.
+    """
+    __slots__ = ('skip_targets', 'tail_calls', 'fused', 'calls', 'compiled')
+
+    def __init__(self, instructions=()):
+        super().__init__(instructions)
+        self.calls = 0
+        self.compiled = None  # None: not compiled yet, False: can't be compiled
+        targets = [len(self)] * (len(self) + 1)
+        for pc in range(len(self) - 1, -1, -1):
+            targets[pc] = pc if self[pc][0] == Instruction.kill_branch else targets[pc + 1]
+        self.skip_targets = targets
+        self.tail_calls = frozenset(
+            pc for pc, (opcode, args) in enumerate(self)
+            if opcode == Instruction.run_func and targets[pc + 1] == pc + 1
+        )
+        self.fused = self._fuse()
+
+    def _fuse(self) -> list:
+        fused = self
+        for pc in range(len(self) - 2):
+            opcode, args = self[pc]
+            command, command_args = self[pc + 1]
             if (
-                    instr_name == "tellraw"
-                    and arg_text
-                    and ord(arg_text[0]) in {0, 1, 2, 3}
-                ):
-                arg_text = parse_json_text_format(arg_data)
-            args.append(arg_text)
-        instructions.append((instr_name, args))
-    return instructions
+                opcode not in FUSABLE_PREFIXES
+                or command not in FUSABLE_COMMANDS
+                or self[pc + 2][0] != Instruction.kill_branch
+            ):
+                continue
+            superinstruction = FUSABLE_PREFIXES[opcode]
+            if superinstruction == Superinstruction.guarded_command and command == Instruction.run_func:
+                superinstruction = Superinstruction.guarded_call
+            if fused is self:
+                fused = list(self)
+            fused[pc] = (superinstruction, (opcode, args, command, command_args))
+        return fused
+
+EMPTY_PROGRAM = Program()
+
+class CodeObject(Sequence):
+    """
+    A function as stored in an executable, in compact form.
+
+    opcodes[pc] is the opcode of instruction pc, and its operands are
+    pool[operands[i]] for i in range(offsets[pc], offsets[pc + 1]). The pool
+    is shared by all functions of an executable and holds every distinct
+    operand once, so an instruction takes a few bytes of arrays instead of a
+    tuple, a list and a string per operand.
+
+    Indexing materializes (opcode, [operands]) tuples, for the GUI and the
+    disassembler. The VM runs the Program that load() binds on first use;
+    the arrays are released then, so only functions that are never called
+    stay compact, and indexing returns the bound instructions of the Program.
+    A code object created from an instruction block decodes it on first use,
+    see decode(). pool_index maps the bytes of the operands in the pool to
+    their index until then, and version is the format of the block.
+    """
+    __slots__ = ('opcodes', 'offsets', 'operands', 'pool', 'pool_index', 'block', 'version', 'program')
+
+    def __init__(self, pool: list, pool_index: dict = None, block: bytes = None, version: int = FORMAT_VERSION):
+        self.opcodes = array('B')
+        self.offsets = array('I', [0])
+        self.operands = array('I')
+        self.pool = pool
+        self.pool_index = pool_index
+        self.block = block
+        self.version = version
+        self.program = None
+
+    def __len__(self):
+        if self.program is not None:
+            return len(self.program)
+        if self.block is not None:
+            self.decode()
+        return len(self.opcodes)
+
+    def __getitem__(self, pc: int) -> tuple:
+        if self.program is not None:
+            opcode, args = self.program[pc]
+            return opcode, list(args)
+        if self.block is not None:
+            self.decode()
+        if pc < 0:
+            pc += len(self.opcodes)
+        pool = self.pool
+        return (
+            Instruction(self.opcodes[pc]),
+            [pool[i] for i in self.operands[self.offsets[pc]:self.offsets[pc + 1]]],
+        )
+
+    def __iter__(self):
+        for pc in range(len(self)):
+            yield self[pc]
+
+    def line(self, pc: int) -> str:
+        """Instruction pc as disassembly text."""
+        opcode, args = self[pc]
+        return ' '.join([opcode.name, *map(str, args)])
+
+    @property
+    def lines(self) -> 'CodeListing':
+        """The disassembly text of every instruction, formatted when accessed."""
+        return CodeListing(self)
+
+    def load(self) -> Program:
+        """The bound Program of the function, created on the first call."""
+        if self.program is None:
+            self.program = Program((opcode, bind_operands(opcode, args)) for opcode, args in self)
+            # The VM only reads the Program from now on
+            self.opcodes = self.offsets = self.operands = None
+        return self.program
+
+    def decode(self) -> 'CodeObject':
+        """
+        Decodes the instruction block of the code object, if it has one left.
+        Binary format for each instruction:
+          <argCount><instruction:1byte>
+          Then for each argument:
+             <argLen><argBytes>
+        The counts and lengths are varints since version 5 and single bytes in
+        version 4. Operands are strings, or decoded JSON text for tellraw.
+        Each distinct operand is decoded once and added to the pool shared by
+        the functions of the executable. Since version 6 the executable
+        decodes the pool up front and each argument is a varint index into it.
+        Raises:
+          ValueError: If the block contains an unknown opcode or is truncated.
+        """
+        if self.block is None:
+            return self
+        read = LENGTH_READERS[self.version]
+        pooled = self.version >= CONSTANT_POOL_VERSION
+        pool = self.pool
+        pool_index = self.pool_index
+        opcodes = self.opcodes
+        operands = self.operands
+        offsets = self.offsets
+        block = self.block
+        # A failed decode is not retried
+        self.block = None
+        self.pool_index = None
+
+        offset = 0
+        try:
+            while offset < len(block):
+                arg_count, offset = read(block, offset, 1)
+                instr_code = block[offset]
+                offset += 1
+                try:
+                    opcode = Instruction(instr_code)
+                except ValueError:
+                    raise ValueError(f"Unknown opcode: {instr_code}") from None
+
+                if HANDLERS[opcode] is _not_implemented and opcode not in _warned_opcodes:
+                    log.warning(f'Instruction {opcode.name} is not implemented and will be ignored')
+                    _warned_opcodes.add(opcode)
+
+                if pooled:
+                    for _ in range(arg_count):
+                        index, offset = read_varint(block, offset)
+                        if index >= len(pool):
+                            raise ValueError(f"Constant index out of range: {index}")
+                        operands.append(index)
+                    opcodes.append(opcode)
+                    offsets.append(len(operands))
+                    continue
+
+                for _ in range(arg_count):
+                    arg_len, offset = read(block, offset, 1)
+                    arg_data = bytes(block[offset:offset + arg_len])
+                    if len(arg_data) != arg_len:
+                        raise IndexError("Truncated argument")
+                    offset += arg_len
+                    # If the instruction is tellraw, attempt to parse JSON text format.
+                    is_json = opcode == Instruction.tellraw and arg_data[:1] in (b'\0', b'\1', b'\2', b'\3')
+                    key = (Constant.json_text if is_json else Constant.string, arg_data)
+                    index = pool_index.get(key)
+                    if index is None:
+                        index = pool_index[key] = len(pool)
+                        pool.append(decode_constant(*key))
+                    operands.append(index)
+                opcodes.append(opcode)
+                offsets.append(len(operands))
+        except IndexError:
+            raise ValueError("Incomplete instruction at the end of the block") from None
+        return self
+
+    def __repr__(self):
+        state = 'not decoded' if self.block is not None else f'{len(self)} instructions'
+        return f"<CodeObject {state}>"
+
+class CodeListing(Sequence):
+    """A read-only view of the lines of a CodeObject, see CodeObject.line()."""
+    __slots__ = ('code',)
+
+    def __init__(self, code: CodeObject):
+        self.code = code
+
+    def __len__(self):
+        return len(self.code)
+
+    def __getitem__(self, pc: int) -> str:
+        return self.code.line(pc)
+
+def _read_fixed(data: bytes, offset: int, width: int) -> tuple[int, int]:
+    end = offset + width
+    if end > len(data):
+        raise IndexError("Truncated length")
+    return int.from_bytes(data[offset:end], 'big'), end
+
+def _read_varint(data: bytes, offset: int, width: int) -> tuple[int, int]:
+    return read_varint(data, offset)
+
+# Length readers of the supported format versions: read(data, offset, width)
+# returns a length and the offset after it. Version 4 stores lengths in
+# width big-endian bytes, later versions as varints.
+LENGTH_READERS = {4: _read_fixed, 5: _read_varint, 6: _read_varint, 7: _read_varint}
+
+def _read_text(data: bytes, offset: int, length: int) -> tuple[str, int]:
+    end = offset + length
+    if end > len(data):
+        raise IndexError("Truncated text")
+    return bytes(data[offset:end]).decode('utf-8'), end
+
+# Version of the instruction blocks compiler.compile_instr() writes, with
+# inline operands. create_executable() pools them.
+INLINE_OPERANDS_VERSION = CONSTANT_POOL_VERSION - 1
+
+def decode_constant(tag: Constant, data: bytes):
+    """
+    Decodes a constant: strings are interned, so that every operand equal to
+    it, and the scoreboard keys made from them, share one hashed object.
+    Numbers come out typed: int32 as int, coordinates as Coordinate and
+    ranges as Range, so binding them doesn't parse any text.
+
+    Raises:
+        ValueError: If the tag is unknown or the constant invalid.
+    """
+    if tag == Constant.string:
+        try:
+            return sys.intern(data.decode("utf-8"))
+        except UnicodeDecodeError:
+            return data.hex()
+    if tag == Constant.json_text:
+        return parse_json_text_format(data)
+    if tag == Constant.int32:
+        return decode_number_constant(tag, data)
+    if tag == Constant.coordinate:
+        offset, flags = decode_number_constant(tag, data)
+        return Coordinate(offset, bool(flags & (COORDINATE_RELATIVE | COORDINATE_CARET)), bool(flags & COORDINATE_CARET))
+    if tag == Constant.range:
+        return Range.from_bounds(*decode_number_constant(tag, data))
+    raise ValueError(f"Unknown constant tag: {tag}")
+
+def _read_constants(data: bytes, offset: int, version: int) -> tuple[list, int]:
+    """Reads and decodes the constant pool of an executable. Returns it and the offset after it."""
+    count, offset = read_varint(data, offset)
+    constants = []
+    for _ in range(count):
+        tag = data[offset]
+        if tag > Constant.json_text and version < TYPED_CONSTANTS_VERSION:
+            raise ValueError(f"Constant tag {tag} needs format v{TYPED_CONSTANTS_VERSION}")
+        length, offset = read_varint(data, offset + 1)
+        end = offset + length
+        if end > len(data):
+            raise IndexError("Truncated constant")
+        constants.append(decode_constant(tag, bytes(data[offset:end])))
+        offset = end
+    return constants, offset
+
+def parse_instructions(bytecode: bytes, version: int = INLINE_OPERANDS_VERSION) -> Program:
+    """
+    Parses a binary instruction block with inline operands into a Program, see CodeObject.decode().
+
+    Raises:
+      ValueError: If the block contains an unknown opcode or an invalid operand.
+    """
+    return decode_function(bytecode, [], {}, version).load()
+
+def decode_function(bytecode: bytes, pool: list, pool_index: dict, version: int = INLINE_OPERANDS_VERSION) -> CodeObject:
+    """
+    Decodes a binary instruction block into a CodeObject, see CodeObject.decode().
+
+    Raises:
+      ValueError: If the block contains an unknown opcode.
+    """
+    return CodeObject(pool, pool_index, bytecode, version).decode()
+
+def executable_version(bytecode: bytes) -> tuple[int, bool]:
+    """
+    Reads the header of an executable.
+
+    Returns:
+        The format version, one of SUPPORTED_VERSIONS, and whether the
+        executable uses the indexed layout.
+    Raises:
+        ValueError: If the magic number is wrong or the version unsupported.
+    """
+    header = bytecode[:4]
+    if len(header) != 4 or header != MAGIC:
+        raise ValueError("Invalid magic number in executable")
+
+    version_byte = bytecode[4:5]
+    if len(version_byte) != 1:
+        raise ValueError("Missing version byte")
+
+    version = version_byte[0] & ~INDEXED_LAYOUT
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported format version: {version}")
+    return version, bool(version_byte[0] & INDEXED_LAYOUT)
 
 def parse_executable(bytecode: bytes) -> tuple:
     """
         Parses the given bytecode and extracts the namespace and functions.
 
-        The format is as follows:
+        The format is as follows, with lengths as varints since version 5 and
+        with the given widths in version 4:
         - 4 bytes: Magic number ("MCFN")
         - 1 byte: Format version
-        - 1 byte: Length of the namespace (N)
+        - Length of the namespace (N), v4: 1 byte
         - N bytes: Namespace (UTF-8 encoded string)
-        - 1 byte: Number of functions (F)
+        - Since v6, the constant pool:
+            - Number of constants (C)
+            - For each constant: 1 byte tag (see Constant), length, bytes
+        - Number of functions (F), v4: 2 bytes
         - For each function:
-            - 1 byte: Length of the function name (L)
+            - Length of the function name (L), v4: 1 byte
             - L bytes: Function name (UTF-8 encoded string)
-            - 2 bytes: Length of the instruction block (B)
+            - Length of the instruction block (B), v4: 2 bytes
             - B bytes: Instruction block
 
+        Executables in the indexed layout, where the version has the
+        INDEXED_LAYOUT bit set, start with a function index instead, see
+        parse_indexed_executable(). Their functions are decoded on first use.
+
         Args:
-            bytecode (bytes): The bytecode to parse.
+            bytecode (bytes): The bytecode to parse, or a memory map of it.
         Returns:
             tuple: A tuple containing the namespace (str) and a dictionary of functions.
-                The dictionary keys are function names (str) and the values are lists of instructions.
+                The dictionary keys are function names (str) and the values are CodeObjects
+                sharing one operand pool.
         Raises:
             ValueError: If the bytecode is invalid or incomplete, or if the format version is unsupported.
     """
+    version, indexed = executable_version(bytecode)
+    if indexed:
+        return parse_indexed_executable(bytecode)
 
+    read = LENGTH_READERS[version]
     functions = {}
-    stream = BytesIO(bytecode)
-
-    header = stream.read(4)
-    if len(header) != 4 or header != b"MCFN":
-        raise ValueError("Invalid magic number in executable")
-
-    version_byte = stream.read(1)
-    if len(version_byte) != 1:
-        raise ValueError("Missing version byte")
-
-    version = version_byte[0]
-    if version != FORMAT_VERSION:
-        raise ValueError(f"Unsupported format version: {version}")
-
-    # Read namespace.
-    ns_len_byte = stream.read(1)
-
-    if len(ns_len_byte) != 1:
-        raise ValueError("Missing namespace length")
-
-    ns_len = ns_len_byte[0]
-    namespace_bytes = stream.read(ns_len)
-
-    if len(namespace_bytes) != ns_len:
-        raise ValueError("Incomplete namespace bytes")
-
-    namespace = namespace_bytes.decode('utf-8')
-
-    # Read function count (now 2 bytes)
-    func_count_bytes = stream.read(2)
-    if len(func_count_bytes) != 2:
-        raise ValueError("Missing function count bytes")
-    func_count = struct.unpack(">H", func_count_bytes)[0]
-
-    for _ in range(func_count):
-        name_len_byte = stream.read(1)
-
-
-        if len(name_len_byte) != 1:
-            raise ValueError("Unexpected end of file while reading function name length")
-
-
-        name_len = name_len_byte[0]
-        func_name_bytes = stream.read(name_len)
-
-
-        if len(func_name_bytes) != name_len:
-            raise ValueError("Unexpected end of file while reading function name")
+    pool = []
+    pool_index = {}
 
+    try:
+        ns_len, offset = read(bytecode, 5, 1)
+        namespace, offset = _read_text(bytecode, offset, ns_len)
+        if version >= CONSTANT_POOL_VERSION:
+            pool, offset = _read_constants(bytecode, offset, version)
+        func_count, offset = read(bytecode, offset, 2)
+
+        for _ in range(func_count):
+            name_len, offset = read(bytecode, offset, 1)
+            func_name, offset = _read_text(bytecode, offset, name_len)
+            block_len, offset = read(bytecode, offset, 2)
+            instr_block = bytecode[offset:offset + block_len]
+            if len(instr_block) != block_len:
+                raise ValueError(f"Incomplete instruction block for {func_name}")
+            offset += block_len
+
+            functions[func_name] = decode_function(instr_block, pool, pool_index, version)
+    except IndexError:
+        raise ValueError("Unexpected end of file while reading the executable") from None
 
-        func_name = func_name_bytes.decode('utf-8')
-        block_len_bytes = stream.read(2)
+    return namespace, functions
 
+def parse_indexed_executable(bytecode: bytes) -> tuple:
+    """
+    Parses the header and function index of an executable in the indexed
+    layout, without decoding any function. The format is as follows, with
+    lengths as varints since version 5 and with the given widths in version 4:
+    - 4 bytes: Magic number ("MCFN")
+    - 1 byte: Format version | INDEXED_LAYOUT
+    - Length of the namespace (N), v4: 1 byte
+    - N bytes: Namespace (UTF-8 encoded string)
+    - Since v6, the constant pool, see parse_executable()
+    - Number of functions (F), v4: 2 bytes
+    - For each function, the index entry:
+        - Length of the function name (L), v4: 1 byte
+        - L bytes: Function name (UTF-8 encoded string)
+        - Offset of the instruction block from the end of the index,
+          v4: 4 bytes from the start of the executable
+        - Length of the instruction block, v4: 4 bytes
+    - The instruction blocks
+
+    The executable isn't compressed, so it can be memory mapped, see
+    read_executable(). Only the pages of functions that are called are read.
 
-        if len(block_len_bytes) != 2:
-            raise ValueError("Unexpected end of file while reading instruction block length")
+    Returns:
+        tuple: The namespace and a dictionary of CodeObjects that decode their
+            instruction block on first use.
+    Raises:
+        ValueError: If the header or the index is incomplete.
+    """
+    version, _ = executable_version(bytecode)
+    read = LENGTH_READERS[version]
+    view = memoryview(bytecode)
+    pool = []
+    pool_index = {}
+    functions = {}
 
-        block_len = struct.unpack(">H", block_len_bytes)[0]
-        instr_block = stream.read(block_len)
+    try:
+        ns_len, offset = read(bytecode, 5, 1)
+        namespace, offset = _read_text(bytecode, offset, ns_len)
+        if version >= CONSTANT_POOL_VERSION:
+            pool, offset = _read_constants(bytecode, offset, version)
+        func_count, offset = read(bytecode, offset, 2)
+
+        index = []
+        for _ in range(func_count):
+            name_len, offset = read(bytecode, offset, 1)
+            func_name, offset = _read_text(bytecode, offset, name_len)
+            block_offset, offset = read(bytecode, offset, 4)
+            block_len, offset = read(bytecode, offset, 4)
+            index.append((func_name, block_offset, block_len))
+    except IndexError:
+        raise ValueError("Unexpected end of file while reading the function index") from None
 
-        if len(instr_block) != block_len:
+    base = offset if version >= 5 else 0
+    for func_name, block_offset, block_len in index:
+        start = base + block_offset
+        if start + block_len > len(bytecode):
             raise ValueError(f"Incomplete instruction block for {func_name}")
-
-        instructions = parse_instructions(instr_block)
-        functions[func_name] = instructions
+        functions[func_name] = CodeObject(pool, pool_index, view[start:start + block_len], version)
 
     return namespace, functions
 
@@ -270,61 +629,6 @@ def _extracted_from_parse_json_text_format_52(stream: BytesIO) -> dict:
             props[prop_name] = (value == 1)
     return {"score": {"name": name, "objective": objective}} | props
 
-def parse_range(value_str: str) -> tuple[None | int, None | int]:
-    """
-    Parses a range specification string of the format "[<start>]..[<end>]".
-    If either bound is omitted, None is returned for that bound.
-
-    Args:
-        value_str (str): The range string, e.g. "[4]..[8]" or "..[8]".
-
-    Returns:
-        tuple: A tuple (start, end) where start and end are integers or None.
-    """
-
-    if '..' not in value_str:
-        # Handle single numeric values
-        try:
-            # Try to parse as a simple integer
-            num = int(value_str.strip())
-            return num, num
-        except ValueError:
-            # If it has brackets, try to strip them first
-            try:
-                stripped = value_str.strip()
-                if stripped.startswith('[') and stripped.endswith(']'):
-                    num = int(stripped[1:-1].strip())
-                    return num, num
-            except ValueError:
-                pass
-        raise ValueError(f"Invalid range specification: {value_str}")
-
-    range_parts = value_str.split('..')
-    if len(range_parts) != 2:
-        raise ValueError(f"Invalid range specification: {value_str}")
-
-    def strip_brackets(s: str) -> str:
-        s = s.strip()
-        if s.startswith('[') and s.endswith(']'):
-            return s[1:-1].strip()
-        return s
-
-    # Parse start value
-    start_str = strip_brackets(range_parts[0])
-    try:
-        start_value = int(start_str) if start_str != '' else None
-    except ValueError:
-        raise ValueError(f"Invalid range start: {range_parts[0]}")
-        
-    # Parse end value
-    end_str = strip_brackets(range_parts[1])
-    try:
-        end_value = int(end_str) if end_str != '' else None
-    except ValueError:
-        raise ValueError(f"Invalid range end: {range_parts[1]}")
-        
-    return start_value, end_value
-
 def parse_nbt_filter(nbt_str: str) -> dict:
     """
     Very naive SNBT parser for use in target selectors.
@@ -394,83 +698,778 @@ def parse_nbt_filter(nbt_str: str) -> dict:
     return result
 
 def read_executable(filepath: str) -> bytes:
+    """
+    Read an executable. Compressed ones are decompressed, uncompressed ones
+    are memory mapped, so that only the parts that are used are read.
+    """
     with open(filepath, 'rb') as f:
-        return zlib.decompress(f.read())
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return zlib.decompress(f.read())
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 def distance_3d(a, b):
     return sum((x-y)**2 for x,y in zip(a,b))**0.5
 
-def print_formatted_text(text, color, bold, italic, underline):
+# ANSI escape codes for text formatting
+ANSI_COLORS = {
+    'black': '30', 'red': '31', 'green': '32', 'yellow': '33',
+    'blue': '34', 'magenta': '35', 'cyan': '36', 'white': '37'
+}
+ANSI_RESET = '\033[0m'
+
+def ansi_style(component: dict) -> str:
+    """Returns the ANSI escape codes for the color and style of a text component."""
+    bold_code = '\033[1m' if component.get('bold', False) else ''
+    italic_code = '\033[3m' if component.get('italic', False) else ''
+    underline_code = '\033[4m' if component.get('underlined', False) else ''
+    color_code = f'\033[{ANSI_COLORS.get(component.get("color", "white"), "37")}m'
+    return f"{color_code}{bold_code}{italic_code}{underline_code}"
+
+class TextTemplate:
     """
-    Prints the given text with the specified formatting.
+    A tellraw text component, or a list of them, decoded once for rendering.
+
+    Static text is pre-rendered with its ANSI codes and adjacent pieces are
+    joined. Score components become slots that render() fills in, so the
+    decoded component is never modified.
+
+    Raises:
+        ValueError: If a component has neither a "text" nor a "score".
     """
-    # ANSI escape codes for text formatting
-    color_codes = {
-        'black': '30', 'red': '31', 'green': '32', 'yellow': '33',
-        'blue': '34', 'magenta': '35', 'cyan': '36', 'white': '37'
-    }
-    reset_code = '\033[0m'
-    bold_code = '\033[1m' if bold else ''
-    italic_code = '\033[3m' if italic else ''
-    underline_code = '\033[4m' if underline else ''
-    color_code = f'\033[{color_codes.get(color, "37")}m'
-
-    formatted_text = f"{color_code}{bold_code}{italic_code}{underline_code}{text}{reset_code}"
-    print(formatted_text,end='')
-
-def print_json_text(text:dict | list[dict], recursed=False):
-    if isinstance(text, list):
-        for item in text:
-            print_json_text(item, recursed=True)
-        print()
-        return
+    __slots__ = ('source', 'parts', 'slots')
+
+    def __init__(self, text: dict | list[dict]):
+        self.source = text
+        self.parts = []  # Rendered strings, with None for every slot
+        slots = []       # (index in parts, objective, holder)
+        pending = []
+        self._compile(text, pending, slots)
+        if pending or not self.parts:
+            self.parts.append(''.join(pending))
+        self.slots = tuple(slots)
+
+    def _compile(self, text, pending: list, slots: list):
+        if isinstance(text, list):
+            for item in text:
+                self._compile(item, pending, slots)
+            return
+
+        if not isinstance(text, dict):
+            pending.append(str(text))
+            return
+
+        if 'text' in text:
+            pending.append(f"{ansi_style(text)}{text['text']}{ANSI_RESET}")
+            return
+
+        if 'score' not in text:
+            raise ValueError(f'Invalid JSON text format: {text}')
+
+        score = text['score']
+        pending.append(ansi_style(text))
+        self.parts.append(''.join(pending))
+        pending.clear()
+        slots.append((len(self.parts), score['objective'], score['name']))
+        self.parts.append(None)
+        pending.append(ANSI_RESET)
+
+    def render(self) -> str:
+        if not self.slots:
+            return self.parts[0]
+        parts = self.parts.copy()
+        score = scoreboards.score
+        for index, objective, holder in self.slots:
+            parts[index] = str(score(objective, holder))
+        return ''.join(parts)
+
+    def __repr__(self):
+        return repr(self.source)
+
+
+# Output
+
+class OutputSink:
+    """Where say and tellraw write their lines. See the `output` variable."""
+    def write_line(self, line: str):
+        raise NotImplementedError
+
+    def flush(self):
+        """Write out anything buffered. Called when a run ends."""
+
+class StdoutSink(OutputSink):
+    """Writes every line to sys.stdout as soon as it is output."""
+    def write_line(self, line: str):
+        sys.stdout.write(line + '\n')
+
+class BufferedStdoutSink(OutputSink):
+    """Collects lines and writes them to sys.stdout in blocks of about buffer_size characters."""
+    def __init__(self, buffer_size: int = 1 << 16):
+        self.buffer_size = buffer_size
+        self._lines = []
+        self._size = 0
+
+    def write_line(self, line: str):
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            sys.stdout.write('\n'.join(self._lines))
+            sys.stdout.flush()
+            self._lines = []
+            self._size = 0
+
+class CaptureSink(OutputSink):
+    """Keeps the lines in a list, for embedding the VM and for tests."""
+    def __init__(self):
+        self.lines = []
+
+    def write_line(self, line: str):
+        self.lines.append(line)
+
+class NullSink(OutputSink):
+    """Discards all output, to measure the VM on its own."""
+    def write_line(self, line: str):
+        pass
+
+# Sinks selectable by name, see mcfn.py run --output
+OUTPUT_SINKS = {
+    'stdout': StdoutSink,
+    'buffered': BufferedStdoutSink,
+    'null': NullSink,
+}
+
+
+# Entities
+
+# Edge length of the cubes entities are bucketed into by position.
+ENTITY_CELL_SIZE = 16
+
+def _entity_position(entity: dict) -> tuple:
+    return entity.get('position', (0, 0, 0))
+
+def _shell(center: tuple, radius: int):
+    """Yield the grid cells at exactly `radius` cells (Chebyshev) from center."""
+    cx, cy, cz = center
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            if abs(dx) == radius or abs(dy) == radius:
+                dzs = range(-radius, radius + 1)
+            else:
+                dzs = (-radius, radius)
+            for dz in dzs:
+                yield (cx + dx, cy + dy, cz + dz)
 
-    if not isinstance(text, dict):
-        print(text)
-        return
+class EntityStore:
+    """
+    All entities in the world, bucketed into a uniform grid by position.
+
+    Entities are dicts with at least an 'id' and a 'position'. Iteration
+    yields them in the order they were added. Selectors with distance or
+    volume arguments only look at the grid cells in range, and
+    sort=nearest with a limit is answered by a k-nearest search that grows
+    outwards from the origin.
 
-    if 'text' not in text:
-        _validate_and_update_score(text)
-    color     = text.get('color', 'white')
-    bold      = text.get('bold', False)
-    italic    = text.get('italic', False)
-    underline = text.get('underlined', False)
+    The store also keeps hash indexes from type, tag and CustomName to the
+    entities that have them, so type=, tag= and name= filters start from the
+    matching index sets instead of scanning every entity.
 
-    print_formatted_text(text['text'], color, bold, italic, underline)
+    Positions must be changed through move() and tags through add_tag() and
+    remove_tag() to keep the indexes up to date.
+    """
+    def __init__(self, initial=()):
+        self._entities = {}  # id(entity) -> entity, in insertion order
+        self._order = {}     # id(entity) -> insertion sequence number
+        self._cell_of = {}   # id(entity) -> grid cell
+        self._cells = {}     # grid cell -> {id(entity): entity}
+        self._by_type = {}   # type -> {id(entity): entity}
+        self._by_tag = {}    # tag -> {id(entity): entity}
+        self._by_name = {}   # CustomName -> {id(entity): entity}
+        self._sequence = 0
+        self.extend(initial)
+
+    @staticmethod
+    def _cell(position: tuple) -> tuple:
+        return tuple(int(c // ENTITY_CELL_SIZE) for c in position)
+
+    @staticmethod
+    def _index(index: dict, value, entity: dict):
+        index.setdefault(value, {})[id(entity)] = entity
+
+    @staticmethod
+    def _unindex(index: dict, value, entity: dict):
+        bucket = index.get(value)
+        if bucket is None:
+            return
+        bucket.pop(id(entity), None)
+        if not bucket:
+            del index[value]
+
+    def add(self, entity: dict):
+        """Add an entity to the world."""
+        key = id(entity)
+        if key in self._entities:
+            return
+        cell = self._cell(_entity_position(entity))
+        self._entities[key] = entity
+        self._order[key] = self._sequence
+        self._sequence += 1
+        self._cell_of[key] = cell
+        self._cells.setdefault(cell, {})[key] = entity
+
+        self._index(self._by_type, entity.get('type'), entity)
+        for tag in entity.get('tags', ()):
+            self._index(self._by_tag, tag, entity)
+        if 'CustomName' in entity:
+            self._index(self._by_name, entity['CustomName'], entity)
+
+    def extend(self, entities):
+        for entity in entities:
+            self.add(entity)
+
+    def remove(self, entity: dict):
+        """Remove an entity from the world. Raises ValueError if it is not in it."""
+        key = id(entity)
+        if key not in self._entities:
+            raise ValueError(f'Entity is not in the world: {entity}')
+        del self._entities[key]
+        del self._order[key]
+        cell = self._cell_of.pop(key)
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+
+        self._unindex(self._by_type, entity.get('type'), entity)
+        for tag in entity.get('tags', ()):
+            self._unindex(self._by_tag, tag, entity)
+        if 'CustomName' in entity:
+            self._unindex(self._by_name, entity['CustomName'], entity)
+
+    def add_tag(self, entity: dict, tag: str) -> bool:
+        """Add a tag to an entity. Returns False if it already had it."""
+        tags = entity.setdefault('tags', [])
+        if tag in tags:
+            return False
+        tags.append(tag)
+        if id(entity) in self._entities:
+            self._index(self._by_tag, tag, entity)
+        return True
+
+    def remove_tag(self, entity: dict, tag: str) -> bool:
+        """Remove a tag from an entity. Returns False if it didn't have it."""
+        tags = entity.get('tags', [])
+        if tag not in tags:
+            return False
+        tags.remove(tag)
+        if id(entity) in self._entities:
+            self._unindex(self._by_tag, tag, entity)
+        return True
+
+    def lookup(self, keys: tuple) -> list:
+        """
+        Return the entities found in every index set of keys, in insertion order.
+
+        keys is a tuple of (index, value) pairs where index is 'type', 'tag' or
+        'name'. The smallest set is scanned and checked against the others.
+        """
+        indexes = {'type': self._by_type, 'tag': self._by_tag, 'name': self._by_name}
+        sets = sorted((indexes[index].get(value, {}) for index, value in keys), key=len)
+        smallest, others = sets[0], sets[1:]
+        return self._in_order([
+            entity for key, entity in smallest.items()
+            if all(key in other for other in others)
+        ])
+
+    def move(self, entity: dict, position: tuple):
+        """Set the position of an entity, moving it to its new grid cell."""
+        key = id(entity)
+        entity['position'] = position
+        if key not in self._entities:
+            return
+        cell = self._cell(position)
+        old = self._cell_of[key]
+        if cell == old:
+            return
+        bucket = self._cells[old]
+        del bucket[key]
+        if not bucket:
+            del self._cells[old]
+        self._cell_of[key] = cell
+        self._cells.setdefault(cell, {})[key] = entity
+
+    def clear(self):
+        self._entities.clear()
+        self._order.clear()
+        self._cell_of.clear()
+        self._cells.clear()
+        self._by_type.clear()
+        self._by_tag.clear()
+        self._by_name.clear()
+
+    def _in_order(self, entities: list) -> list:
+        order = self._order
+        return sorted(entities, key=lambda e: order[id(e)])
+
+    def within(self, lower: tuple, upper: tuple) -> list:
+        """
+        Return the entities in the grid cells overlapping a box, in insertion order.
+
+        The result is a superset of the entities inside the box, callers still
+        have to check the exact bounds.
+        """
+        # inf // n is nan, so unbounded axes are kept as they are.
+        lo = tuple(c // ENTITY_CELL_SIZE if math.isfinite(c) else c for c in lower)
+        hi = tuple(c // ENTITY_CELL_SIZE if math.isfinite(c) else c for c in upper)
+
+        cell_count = math.inf
+        if all(math.isfinite(c) for c in lo + hi):
+            lo = tuple(int(c) for c in lo)
+            hi = tuple(int(c) for c in hi)
+            cell_count = math.prod(h - l + 1 for l, h in zip(lo, hi))
+
+        if cell_count <= len(self._cells):
+            buckets = [
+                self._cells.get((x, y, z))
+                for x in range(lo[0], hi[0] + 1)
+                for y in range(lo[1], hi[1] + 1)
+                for z in range(lo[2], hi[2] + 1)
+            ]
+        else:
+            # The box covers more cells than are occupied, scan the occupied ones.
+            buckets = [
+                bucket for cell, bucket in self._cells.items()
+                if all(l <= c <= h for c, l, h in zip(cell, lo, hi))
+            ]
+
+        return self._in_order([e for bucket in buckets if bucket for e in bucket.values()])
+
+    def nearest(self, origin: tuple, k: int, refine) -> list:
+        """
+        Return up to k entities nearest to origin, nearest first.
+
+        Candidates are passed through refine (a function taking and returning
+        a list of entities) one shell of grid cells at a time. The search stops
+        once k candidates were accepted and no unvisited cell can hold a nearer one.
+        Ties are broken by insertion order.
+        """
+        if k <= 0:
+            return []
+
+        order = self._order
+        def key(e):
+            return (math.dist(_entity_position(e), origin), order[id(e)])
+
+        center = self._cell(origin)
+        found = []
+        seen = 0
+        radius = 0
+        while seen < len(self._entities):
+            shell_size = (2 * radius + 1) ** 3 - (2 * radius - 1) ** 3 if radius else 1
+            if shell_size > len(self._cells):
+                # Sparse world, cheaper to take every cell not visited yet.
+                batch = [
+                    e for cell, bucket in self._cells.items()
+                    if max(abs(c - o) for c, o in zip(cell, center)) >= radius
+                    for e in bucket.values()
+                ]
+                found.extend(refine(batch))
+                break
+
+            batch = []
+            for cell in _shell(center, radius):
+                bucket = self._cells.get(cell)
+                if bucket:
+                    batch.extend(bucket.values())
+            seen += len(batch)
+            found.extend(refine(batch))
+
+            # Entities in the next shell are at least radius cells away.
+            if len(found) >= k:
+                kth_distance = heapq.nsmallest(k, map(key, found))[-1][0]
+                if kth_distance <= radius * ENTITY_CELL_SIZE:
+                    break
+            radius += 1
+
+        return heapq.nsmallest(k, found, key=key)
+
+    def __iter__(self):
+        return iter(list(self._entities.values()))
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __bool__(self):
+        return bool(self._entities)
+
+    def __contains__(self, entity):
+        return id(entity) in self._entities
+
+    def __repr__(self):
+        return f'EntityStore({list(self._entities.values())})'
+
+
+# Scoreboards
+
+def _wrap_int32(value: int) -> int:
+    """Wrap a value to a signed 32-bit integer, like scores overflow in vanilla."""
+    return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+class Objective(MutableMapping):
+    """Dict-like view of the scores of one objective, holder name -> score."""
+    __slots__ = ('_board', '_id')
+
+    def __init__(self, board: 'Scoreboards', objective_id: int):
+        self._board = board
+        self._id = objective_id
+
+    def __getitem__(self, holder):
+        board = self._board
+        holder_id = board._holders.get(holder)
+        if holder_id is None or not board._has(self._id, holder_id):
+            raise KeyError(holder)
+        return board._columns[self._id][holder_id]
+
+    def __setitem__(self, holder, value):
+        self._board._write(self._id, self._board._intern(holder), value)
+
+    def __delitem__(self, holder):
+        board = self._board
+        holder_id = board._holders.get(holder)
+        if holder_id is None or not board._clear(self._id, holder_id):
+            raise KeyError(holder)
+
+    def __contains__(self, holder):
+        holder_id = self._board._holders.get(holder)
+        return holder_id is not None and self._board._has(self._id, holder_id)
+
+    def __iter__(self):
+        board = self._board
+        names = board._holder_names
+        present = board._present[self._id]
+        return iter([
+            names[holder_id] for holder_id in range(len(present) * 8)
+            if present[holder_id >> 3] >> (holder_id & 7) & 1
+        ])
+
+    def __len__(self):
+        return self._board._counts[self._id]
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class Scoreboards(MutableMapping):
+    """
+    All scoreboard objectives, stored column by column.
 
-    if not recursed:
-        print()
+    Objective and holder names are interned to integer ids. Each objective is
+    an array('i') column indexed by holder id with a presence bitmap next to
+    it, so a score takes 4 bytes and a bit, and reading a score that was
+    never set doesn't create it. Writes wrap around at 32 bits like in vanilla.
 
-def _validate_and_update_score(text):
-    if 'score' not in text:
-        raise ValueError(f'Invalid JSON text format: {text}')
+    Indexing by objective name gives an Objective view that behaves like the
+    old dict of dicts, for tellraw, the GUI and tests.
+    """
+    def __init__(self, initial=None):
+        self.clear()
+        if initial:
+            self.update(initial)
+
+    def clear(self):
+        self._objectives = {}   # objective name -> objective id
+        self._holders = {}      # holder name -> holder id
+        self._holder_names = [] # holder id -> holder name
+        self._columns = []      # objective id -> array('i') of scores
+        self._present = []      # objective id -> bytearray presence bitmap
+        self._counts = []       # objective id -> number of scores set
+        self._views = []        # objective id -> Objective
+
+    def _intern(self, holder) -> int:
+        holder_id = self._holders.get(holder)
+        if holder_id is None:
+            holder_id = self._holders[holder] = len(self._holder_names)
+            self._holder_names.append(holder)
+        return holder_id
+
+    def add_objective(self, objective: str) -> int:
+        """Create an objective if it doesn't exist and return its id."""
+        objective_id = self._objectives.get(objective)
+        if objective_id is None:
+            objective_id = self._objectives[objective] = len(self._columns)
+            self._columns.append(array('i'))
+            self._present.append(bytearray())
+            self._counts.append(0)
+            self._views.append(Objective(self, objective_id))
+        return objective_id
+
+    def _has(self, objective_id: int, holder_id: int) -> bool:
+        present = self._present[objective_id]
+        return holder_id >> 3 < len(present) and bool(present[holder_id >> 3] >> (holder_id & 7) & 1)
+
+    def _write(self, objective_id: int, holder_id: int, value: int) -> int:
+        column = self._columns[objective_id]
+        if holder_id >= len(column):
+            # Grow geometrically so that adding holders one by one stays linear.
+            size = max(holder_id + 1, 2 * len(column))
+            column.frombytes(bytes(column.itemsize * (size - len(column))))
+            present = self._present[objective_id]
+            present.extend(bytes((size + 7) // 8 - len(present)))
+
+        present = self._present[objective_id]
+        if not present[holder_id >> 3] >> (holder_id & 7) & 1:
+            present[holder_id >> 3] |= 1 << (holder_id & 7)
+            self._counts[objective_id] += 1
+
+        value = _wrap_int32(value)
+        column[holder_id] = value
+        return value
+
+    def _clear(self, objective_id: int, holder_id: int) -> bool:
+        if not self._has(objective_id, holder_id):
+            return False
+        self._present[objective_id][holder_id >> 3] &= ~(1 << (holder_id & 7)) & 0xFF
+        self._columns[objective_id][holder_id] = 0
+        self._counts[objective_id] -= 1
+        return True
+
+    def score(self, objective: str, holder, default: int = 0) -> int:
+        """Read a score without creating it. Returns default if it isn't set."""
+        objective_id = self._objectives.get(objective)
+        holder_id = self._holders.get(holder)
+        if objective_id is None or holder_id is None or not self._has(objective_id, holder_id):
+            return default
+        return self._columns[objective_id][holder_id]
+
+    def has_score(self, objective: str, holder) -> bool:
+        objective_id = self._objectives.get(objective)
+        holder_id = self._holders.get(holder)
+        return objective_id is not None and holder_id is not None and self._has(objective_id, holder_id)
+
+    def set_score(self, objective: str, holder, value: int) -> int:
+        """Set a score, creating the objective if needed. Returns the stored value."""
+        return self._write(self.add_objective(objective), self._intern(holder), value)
+
+    def add_score(self, objective: str, holder, amount: int) -> int:
+        """Add to a score (unset scores count as 0). Returns the stored value."""
+        return self.set_score(objective, holder, self.score(objective, holder) + amount)
+
+    def reset_score(self, holder, objective: str = None) -> int:
+        """Remove the scores of a holder in one objective or in all of them. Returns how many were removed."""
+        holder_id = self._holders.get(holder)
+        if holder_id is None:
+            return 0
+        if objective is not None:
+            objective_id = self._objectives.get(objective)
+            return 0 if objective_id is None else int(self._clear(objective_id, holder_id))
+        return sum(self._clear(objective_id, holder_id) for objective_id in self._objectives.values())
+
+    def __getitem__(self, objective: str) -> Objective:
+        return self._views[self._objectives[objective]]
+
+    def __setitem__(self, objective: str, scores):
+        objective_id = self.add_objective(objective)
+        view = self._views[objective_id]
+        if scores is view:
+            return
+        scores = dict(scores)
+        view.clear()
+        view.update(scores)
+
+    def __delitem__(self, objective: str):
+        objective_id = self._objectives.pop(objective)
+        self._columns[objective_id] = array('i')
+        self._present[objective_id] = bytearray()
+        self._counts[objective_id] = 0
+
+    def __iter__(self):
+        return iter(list(self._objectives))
+
+    def __len__(self):
+        return len(self._objectives)
+
+    def __repr__(self):
+        return repr({objective: dict(self[objective]) for objective in self._objectives})
+
+
+# Scheduling
+
+ROUND_ROBIN = 'round_robin'
+DEPTH_FIRST = 'depth_first'
+BREADTH_FIRST = 'breadth_first'
+SCHEDULING_POLICIES = (ROUND_ROBIN, DEPTH_FIRST, BREADTH_FIRST)
+
+class Scheduler:
+    """
+    Run queue of the live branches.
 
-    # Score component
-    score = text['score']
-    name = score['name']
-    objective = score['objective']
+    The policy decides what a pass runs:
 
-    if objective not in scoreboards:
-        scoreboards[objective] = {name: 0}
+    - round_robin: every live branch in the order they were created,
+      including branches created during the pass.
+    - breadth_first: every branch that was live when the pass started;
+      branches created during the pass wait for the next one, behind the
+      branches that created them.
+    - depth_first: only the most recently created live branch, so callees
+      finish before their callers resume. Keeps the fewest branches alive.
 
-    if name not in scoreboards[objective]:
-        scoreboards[objective][name] = 0
+    Adding, killing and membership tests are O(1): a killed branch keeps
+    its queue entry until a pass reaches it and drops it.
+    """
+    def __init__(self, initial=(), policy:str=ROUND_ROBIN):
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.policy = policy
+        self.peak = 0          # Most branches live at once
+        self._queue = deque()  # (ticket, branch), in run order
+        self._tickets = {}     # live branch -> ticket of its queue entry
+        self._next_ticket = 0
+        for branch in initial:
+            self.add(branch)
+
+    def add(self, branch: 'Branch'):
+        """Queue a branch at the end of the run order. Does nothing if it is already live."""
+        if branch in self._tickets:
+            return
+        self._tickets[branch] = self._next_ticket
+        self._queue.append((self._next_ticket, branch))
+        self._next_ticket += 1
+        if len(self._tickets) > self.peak:
+            self.peak = len(self._tickets)
+
+    def kill(self, branch: 'Branch') -> bool:
+        """Remove a branch from the live set. Returns False if it wasn't live."""
+        return self._tickets.pop(branch, None) is not None
+
+    def clear(self):
+        self._queue = deque()
+        self._tickets.clear()
+
+    def run_pass(self):
+        """
+        Yield the branches to run this pass, as chosen by the policy.
+
+        If the pass is closed early, the branches it didn't reach keep their
+        place at the front of the run order.
+        """
+        if self.policy == DEPTH_FIRST:
+            return self._depth_first_pass()
+        return self._fifo_pass(self.policy == BREADTH_FIRST)
+
+    def _fifo_pass(self, breadth_first:bool):
+        queue = self._queue
+        kept = deque()
+        # Breadth-first stops at the entries queued before the pass
+        remaining = len(queue) if breadth_first else -1
+        try:
+            while queue and remaining:
+                remaining -= 1
+                entry = queue.popleft()
+                ticket, branch = entry
+                if self._tickets.get(branch) != ticket:
+                    continue  # Killed
+                kept.append(entry)
+                yield branch
+        finally:
+            if self._queue is queue:
+                if breadth_first:
+                    # Entries the pass didn't reach, then the branches that ran,
+                    # then the ones they created: parents stay ahead of children.
+                    unreached = [queue.popleft() for _ in range(max(remaining, 0))]
+                    queue.extendleft(reversed(kept))
+                    queue.extendleft(reversed(unreached))
+                else:
+                    queue.extend(kept)
+
+    def _depth_first_pass(self):
+        # The queue is a stack here: the branch stays below the branches it
+        # creates, which are then flipped so the first one created runs first.
+        queue = self._queue
+        while queue:
+            entry = queue.pop()
+            ticket, branch = entry
+            if self._tickets.get(branch) != ticket:
+                continue  # Killed
+            queue.append(entry)
+            mark = len(queue)
+            try:
+                yield branch
+            finally:
+                if self._queue is queue and len(queue) > mark + 1:
+                    created = [queue.pop() for _ in range(len(queue) - mark)]
+                    queue.extend(created)
+            return
+
+    def __contains__(self, branch):
+        return branch in self._tickets
+
+    def __iter__(self):
+        tickets = self._tickets
+        return iter([branch for ticket, branch in self._queue if tickets.get(branch) == ticket])
 
-    text['text'] = scoreboards[objective][name]
+    def __len__(self):
+        return len(self._tickets)
+
+    def __bool__(self):
+        return bool(self._tickets)
 
 
 # Vars
 
 debugHook = None
+trace = False  # Log every executed instruction (uses the instrumented loop)
+
+quantum = None  # Instructions a branch may run before the next one gets a turn (None: until it yields)
+instructions_executed = 0  # Total instructions run by this VM
+tail_calls_eliminated = 0  # Calls that reused the caller's frame instead of pushing one
+scheduling_policy = ROUND_ROBIN  # Policy of the scheduler run() creates, see Scheduler
+
+# Report of the last run: policy, instructions, tail_calls, peak_branches,
+# peak_memory (bytes, None if unknown)
+run_stats = {}
+run_start = (0, 0)  # instructions_executed and tail_calls_eliminated when the last run started
 
-branches = []
+# With a wall-clock budget and no quantum, branches yield this often to check the clock.
+DEADLINE_CHECK_INTERVAL = 1000
+
+branches = Scheduler()
 branchId = 0
 
+# Number of killed branches BranchPool keeps for reuse, at least.
+BRANCH_POOL_MIN_SIZE = 64
+
+output: OutputSink = StdoutSink()  # Where say and tellraw write
+
+@atexit.register
+def _flush_output():
+    """Write out what the active sink still buffers when the process exits."""
+    output.flush()
+
 blocks = {}
-entities = []
-scoreboards = {}
+entities = EntityStore()
+scoreboards = Scoreboards()
+
+class Frame:
+    """A function suspended by a call, which continues when the callee returns."""
+    __slots__ = ('function', 'program', 'program_counter', 'vars', 'caller_pending_store')
+
+    def __init__(self, function, program, program_counter, vars, caller_pending_store):
+        self.function = function
+        self.program = program
+        self.program_counter = program_counter
+        self.vars = vars
+        self.caller_pending_store = caller_pending_store
 
 class Branch:
+    __slots__ = (
+        'executor', 'position', 'facing', 'program', 'program_counter', 'id',
+        'pending_store', 'caller_pending_store', 'last_value', 'caller',
+        'function', 'vars', 'frames', 'children', 'pooled'
+    )
+
     def __init__(self,
             executor='SERVER',
             position=(0,0,0),
@@ -479,20 +1478,29 @@ class Branch:
             caller=None,
             function='main'
         ):
+        self.pooled = False  # Set by BranchPool for branches it may reuse
+        self._init(executor, position, facing, program_counter, caller, function)
+
+    def _init(self, executor, position, facing, program_counter, caller, function):
         global branchId
 
         self.executor = executor
         self.position = position
         self.facing = facing
-        self.program = []
+        self.program = EMPTY_PROGRAM
         self.program_counter = program_counter
         self.id = branchId
         branchId += 1
 
         # NEW: store pending execute_store info and result from the previous instruction.
         self.pending_store = None   # Will be set as (store_type, target, objective)
+        self.caller_pending_store = None  # Store moved over from the caller by run_func
         self.last_value    = 0
         self.caller:Branch = caller # Branch which cloned this branch
+        self.frames = []            # Call stack of suspended functions, innermost last
+        self.children = 0           # Branches referencing this one as their caller
+        if caller is not None:
+            caller.children += 1
 
         # Function name
         self.function = function
@@ -500,18 +1508,17 @@ class Branch:
         # List of variable values. Use varname_to_int() to get the index based on the variable letter(s)
         self.vars = []
 
-        if self.id == 10000:
-            log.warning("There are 10 000 branches, you probably should fix that..")
-        branches.append(self)
+        branches.add(self)
 
     def execute_one(self):
         if self.program_counter >= len(self.program):
-            self.kill()
+            self.finish()
             return True
 
         inst, args = self.program[self.program_counter]
 
-        log.debug(f'{"  "*self.id}{inst} {str(args).strip("[]")}')
+        if trace:
+            log.debug(f'{"  "*self.id}{inst.name} {str(args).strip("[]")}')
 
         self.program_counter += 1
 
@@ -524,13 +1531,8 @@ class Branch:
         return result
 
     def skip_over(self):
-        """Skip over the next kill_branch instruction."""
-        while self.program_counter < len(self.program):
-            inst, args = self.program[self.program_counter]
-            if inst == 'kill_branch':
-                break
-
-            self.program_counter += 1
+        """Skip to the next kill_branch instruction."""
+        self.program_counter = self.program.skip_targets[self.program_counter]
 
     def new(
             self,
@@ -545,7 +1547,7 @@ class Branch:
         if caller is None:
             caller = self
 
-        return Branch(executor, position, facing, program_counter, caller, function)
+        return branch_pool.acquire(executor, position, facing, program_counter, caller, function)
 
     def clone(self, executor=None, position=None, facing=None, program_counter=None, function=None):
         """Clone this branch and return it with the selected attributes modified."""
@@ -564,207 +1566,438 @@ class Branch:
         if function is None:
             function = self.function
 
-        return self.new(executor, position, facing, program_counter, function)
+        branch = self.new(executor, position, facing, program_counter, function)
+        branch.program = self.program
+        branch.vars = self.vars
+        return branch
 
-    def kill(self):
-        # Process any pending store before killing the branch.
+    def call(self, function:str, args:list):
+        """Enter a function, suspending the current one in a frame until it returns."""
+        self.frames.append(Frame(
+            self.function, self.program, self.program_counter, self.vars, self.caller_pending_store
+        ))
+        self.function = function
+        self.program = function_program(function)
+        self.program_counter = 0
+        self.vars = args
+        # The caller's pending store waits for the return value
+        self.caller_pending_store = self.pending_store
+        self.pending_store = None
+
+    def tail_call(self, function:str, args:list):
+        """Replace the current function with a call to another one, reusing its frame."""
+        self.function = function
+        self.program = function_program(function)
+        self.program_counter = 0
+        self.vars = args
+
+    def return_to_caller(self):
+        """Leave the current function and continue the one that called it."""
+        frame = self.frames.pop()
+        self.function = frame.function
+        self.program = frame.program
+        self.program_counter = frame.program_counter
+        self.vars = frame.vars
+        self.caller_pending_store = frame.caller_pending_store
+        self.pending_store = None
+
+    def finish(self):
+        """End the current function: return to the caller, or kill the branch if there is none."""
+        if not self.frames:
+            self.kill()
+            return
+        self._store_pending()
+        self.return_to_caller()
+
+    def _store_pending(self):
         if self.pending_store is not None:
             store_type, target, objective = self.pending_store
             value = int(self.last_value) if store_type == "result" else (1 if self.last_value else 0)
-            if objective not in scoreboards:
-                scoreboards[objective] = {}
-            scoreboards[objective][target] = value
+            scoreboards.set_score(objective, target, value)
             self.pending_store = None
 
-        if self in branches:
-            branches.remove(self)
+    def kill(self):
+        # Process any pending store before killing the branch.
+        self._store_pending()
+
+        alive = branches.kill(self)
         self.executor = None
+        if alive and self.children == 0:
+            branch_pool.release(self)
 
     def __str__(self):
         return f"Branch(\n  executor={self.executor},\n  position={self.position},\n  facing={self.facing},\n  program_counter={self.program_counter}\n)"
 
-root = Branch()
+class BranchPool:
+    """
+    Free list of killed branches that Branch.new() reuses.
+
+    A branch goes back to the pool once it is dead and no branch created by
+    it is still around, so a caller is never reused while a callee can still
+    return to it. The free list may grow up to the peak number of live
+    branches seen, and trim() shrinks it back to BRANCH_POOL_MIN_SIZE.
+    """
+    def __init__(self):
+        self.free = []
+        self.limit = BRANCH_POOL_MIN_SIZE
+        self.allocated = 0  # Branches created because the free list was empty
+        self.reused = 0     # Branches taken from the free list
+        self.released = 0   # Branches put on the free list
+        self.discarded = 0  # Branches left to the GC because the free list was full
+
+    def acquire(self, executor, position, facing, program_counter, caller, function) -> Branch:
+        if self.free:
+            self.reused += 1
+            branch = self.free.pop()
+            branch._init(executor, position, facing, program_counter, caller, function)
+        else:
+            self.allocated += 1
+            branch = Branch(executor, position, facing, program_counter, caller, function)
+            branch.pooled = True
+        # Size the free list after the peak number of live branches.
+        if len(branches) > self.limit:
+            self.limit = len(branches)
+        return branch
+
+    def release(self, branch: Branch):
+        """Recycle a dead branch, then its callers that were only kept alive by it."""
+        while branch is not None and branch.pooled:
+            caller = branch.caller
+
+            # Drop references so that the pool doesn't keep programs and entities alive.
+            branch.caller = None
+            branch.program = EMPTY_PROGRAM
+            branch.vars = []
+            branch.frames.clear()
+            branch.pending_store = None
+            branch.caller_pending_store = None
+            if len(self.free) < self.limit:
+                self.free.append(branch)
+                self.released += 1
+            else:
+                self.discarded += 1
 
-def eval_target_selector(branch: Branch, selector: str) -> str:
-    """Find all entities that match a selector and return their ids"""
-    global entities
+            if caller is None:
+                break
+            caller.children -= 1
+            if caller.children or caller in branches:
+                break
+            branch = caller
 
-    # If the selector doesn't start with '@', return
-    if not selector.startswith('@'):
-        return [selector]
+    def trim(self):
+        """Shrink the free list back to its minimum size."""
+        del self.free[BRANCH_POOL_MIN_SIZE:]
+        self.limit = BRANCH_POOL_MIN_SIZE
 
-    # Only @e is permitted.
-    if selector.split('[', 1)[0] not in {'@e', '@s'}:
-        raise ValueError(f'Only @e or @s selector is permitted: {selector}')
+    def stats(self) -> dict:
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'released': self.released,
+            'discarded': self.discarded,
+            'free': len(self.free),
+            'limit': self.limit,
+        }
 
-    if selector.startswith('@s'):
-        included = [branch.executor]
-    elif selector.startswith('@e'):
-        included = entities
-    else:
-        raise ValueError(f'Invalid selector: {selector}')
+branch_pool = BranchPool()
 
-    if '[' not in selector:
-        return included
+root = Branch()
 
-    # Parse selector arguments.
-    args = {
-        k.strip(): v.strip()
-        for (k, v) in [
-            i.split('=',1)
-            for i in selector.rstrip(']').split('[', 1)[1].split(',')
+# Maximum number of compiled selectors kept by compile_selector().
+SELECTOR_CACHE_SIZE = 1024
+
+def _split_selector_arguments(args_str: str) -> list:
+    """Split "a=1,b={c=2,d=3}" on the commas that are not nested in {} or []."""
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(args_str):
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(args_str[start:i])
+            start = i + 1
+    parts.append(args_str[start:])
+    return [part for part in parts if part.strip()]
+
+def _parse_float_range(value: str) -> tuple:
+    if '..' in value:
+        lower, upper = value.split('..', 1)
+        return (
+            float(lower) if lower != '' else None,
+            float(upper) if upper != '' else None
+        )
+    return float(value), float(value)
+
+def _type_stage(type_name, negated):
+    def stage(branch, included):
+        return [e for e in included if (e['type'] == type_name) is not negated]
+    return stage
+
+def _distance_stage(lower, upper):
+    lower = -math.inf if lower is None else lower - 1e-6
+    upper = math.inf if upper is None else upper + 1e-6
+    def stage(branch, included):
+        origin = branch.position
+        return [e for e in included if lower <= math.dist(e['position'], origin) <= upper]
+    return stage
+
+def _scores_stage(objective, start, end):
+    start = -math.inf if start is None else start
+    end = math.inf if end is None else end
+    def stage(branch, included):
+        score = scoreboards.score
+        return [e for e in included if start <= score(objective, e['id']) <= end]
+    return stage
+
+def _tag_stage(tag, negated):
+    def stage(branch, included):
+        return [e for e in included if (tag in e.get('tags', ())) is not negated]
+    return stage
+
+def _name_stage(name, negated):
+    def stage(branch, included):
+        return [e for e in included if (e.get('CustomName', '') == name) is not negated]
+    return stage
+
+def _nbt_stage(filter_nbt, negated):
+    def stage(branch, included):
+        # Assume that the target entity's full NBT is stored in its 'nbt' key.
+        return [
+            e for e in included
+            if ('nbt' in e and match_nbt(filter_nbt, e['nbt'])) is not negated
         ]
-    }
+    return stage
+
+def _volume_stage(region):
+    def stage(branch, included):
+        result = []
+        for e in included:
+            pos = e.get('position', (0, 0, 0))
+            if all(min_val <= pos[axis] < max_val for axis, min_val, max_val in region):
+                result.append(e)
+        return result
+    return stage
+
+def _sort(branch, included, order):
+    origin = branch.position
+    if order == 'random':
+        return random.sample(included, len(included))
+    return sorted(
+        included,
+        key=lambda e: math.dist(e['position'], origin),
+        reverse=order == 'furthest'
+    )
 
-    # Filter by entity type.
-    if 'type' in args:
-        included = [e for e in included if e['type'] == args['type']]
-
-    # Limit option.
-    if 'limit' in args:
-        included = included[:int(args['limit'])]
-
-    # Distance filter.
-    if 'distance' in args:
-        d_spec = args['distance']
-        if '..' in d_spec:
-            parts = d_spec.split('..')
-            lower = float(parts[0]) if parts[0] != '' else None
-            upper = float(parts[1]) if parts[1] != '' else None
-        else:
-            val = float(d_spec)
-            lower = val
-            upper = val
+class Selector:
+    """
+    A target selector compiled into a pipeline of filter stages.
 
-        def in_range(d):
-            if lower is not None and d < lower - 1e-6:
-                return False
-            if upper is not None and d > upper + 1e-6:
-                return False
-            return True
+    All arguments (ranges, scores, NBT filters, volumes, sort and limit) are
+    parsed once when the selector is compiled. The stages run in the order
+    filters, sort, limit, like in vanilla. Selectors are immutable and shared
+    through compile_selector().
 
-        included = [e for e in included if in_range(distance_3d(e['position'], branch.position))]
-
-    # Scores filter.
-    if 'scores' in args:
-        scores_str = args['scores'].strip()
-        # Remove surrounding curly braces if present.
-        if scores_str.startswith('{') and scores_str.endswith('}'):
-            scores_str = scores_str[1:-1].strip()
-        # Process one or more score specifications, separated by commas.
-        for score_spec in scores_str.split(','):
-            parts = score_spec.split('=', 1)
-            if len(parts) != 2:
-                raise ValueError(f"Invalid score specification: {score_spec}")
-            objective = parts[0].strip()
-            value_str = parts[1].strip()
-            # If the value contains "..", process as a range.
-            if '..' in value_str:
-                start_value, end_value = parse_range(value_str)
-
-                new_included = []
-                for e in included:
-                    s_val = scoreboards[e['id']].get(objective, 0)
-                    if start_value is not None and s_val < start_value:
-                        continue
-                    if end_value is not None and s_val > end_value:
-                        continue
-                    new_included.append(e)
-                included = new_included
-            else:
-                # Process as a single integer value.
+    For @e, type=, tag= and name= arguments that aren't negated are looked up
+    in the EntityStore indexes. Otherwise distance and volume arguments are
+    turned into a bounding box that is looked up in the EntityStore grid, and
+    sort=nearest with a limit becomes a k-nearest query.
+    """
+    __slots__ = (
+        'text', 'base', 'filters', 'residual', 'index_keys',
+        'sort', 'limit', 'radius', 'box'
+    )
+
+    def __init__(self, text: str):
+        self.text = text
+        self.base = text.split('[', 1)[0]
+
+        args = []
+        if '[' in text:
+            args_str = text.split('[', 1)[1].removesuffix(']')
+            for pair in _split_selector_arguments(args_str):
+                if '=' not in pair:
+                    raise ValueError(f'Invalid selector argument "{pair}" in {text}')
+                key, value = pair.split('=', 1)
+                args.append((key.strip(), value.strip()))
+
+        filters = []
+        index_keys = []  # (index, value) pairs answered by the EntityStore indexes
+        indexed = []     # stages made redundant by index_keys
+        region = {}
+        self.sort = None
+        self.limit = None
+        self.radius = None
+        for key, value in args:
+            negated = value.startswith('!')
+            if key in ('type', 'tag', 'name'):
+                value = value.removeprefix('!')
+                if key == 'type':
+                    value = value.removeprefix('minecraft:')
+                    filters.append(_type_stage(value, negated))
+                elif key == 'tag':
+                    filters.append(_tag_stage(value, negated))
+                else:
+                    filters.append(_name_stage(value, negated))
+                if not negated:
+                    index_keys.append((key, value))
+                    indexed.append(filters[-1])
+            elif key == 'distance':
+                lower, upper = _parse_float_range(value)
+                filters.append(_distance_stage(lower, upper))
+                if upper is not None:
+                    self.radius = upper if self.radius is None else min(self.radius, upper)
+            elif key == 'scores':
+                for score_spec in _split_selector_arguments(value.removeprefix('{').removesuffix('}')):
+                    if '=' not in score_spec:
+                        raise ValueError(f"Invalid score specification: {score_spec}")
+                    objective, value_str = score_spec.split('=', 1)
+                    filters.append(_scores_stage(objective.strip(), *parse_range(value_str.strip())))
+            elif key == 'nbt':
                 try:
-                    eq_value = int(value_str)
-                except ValueError:
-                    raise ValueError(f"Invalid score value for objective '{objective}': {value_str}")
-                included = [e for e in included if scoreboards[e['id']].get(objective, 0) == eq_value]
-
-    # Tag filter.
-    if 'tag' in args:
-        tag_value = args['tag']
-        if tag_value.startswith('!'):
-            tag_value = tag_value[1:]
-            included = [e for e in included if tag_value not in e.get('tags', [])]
-        else:
-            included = [e for e in included if tag_value in e.get('tags', [])]
-
-    # Name filter.
-    if 'name' in args:
-        name_value = args['name']
-        if name_value.startswith('!'):
-            name_value = name_value[1:]
-            included = [e for e in included if e.get('CustomName', '') != name_value]
+                    filter_nbt = parse_nbt_filter(value.removeprefix('!'))
+                except Exception as e:
+                    raise ValueError(f"Invalid NBT filter: {e}")
+                filters.append(_nbt_stage(filter_nbt, negated))
+            elif key in ('x', 'y', 'z', 'dx', 'dy', 'dz'):
+                region[key] = float(value)
+            elif key == 'sort':
+                # 'arbitrary' does nothing.
+                self.sort = value if value in ('nearest', 'furthest', 'random') else None
+            elif key == 'limit':
+                self.limit = int(value)
+
+        # x, dx, y, dy, z, dz filters.
+        volume = []
+        lower = [-math.inf] * 3
+        upper = [math.inf] * 3
+        for axis, coord in enumerate(('x', 'y', 'z')):
+            if coord not in region:
+                continue
+            base = region[coord]
+            d_val = region.get(f'd{coord}', 0)  # default: region covers one block
+            if d_val >= 0:
+                volume.append((axis, base, base + d_val + 1))
+            else:
+                volume.append((axis, base + d_val, base + 1))
+            lower[axis], upper[axis] = volume[-1][1:]
+        if volume:
+            filters.append(_volume_stage(tuple(volume)))
+            self.box = (tuple(lower), tuple(upper))
         else:
-            included = [e for e in included if e.get('CustomName', '') == name_value]
-
-    # NBT filter.
-    if 'nbt' in args:
-        nbt_str = args['nbt']
-        negative = False
-        if nbt_str.startswith('!'):
-            negative = True
-            nbt_str = nbt_str[1:]
-        try:
-            filter_nbt = parse_nbt_filter(nbt_str)
-        except Exception as e:
-            raise ValueError(f"Invalid NBT filter: {e}")
-        def entity_matches_nbt(entity):
-            # Assume that the target entity's full NBT is stored in its 'nbt' key.
-            if 'nbt' not in entity:
-                return False
-            return match_nbt(filter_nbt, entity['nbt'])
-        if negative:
-            included = [e for e in included if not entity_matches_nbt(e)]
+            self.box = None
+
+        self.filters = tuple(filters)
+        # Stages left to run on entities taken from the indexes.
+        self.residual = tuple(stage for stage in filters if stage not in indexed)
+        self.index_keys = tuple(index_keys)
+
+    def _filter(self, branch: Branch, included: list, stages: tuple = None) -> list:
+        for stage in self.filters if stages is None else stages:
+            included = stage(branch, included)
+        return included
+
+    def _candidates(self, branch: Branch) -> list:
+        """Return the entities that can match, using the grid when the selector is bounded."""
+        if self.radius is None and self.box is None:
+            return list(entities)
+
+        lower = [-math.inf] * 3
+        upper = [math.inf] * 3
+        if self.box is not None:
+            lower, upper = list(self.box[0]), list(self.box[1])
+        if self.radius is not None:
+            for axis, origin in enumerate(branch.position):
+                lower[axis] = max(lower[axis], origin - self.radius - 1e-6)
+                upper[axis] = min(upper[axis], origin + self.radius + 1e-6)
+        return entities.within(tuple(lower), tuple(upper))
+
+    def select(self, branch: Branch) -> list:
+        """Return every entity matched by this selector for the given branch."""
+        if self.base == '@s':
+            included = self._filter(branch, [branch.executor])
+            return included if self.limit is None else included[:self.limit]
+        elif self.base != '@e':
+            # Only @e is permitted.
+            raise ValueError(f'Only @e or @s selector is permitted: {self.text}')
+
+        if self.index_keys:
+            # Start from the smallest matching index set.
+            included = self._filter(branch, entities.lookup(self.index_keys), self.residual)
+        elif self.sort == 'nearest' and self.limit is not None:
+            return entities.nearest(
+                branch.position, self.limit,
+                lambda batch: self._filter(branch, batch)
+            )
         else:
-            included = [e for e in included if entity_matches_nbt(e)]
-
-    # x, dx, y, dy, z, dz filters.
-    if any(k in args for k in ('x', 'y', 'z', 'dx', 'dy', 'dz')):
-        coord_filters = {}
-        for coord in ('x', 'y', 'z'):
-            if coord in args:
-                base = float(args[coord])
-                d_key = {'x': 'dx', 'y': 'dy', 'z': 'dz'}[coord]
-                if d_key in args:
-                    d_val = float(args[d_key])
-                else:
-                    d_val = 0  # default: region covers one block
-                if d_val >= 0:
-                    region_min = base
-                    region_max = base + d_val + 1
-                else:
-                    region_min = base + d_val
-                    region_max = base + 1
-                coord_filters[coord] = (region_min, region_max)
-
-        # If any coordinate filter is active, filter the entities by checking their position.
-        if coord_filters:
-            def in_region(entity):
-                pos = entity.get('position', (0, 0, 0))
-                for axis, (min_val, max_val) in coord_filters.items():
-                    idx = {'x': 0, 'y': 1, 'z': 2}[axis]
-                    if not (min_val <= pos[idx] < max_val):
-                        return False
-                return True
-            included = [e for e in included if in_region(e)]
+            included = self._filter(branch, self._candidates(branch))
+        if self.sort is not None:
+            included = _sort(branch, included, self.sort)
+        if self.limit is not None:
+            included = included[:self.limit]
+        return included
 
-    # Sort options.
-    if 'sort' in args:
-        if args['sort'] == 'nearest':
-            included = sorted(included, key=lambda e: distance_3d(e['position'], branch.position))
-        elif args['sort'] == 'furthest':
-            included = sorted(included, key=lambda e: distance_3d(e['position'], branch.position), reverse=True)
-        elif args['sort'] == 'random':
-            random.shuffle(included)
-        # 'arbitrary' does nothing.
+    def __repr__(self):
+        return repr(self.text)
 
+    def __str__(self):
+        return self.text
 
-    # Return IDs (assuming each entity has an 'id' key).
-    return included
+@lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def compile_selector(text: str) -> Selector:
+    """
+    Compile a selector string, reusing the compiled selector for text seen before.
 
-def eval_position(branch:Branch, x: str, y: str, z: str) -> tuple:
+    The cache is a bounded LRU keyed by the selector text, so selectors built
+    from macro arguments are compiled once per distinct value. Hit and miss
+    counters are available through compile_selector.cache_info().
+    """
+    return Selector(text)
+
+def eval_target_selector(branch: Branch, selector: 'Selector | str') -> list:
+    """Find all entities that match a selector and return them"""
+    if selector.__class__ is not Selector:
+        # If the selector doesn't start with '@', return
+        if not selector.startswith('@'):
+            return [selector]
+        selector = compile_selector(selector)
+
+    return selector.select(branch)
+
+class Coordinate:
+    """
+    One component of a coordinate triple such as "5", "~2" or "^", as stored
+    in the constant pool. Caret components are relative too.
+    """
+    __slots__ = ('offset', 'relative', 'caret')
+
+    def __init__(self, offset: float, relative: bool = False, caret: bool = False):
+        self.offset = offset
+        self.relative = relative
+        self.caret = caret
+
+    @classmethod
+    def parse(cls, text: str) -> 'Coordinate':
+        if text.startswith("^"):
+            return cls(float(text[1:] or 0), True, True)
+        if text.startswith("~"):
+            return cls(float(text[1:] or 0), True)
+        return cls(float(text))
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __str__(self):
+        prefix = "^" if self.caret else "~" if self.relative else ""
+        if prefix and not self.offset:
+            return prefix
+        return f"{prefix}{int(self.offset) if self.offset.is_integer() else self.offset}"
+
+class Coordinates:
     """
-    Evaluates a position from three coordinate strings.
+    A coordinate triple decoded once at load time.
 
     Supports:
       - Absolute: e.g. "5"
@@ -773,17 +2006,36 @@ def eval_position(branch:Branch, x: str, y: str, z: str) -> tuple:
          When any coordinate begins with "^", all three are assumed to be caret coordinates.
          Caret coordinates are applied relative to the current camera direction (facing).
 
-    Globals:
-      position: (x,y,z) tuple representing the current world position.
-      facing: (yaw,pitch) in degrees representing the current camera orientation.
+    Each component is kept as a float offset plus a flag telling whether it is
+    relative to the execution position.
     """
-    base_x, base_y, base_z = branch.position  # current world position
-    # If any coordinate starts with "^", process all three as camera-relative.
-    if x.startswith("^") or y.startswith("^") or z.startswith("^"):
-        # Extract caret offsets; if a component is not provided as caret, assume 0.
-        dx = float(x[1:]) if x.startswith("^") and x != "^" else 0.0
-        dy = float(y[1:]) if y.startswith("^") and y != "^" else 0.0
-        dz = float(z[1:]) if z.startswith("^") and z != "^" else 0.0
+    __slots__ = ('text', 'caret', 'offsets', 'relative')
+
+    def __init__(self, x: 'str | Coordinate', y: 'str | Coordinate', z: 'str | Coordinate'):
+        self.text = f'{x} {y} {z}'
+        components = [c if c.__class__ is Coordinate else Coordinate.parse(c) for c in (x, y, z)]
+        # If any coordinate starts with "^", process all three as camera-relative.
+        self.caret = any(c.caret for c in components)
+        if self.caret:
+            # If a component is not provided as caret, assume 0.
+            self.offsets = tuple(c.offset if c.caret else 0.0 for c in components)
+            self.relative = (True, True, True)
+        else:
+            self.offsets = tuple(c.offset for c in components)
+            self.relative = tuple(c.relative for c in components)
+
+    def resolve(self, branch:Branch) -> tuple:
+        """Evaluate the coordinates against the position and facing of a branch."""
+        base_x, base_y, base_z = branch.position  # current world position
+        dx, dy, dz = self.offsets
+
+        if not self.caret:
+            rel_x, rel_y, rel_z = self.relative
+            return (
+                base_x + dx if rel_x else dx,
+                base_y + dy if rel_y else dy,
+                base_z + dz if rel_z else dz
+            )
 
         # Compute the forward, right, and up vectors based on the camera's yaw and pitch.
         yaw_deg, pitch_deg = branch.facing
@@ -809,21 +2061,15 @@ def eval_position(branch:Branch, x: str, y: str, z: str) -> tuple:
         new_z = base_z + (dx * r_z + dy * up_z + dz * f_z)
         return (new_x, new_y, new_z)
 
-    else:
-        # For tilde and absolute values, process each coordinate independently.
-        def parse_coord(comp_str: str, base: float) -> float:
-            # If relative coordinate using tilde, add the offset to base.
-            if comp_str.startswith("~"):
-                if comp_str == "~":
-                    return base
-                return base + float(comp_str[1:])
-            # Otherwise, it's absolute.
-            return float(comp_str)
-
-        new_x = parse_coord(x, base_x)
-        new_y = parse_coord(y, base_y)
-        new_z = parse_coord(z, base_z)
-        return (new_x, new_y, new_z)
+    def __repr__(self):
+        return repr(self.text)
+
+    def __str__(self):
+        return self.text
+
+def eval_position(branch:Branch, x: str, y: str, z: str) -> tuple:
+    """Evaluates a position from three coordinate strings. See Coordinates."""
+    return Coordinates(x, y, z).resolve(branch)
 
 def match_nbt(filter_nbt: dict, target_nbt: dict) -> bool:
     """
@@ -877,173 +2123,490 @@ def varname_to_int(varname: str) -> int:
     except Exception as e:
         raise ValueError(f'Invalid varname: {varname}') from e
 
-# All other functions are useless frfr
-def execute_instruction(branch:Branch, inst, args):
-    # sourcery skip: low-code-quality
-    for i,arg in enumerate(args):
-        if str(arg).startswith('$'):
-            var = arg.removeprefix('$(').removesuffix(')')
-            var = varname_to_int(var)
-            if len(branch.vars) <= var:
-                raise RuntimeError(f'Variable index out of range: {var}, {branch.vars}')
-            args[i] = branch.vars[var]
-
-    match inst:
-        case "execute_as":
-            executors = eval_target_selector(branch, args[0])
-            for executor in executors:
-                branch.clone(executor=executor)
-            branch.skip_over()
-
-        case "execute_at":
-            entity = eval_target_selector(branch, args[0])[0]
-            position = (0, 0, 0) if entity == 'SERVER' else entity['Pos']
-            branch.clone(position=position)
-            branch.skip_over()
-
-        case "execute_store":
-            # Args: store_type, target, objective.
-            store_type, target, objective = args
-            # Instead of modifying the scoreboard immediately,
-            # record the store request on this branch.
-            branch.pending_store = (store_type, target, objective)
-
-        case "kill_branch":
-            # Debug for kill_branch
-            if branch.pending_store is not None:
-                store_type, target, objective = branch.pending_store
-                # Use the value of the last executed instruction.
-                value = (
-                    int(branch.last_value)
-                    if store_type == "result"
-                    else (1 if branch.last_value else 0)
-                )
+# Operands
 
-                branch.pending_store = _set_objective_target(
-                    objective, value, target, branch
-                )
-            if branch.id == 0:
-                return False
+class Range:
+    """An integer range such as "1..5", decoded once at load time. Open bounds are None."""
+    __slots__ = ('text', 'start', 'end')
 
-            branch.kill()
-            return True  # Yield
-
-        case "get":
-            target = eval_target_selector(branch, args[0])[0]
-            objective = args[1]
-            if objective not in scoreboards:
-                scoreboards[objective] = {}
-            if target not in scoreboards[objective]:
-                scoreboards[objective][target] = 0
-            return None, scoreboards[objective][target]
-
-        case "positioned":
-            branch.position = eval_position(branch, *args[:3])
-
-        case "if_block":
-            position = eval_position(branch, *args[:3])
-            if not blocks.get(position):
-                branch.kill()
-
-        case "if_entity":
-            entities = eval_target_selector(args[0])
-            if not entities:
-                branch.kill()
-
-        case "if_score":
-            # If the instruction was compiled in range mode (matches)
-            if len(args) == 4 and args[2].lower() == "matches":
-                _validate_scoreboard_range(branch, args)
-            elif len(args) == 5:
-                _evaluate_condition_and_skip(branch, args)
-            else:
-                raise ValueError("Invalid argument count for if_score")
-
-        case "unless_block":
-            position = eval_position(branch, *args[:3])
-            if blocks.get(position):
-                branch.kill()
-
-        case "unless_entity":
-            entities = eval_target_selector(args[0])
-            if entities:
-                branch.kill()
-
-        case "unless_score":
-            # If the instruction was compiled in range mode (matches)
-            if len(args) == 4 and args[2].lower() == "matches":
-                _evaluate_target_and_skip(branch, args)
-            elif len(args) == 5:
-                _evaluate_condition_based_on_score(branch, args)
-            else:
-                raise ValueError("Invalid argument count for unless_score")
+    def __init__(self, text: str):
+        self.text = text
+        self.start, self.end = parse_range(text)
 
-        case "say":
-            executor = branch.executor
-            if executor != 'SERVER':
-                executor = executor['type']
+    @classmethod
+    def from_bounds(cls, start: int | None, end: int | None) -> 'Range':
+        """A range decoded from the constant pool."""
+        self = cls.__new__(cls)
+        self.start, self.end = start, end
+        if start is not None and start == end:
+            self.text = str(start)
+        else:
+            self.text = f"{'' if start is None else start}..{'' if end is None else end}"
+        return self
 
-            print(f'[{executor}]', " ".join(args))
+    def __repr__(self):
+        return repr(self.text)
 
-        case "tellraw":
-            print_json_text(args[0])
+    def __str__(self):
+        return self.text
 
-        case "add":
-            target = eval_target_selector(branch, args[0])[0]
-            objective = args[1]
+class MacroRef:
+    """A function argument ("$(a)") used as an instruction operand."""
+    __slots__ = ('text', 'index')
 
-            if objective not in scoreboards:
-                scoreboards[objective] = {}
+    def __init__(self, text: str):
+        self.text = text
+        name = text.removeprefix('$(').removesuffix(')').removeprefix('$')
+        self.index = int(name) if name.isdigit() else varname_to_int(name)
 
-            if target not in scoreboards[objective]:
-                scoreboards[objective][target] = 0
+    def __repr__(self):
+        return repr(self.text)
 
-            scoreboards[objective][target] += int(args[2])
+    def __str__(self):
+        return self.text
 
-        case "remove":
-            target = eval_target_selector(branch, args[0])[0]
-            objective = args[1]
-            scoreboards[objective][target] -= int(args[2])
+# Number of bound operand lists kept per macro instruction.
+MACRO_BIND_CACHE_SIZE = 32
 
-        case "list_scores":
-            target = eval_target_selector(branch, args[0])[0]
-            if target == '*':
-                # Count every entry in every scoreboard
-                count = sum(len(scores) for scores in scoreboards.values())
-            else:
-                count = sum(
-                    target in scores for scores in scoreboards.values()
-                )
-            return None, count
+class MacroOperands(list):
+    """
+    Operands of an instruction that uses macro arguments.
+
+    The operands stay strings, with MacroRef placeholders for the macros, and
+    `slots` holds the precomputed (operand index, argument index) pairs. bind()
+    fills the slots from the arguments of the calling branch and binds the
+    result without touching the program. Bound operands are memoized per
+    argument values, so a macro instruction called in a loop binds once.
+    """
+    __slots__ = ('opcode', 'slots', 'cache')
 
-        case "list_objectives":
-            return None, len(scoreboards)
+    def __init__(self, opcode: Instruction, args: list):
+        super().__init__(
+            MacroRef(arg) if isinstance(arg, str) and arg.startswith('$') else arg
+            for arg in args
+        )
+        self.opcode = opcode
+        self.slots = tuple(
+            (position, arg.index) for position, arg in enumerate(self)
+            if arg.__class__ is MacroRef
+        )
+        self.cache = {}
 
-        case "set_score":
-            target = eval_target_selector(branch, args[0])[0]
-            objective = args[1]
-            if objective not in scoreboards:
-                scoreboards[objective] = {}
-            scoreboards[objective][target] = int(args[2])
+    def bind(self, branch:Branch) -> list:
+        frame = branch.vars
+        try:
+            values = tuple([frame[index] for _, index in self.slots])
+        except IndexError:
+            index = max(index for _, index in self.slots)
+            raise RuntimeError(f'Variable index out of range: {index}, {frame}') from None
+
+        bound = self.cache.get(values)
+        if bound is None:
+            args = list(self)
+            for (position, _), value in zip(self.slots, values):
+                args[position] = value
+            bound = _bind(self.opcode, args)
+
+            if len(self.cache) >= MACRO_BIND_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[values] = bound
+        return bound
+
+def _bind_target(text: str) -> 'Selector | str':
+    # Selectors are compiled, plain score holder names stay strings.
+    return compile_selector(text) if text.startswith('@') else text
+
+def _bind_selector(args: list) -> list:
+    # <selector>
+    return [_bind_target(args[0]), *args[1:]]
+
+def _bind_position(args: list) -> list:
+    # <x> <y> <z> [block]
+    return [Coordinates(*args[:3]), *args[3:]]
+
+def _bind_score_change(args: list) -> list:
+    # <target> <objective> <amount>
+    return [_bind_target(args[0]), args[1], int(args[2]), *args[3:]]
+
+def _bind_score_target(args: list) -> list:
+    # <target> [objective]
+    return [_bind_target(args[0]), *args[1:]]
+
+def _bind_score_comparison(args: list) -> list:
+    # <target> <objective> matches <range>
+    # <target> <objective> <operator> <source> <objective>
+    if len(args) == 4 and args[2].lower() == "matches":
+        matches = args[3] if args[3].__class__ is Range else Range(args[3])
+        return [_bind_target(args[0]), args[1], "matches", matches]
+    if len(args) == 5:
+        return [_bind_target(args[0]), args[1], args[2], _bind_target(args[3]), args[4]]
+    raise ValueError(f"Invalid argument count: {len(args)}")
+
+def _bind_summon(args: list) -> list:
+    # <type> [<x> <y> <z>] [nbt]
+    position = Coordinates(*args[1:4]) if len(args) > 1 else Coordinates('~', '~', '~')
+    nbt = parse_nbt_filter(' '.join(args[4:])) if len(args) > 4 else {}
+    return [args[0].removeprefix('minecraft:'), position, nbt]
+
+def _bind_kill(args: list) -> list:
+    # [selector]
+    return [_bind_target(args[0] if args else '@s')]
+
+def _bind_tellraw(args: list) -> list:
+    # <component>
+    return [TextTemplate(args[0]), *args[1:]]
+
+OPERAND_BINDERS = {
+    Instruction.execute_as: _bind_selector,
+    Instruction.execute_at: _bind_selector,
+    Instruction.positioned: _bind_position,
+    Instruction.if_block: _bind_position,
+    Instruction.if_entity: _bind_selector,
+    Instruction.if_score: _bind_score_comparison,
+    Instruction.unless_block: _bind_position,
+    Instruction.unless_entity: _bind_selector,
+    Instruction.unless_score: _bind_score_comparison,
+    Instruction.add: _bind_score_change,
+    Instruction.remove: _bind_score_change,
+    Instruction.set_score: _bind_score_change,
+    Instruction.get: _bind_score_target,
+    Instruction.list_scores: _bind_score_target,
+    Instruction.reset: _bind_score_target,
+    Instruction.operation: _bind_score_comparison,
+    Instruction.summon: _bind_summon,
+    Instruction.kill: _bind_kill,
+    Instruction.tag_add: _bind_selector,
+    Instruction.tag_remove: _bind_selector,
+    Instruction.tellraw: _bind_tellraw,
+}
+
+def _bind(opcode: Instruction, args: list) -> list:
+    binder = OPERAND_BINDERS.get(opcode)
+    if binder is None:
+        return args
+    try:
+        return binder(args)
+    except (ValueError, IndexError, TypeError) as e:
+        raise ValueError(f'Invalid operands for {opcode.name} {args}: {e}') from None
 
-        case "operation":
-            _scoreboard_operation(branch, args)
+def bind_operands(opcode: Instruction, args: list) -> list:
+    """
+    Convert the string arguments of an instruction into typed operands.
 
-        case "run_func":
-            return _create_new_branch_for_function(args, branch)
+    Integers, ranges, coordinates and selectors are decoded here once so that
+    handlers never parse their arguments again. Instructions that use macro
+    arguments are returned as MacroOperands and are bound when executed.
 
-        case "return_run":
-            return _handle_return_execution(branch)
+    Raises:
+        ValueError: If an argument can't be decoded.
+    """
+    if any(isinstance(arg, str) and arg.startswith('$') for arg in args):
+        return MacroOperands(opcode, args)
+    return _bind(opcode, args)
+
+def function_program(name: str) -> Program:
+    """The Program of a function, binding it on first use if it was loaded as a CodeObject."""
+    function = functions[name]
+    if function.__class__ is CodeObject:
+        return function.load()
+    return function
+
+def load_program(instructions: list) -> Program:
+    """Bind the operands of a list of (opcode, [args]) tuples, e.g. a program built by hand."""
+    return Program((opcode, bind_operands(opcode, list(args))) for opcode, args in instructions)
+
+def _resolve_target(branch:Branch, operand: 'Selector | str'):
+    """Resolve a bound score holder: selectors are evaluated, plain names are used as-is."""
+    if operand.__class__ is Selector:
+        holder = eval_target_selector(branch, operand)[0]
+        # Entities hold scores under their id.
+        return holder['id'] if isinstance(holder, dict) else holder
+    return operand
+
+# Instruction handlers, indexed by opcode. Filled in by the @handler decorator.
+HANDLERS = [None] * (max(Superinstruction) + 1)
+
+def handler(*opcodes: Instruction):
+    """Register the decorated function as the handler for the given opcodes."""
+    def register(func):
+        for opcode in opcodes:
+            HANDLERS[opcode] = func
+        return func
+    return register
+
+def _not_implemented(branch:Branch, args):
+    """Handler for instructions that are known but not implemented by the VM yet."""
+    return None
 
-        case _:
-            log.error(f'NotImplemented: {inst} {args}')
+def execute_instruction(branch:Branch, inst, args):
+    # Instructions with macro arguments are bound once the arguments are known.
+    if args.__class__ is MacroOperands:
+        args = args.bind(branch)
+
+    return HANDLERS[inst](branch, args)
+
+@handler(Instruction.execute_as)
+def _execute_as(branch:Branch, args):
+    executors = eval_target_selector(branch, args[0])
+    for executor in executors:
+        branch.clone(executor=executor)
+    branch.skip_over()
+
+@handler(Instruction.execute_at)
+def _execute_at(branch:Branch, args):
+    entity = eval_target_selector(branch, args[0])[0]
+    position = (0, 0, 0) if entity == 'SERVER' else _entity_position(entity)
+    branch.clone(position=position)
+    branch.skip_over()
+
+@handler(Instruction.execute_store)
+def _execute_store(branch:Branch, args):
+    # Args: store_type, target, objective.
+    store_type, target, objective = args
+    # Instead of modifying the scoreboard immediately,
+    # record the store request on this branch.
+    branch.pending_store = (store_type, target, objective)
+
+@handler(Instruction.kill_branch)
+def _kill_branch(branch:Branch, args):
+    if branch.pending_store is not None:
+        store_type, target, objective = branch.pending_store
+        # Use the value of the last executed instruction.
+        value = (
+            int(branch.last_value)
+            if store_type == "result"
+            else (1 if branch.last_value else 0)
+        )
 
-def _handle_return_execution(branch):
+        branch.pending_store = _set_objective_target(
+            objective, value, target, branch
+        )
+    if branch.frames:
+        # Ends the called function, not the branch
+        branch.return_to_caller()
+        return True
     if branch.id == 0:
+        return False
+
+    branch.kill()
+    return True  # Yield
+
+@handler(Instruction.get)
+def _get(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    objective = args[1]
+    return None, scoreboards.score(objective, target)
+
+@handler(Instruction.positioned)
+def _positioned(branch:Branch, args):
+    branch.position = args[0].resolve(branch)
+
+@handler(Instruction.if_block)
+def _if_block(branch:Branch, args):
+    position = args[0].resolve(branch)
+    if not blocks.get(position):
+        branch.kill()
+
+@handler(Instruction.if_entity)
+def _if_entity(branch:Branch, args):
+    if not eval_target_selector(branch, args[0]):
+        branch.kill()
+
+@handler(Instruction.if_score)
+def _if_score(branch:Branch, args):
+    # If the instruction was compiled in range mode (matches)
+    if len(args) == 4:
+        _validate_scoreboard_range(branch, args)
+    else:
+        _evaluate_condition_and_skip(branch, args)
+
+@handler(Instruction.unless_block)
+def _unless_block(branch:Branch, args):
+    position = args[0].resolve(branch)
+    if blocks.get(position):
+        branch.kill()
+
+@handler(Instruction.unless_entity)
+def _unless_entity(branch:Branch, args):
+    if eval_target_selector(branch, args[0]):
+        branch.kill()
+
+@handler(Instruction.unless_score)
+def _unless_score(branch:Branch, args):
+    # If the instruction was compiled in range mode (matches)
+    if len(args) == 4:
+        _evaluate_target_and_skip(branch, args)
+    else:
+        _evaluate_condition_based_on_score(branch, args)
+
+@handler(Instruction.say)
+def _say(branch:Branch, args):
+    executor = branch.executor
+    if executor != 'SERVER':
+        executor = executor['type']
+
+    output.write_line(f'[{executor}] {" ".join(args)}')
+
+@handler(Instruction.tellraw)
+def _tellraw(branch:Branch, args):
+    output.write_line(args[0].render())
+
+@handler(Instruction.add)
+def _add(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    objective = args[1]
+    scoreboards.add_score(objective, target, args[2])
+
+@handler(Instruction.remove)
+def _remove(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    objective = args[1]
+    scoreboards.add_score(objective, target, -args[2])
+
+@handler(Instruction.list_scores)
+def _list_scores(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    if target == '*':
+        # Count every entry in every scoreboard
+        count = sum(len(scores) for scores in scoreboards.values())
+    else:
+        count = sum(
+            target in scores for scores in scoreboards.values()
+        )
+    return None, count
+
+@handler(Instruction.list_objectives)
+def _list_objectives(branch:Branch, args):
+    return None, len(scoreboards)
+
+@handler(Instruction.set_score)
+def _set_score(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    objective = args[1]
+    scoreboards.set_score(objective, target, args[2])
+
+@handler(Instruction.reset)
+def _reset(branch:Branch, args):
+    target = _resolve_target(branch, args[0])
+    objective = args[1] if len(args) > 1 else None
+    return None, scoreboards.reset_score(target, objective)
+
+@handler(Instruction.operation)
+def _operation(branch:Branch, args):
+    _scoreboard_operation(branch, args)
+
+@handler(Instruction.summon)
+def _summon(branch:Branch, args):
+    entity_type, position, nbt = args
+    entity = {
+        'id': str(uuid4()),
+        'type': entity_type,
+        'position': position.resolve(branch),
+        'tags': list(nbt.get('Tags', [])),
+        'nbt': dict(nbt),
+    }
+    if 'CustomName' in nbt:
+        entity['CustomName'] = str(nbt['CustomName']).strip('"\'')
+    entities.add(entity)
+    return None, 1
+
+@handler(Instruction.kill)
+def _kill(branch:Branch, args):
+    killed = 0
+    for entity in eval_target_selector(branch, args[0]):
+        if entity in entities:
+            entities.remove(entity)
+            killed += 1
+    return None, killed
+
+@handler(Instruction.tag_add)
+def _tag_add(branch:Branch, args):
+    changed = 0
+    for entity in eval_target_selector(branch, args[0]):
+        if isinstance(entity, dict):
+            changed += entities.add_tag(entity, args[1])
+    return None, changed
+
+@handler(Instruction.tag_remove)
+def _tag_remove(branch:Branch, args):
+    changed = 0
+    for entity in eval_target_selector(branch, args[0]):
+        if isinstance(entity, dict):
+            changed += entities.remove_tag(entity, args[1])
+    return None, changed
+
+@handler(Instruction.run_func)
+def _run_func(branch:Branch, args):
+    func_name = args[0]
+    if func_name not in functions:
+        raise RuntimeError(
+            f"Function {func_name} not found. Functions: {', '.join(functions.keys())}"
+        )
+
+    if debugHook is None and not trace:
+        program = function_program(func_name)
+        compiled = _hot_function(program)
+        if compiled is not None and _turn_allows(program):
+            _run_compiled(branch, compiled, args[1:])
+            return True
+
+    # Nothing is left to do in this function after a tail call, so the callee
+    # can take over its frame. Not for the root's kill_branch, which it runs
+    # past, or when a store is waiting for the result of the callee or of
+    # this function: the callee would pass its return value to our caller's
+    # store, which this function doesn't.
+    if (
+        branch.program_counter - 1 in branch.program.tail_calls
+        and (branch.frames or branch.id != 0)
+        and branch.pending_store is None
+        and branch.caller_pending_store is None
+    ):
+        global tail_calls_eliminated
+        tail_calls_eliminated += 1
+        branch.tail_call(func_name, args[1:])
+    else:
+        branch.call(func_name, args[1:])
+
+    # Yield so other branches get a turn between calls
+    return True
+
+@handler(Instruction.return_run)
+def _return_run(branch:Branch, args):
+    return _handle_return_execution(branch)
+
+@handler(*Superinstruction)
+def _fused(branch:Branch, args):
+    """Run `<prefix>; <command>; kill_branch` in one dispatch. See Program."""
+    prefix, prefix_args, command, command_args = args
+    pc = branch.program_counter  # Of the command
+    if prefix_args.__class__ is MacroOperands:
+        prefix_args = prefix_args.bind(branch)
+    HANDLERS[prefix](branch, prefix_args)
+
+    # Prefixes that don't let the command run skip to the kill_branch
+    if branch.program_counter == pc:
+        if command_args.__class__ is MacroOperands:
+            command_args = command_args.bind(branch)
+        branch.program_counter = pc + 1
+        result = HANDLERS[command](branch, command_args)
+        # Yielded, jumped or killed: continue at the kill_branch later, like unfused
+        if result or branch.program_counter != pc + 1 or branch not in branches:
+            return result
+
+    branch.program_counter = pc + 2
+    return _kill_branch(branch, None)
+
+# Everything without a handler is accepted by the loader but does nothing.
+for _opcode in Instruction:
+    if HANDLERS[_opcode] is None:
+        HANDLERS[_opcode] = _not_implemented
+
+def _handle_return_execution(branch):
+    if branch.id == 0 and not branch.frames:
         log.warning('Return run in root branch.')
         return
 
-    if not branch.caller:
+    if not branch.frames and not branch.caller:
         log.error(
             f'No caller to return to. {branch.function}:{branch.program_counter}'
         )
@@ -1051,41 +2614,60 @@ def _handle_return_execution(branch):
 
     # Save current PC and execute the next instruction (usually a get)
     pc_before_return = branch.program_counter
+    function = branch.function
+    depth = len(branch.frames)
+    tail_calls = tail_calls_eliminated
+    pc = branch.program_counter
+    if pc < len(branch.program) and branch.program[pc][0] == Instruction.run_func:
+        # The callee's return value goes to our caller's store
+        branch.pending_store = branch.caller_pending_store
     result = branch.execute_one()
 
-    # Capture return value
-    if isinstance(result, tuple) and len(result) > 1:
+    if len(branch.frames) > depth:
+        # `return run function ...`: the callee returns straight to our caller
+        frame = branch.frames.pop()
+        branch.caller_pending_store = frame.caller_pending_store
+        return True
+    if tail_calls_eliminated != tail_calls:
+        # The same, with the callee already in our frame
+        return True
+
+    has_value = isinstance(result, tuple) and len(result) > 1
+    if has_value:
         value = result[1]
         branch.last_value = value
 
-        # Pass the return value to the caller
-        if branch.caller:
-            # Set the caller's last_value
-            branch.caller.last_value = value
-
-            # MODIFIED: Check for saved pending store from caller
-            if (
-                hasattr(branch, 'caller_pending_store')
-                and branch.caller_pending_store is not None
-            ):
-                store_type, target, objective = (
-                    branch.caller_pending_store
-                )
-                store_value = (
-                    int(value)
-                    if store_type == "result"
-                    else (1 if value else 0)
+        # MODIFIED: Check for saved pending store from caller
+        if branch.caller_pending_store is not None:
+            store_type, target, objective = (
+                branch.caller_pending_store
+            )
+            store_value = (
+                int(value)
+                if store_type == "result"
+                else (1 if value else 0)
+            )
+
+            branch.caller_pending_store = (
+                _set_objective_target(
+                    objective, store_value, target, branch
                 )
+            )
 
-                branch.caller_pending_store = (
-                    _set_objective_target(
-                        objective, store_value, target, branch
-                    )
-                )
     # Log the return for easier debugging
-    log.debug(
-        f"Return from {branch.function}:{pc_before_return} with value: {branch.last_value}"
-    )
+    if trace:
+        log.debug(
+            f"Return from {function}:{pc_before_return} with value: {branch.last_value}"
+        )
+
+    if branch.frames:
+        branch.return_to_caller()
+        # The run loop makes the value the caller's last value
+        return (True, value) if has_value else True
+
+    # A branch forked by execute passes the value to the branch that forked it
+    if has_value:
+        branch.caller.last_value = value
 
     # Terminate the current branch
     branch.kill()
@@ -1093,115 +2675,48 @@ def _handle_return_execution(branch):
     # Return with yield signal and value
     return True, branch.last_value
 
-def _create_new_branch_for_function(args, branch):
-    func_name = args[0]
-    func_args = args[1:]
-    if func_name not in functions:
-        raise RuntimeError(
-            f"Function {func_name} not found. Functions: {', '.join(functions.keys())}"
-        )
-
-    # Create a new Branch and assign its program.
-    new_branch = branch.clone(function=func_name)
-    new_branch.program = functions[func_name]
-    new_branch.vars = func_args
-    new_branch.caller = (
-        branch  # Make sure caller reference is set correctly
-    )
-    new_branch.program_counter = 0  # Start at beginning of function
-
-    # MODIFIED: Transfer pending store from caller to function branch
-    # This prevents the caller's kill_branch from processing it prematurely
-    if branch.pending_store:
-        # Save the pending store information on the new branch
-        new_branch.caller_pending_store = branch.pending_store
-        # Clear it from the caller so kill_branch won't process it
-        branch.pending_store = None
-
-    # Return yield signal only
-    return True
-
 def _scoreboard_operation(branch, args):
-    target = eval_target_selector(branch, args[0])[0]
+    target = _resolve_target(branch, args[0])
     target_obj = args[1]
     operation = args[2]
-    source = eval_target_selector(branch, args[3])[0]
+    source = _resolve_target(branch, args[3])
     source_obj = args[4]
 
-    if target_obj not in scoreboards:
-        scoreboards[target_obj] = {}
-
-    if target not in scoreboards[target_obj]:
-        scoreboards[target_obj][target] = 0
-
-    if source_obj not in scoreboards:
-        scoreboards[source_obj] = {}
-
-    if source not in scoreboards[source_obj]:
-        scoreboards[source_obj][source] = 0
+    value = scoreboards.score(target_obj, target)
+    source_value = scoreboards.score(source_obj, source)
 
     if operation == "=":
-        scoreboards[target_obj][target] = scoreboards[source_obj][
-            source
-        ]
+        value = source_value
     elif operation == "+=":
-        scoreboards[target_obj][target] += scoreboards[source_obj][
-            source
-        ]
+        value += source_value
     elif operation == "-=":
-        scoreboards[target_obj][target] -= scoreboards[source_obj][
-            source
-        ]
+        value -= source_value
     elif operation == "*=":
-        scoreboards[target_obj][target] *= scoreboards[source_obj][
-            source
-        ]
+        value *= source_value
     elif operation == "/=":
-        scoreboards[target_obj][target] //= scoreboards[source_obj][
-            source
-        ]
+        value //= source_value
     elif operation == "%=":
-        scoreboards[target_obj][target] %= scoreboards[source_obj][
-            source
-        ]
+        value %= source_value
     elif operation == "<":
-        scoreboards[target_obj][target] = min(
-            scoreboards[target_obj][target],
-            scoreboards[source_obj][source],
-        )
+        value = min(value, source_value)
     elif operation == ">":
-        scoreboards[target_obj][target] = max(
-            scoreboards[target_obj][target],
-            scoreboards[source_obj][source],
-        )
+        value = max(value, source_value)
     elif operation == "><":
-        (
-            scoreboards[target_obj][target],
-            scoreboards[source_obj][source],
-        ) = (
-            scoreboards[source_obj][source],
-            scoreboards[target_obj][target_obj],
-        )
+        scoreboards.set_score(source_obj, source, value)
+        value = source_value
     else:
         raise ValueError(f"Unknown operation: {operation}")
 
+    scoreboards.set_score(target_obj, target, value)
+
 def _evaluate_condition_based_on_score(branch, args):
-    target = eval_target_selector(branch, args[0])[0]
+    target = _resolve_target(branch, args[0])
     objective = args[1]
     operator = args[2]
-    comp_target = eval_target_selector(branch, args[3])[0]
+    comp_target = _resolve_target(branch, args[3])
     comp_objective = args[4]
-    # Ensure default score values.
-    if objective not in scoreboards:
-        scoreboards[objective] = {}
-    if target not in scoreboards[objective]:
-        scoreboards[objective][target] = 0
-    if comp_objective not in scoreboards:
-        scoreboards[comp_objective] = {}
-    if comp_target not in scoreboards[comp_objective]:
-        scoreboards[comp_objective][comp_target] = 0
-    value = scoreboards[objective][target]
-    comp_value = scoreboards[comp_objective][comp_target]
+    value = scoreboards.score(objective, target)
+    comp_value = scoreboards.score(comp_objective, comp_target)
     cond = False
     if operator == ">":
         cond = value > comp_value
@@ -1223,40 +2738,26 @@ def _evaluate_condition_based_on_score(branch, args):
         branch.skip_over()
 
 def _evaluate_target_and_skip(branch, args):
-    target = eval_target_selector(branch, args[0])[0]
+    target = _resolve_target(branch, args[0])
     objective = args[1]
-    range_spec = args[3]
-    start, end = parse_range(range_spec)
+    start, end = args[3].start, args[3].end
     if start is None:
         start = 0
     if end is None:
         end = 1000000
-    if objective not in scoreboards:
-        scoreboards[objective] = {}
-    if target not in scoreboards[objective]:
-        scoreboards[objective][target] = 0
-    value = scoreboards[objective][target]
+    value = scoreboards.score(objective, target)
     if start <= value < end:
         branch.skip_over()
 
 def _evaluate_condition_and_skip(branch, args):
-    target = eval_target_selector(branch, args[0])[0]
+    target = _resolve_target(branch, args[0])
     objective = args[1]
     operator = args[2]
-    comp_target = eval_target_selector(branch, args[3])[0]
+    comp_target = _resolve_target(branch, args[3])
     comp_objective = args[4]
-    # Ensure default score values.
-    if objective not in scoreboards:
-        scoreboards[objective] = {}
-    if target not in scoreboards[objective]:
-        scoreboards[objective][target] = 0
-    if comp_objective not in scoreboards:
-        scoreboards[comp_objective] = {}
-    if comp_target not in scoreboards[comp_objective]:
-        scoreboards[comp_objective][comp_target] = 0
-    comp_value = scoreboards[comp_objective][comp_target]
+    comp_value = scoreboards.score(comp_objective, comp_target)
     cond = False
-    value = scoreboards[objective][target]
+    value = scoreboards.score(objective, target)
     if operator == ">":
         cond = value > comp_value
     elif operator == "<":
@@ -1277,73 +2778,429 @@ def _evaluate_condition_and_skip(branch, args):
         branch.skip_over()
 
 def _validate_scoreboard_range(branch, args):
-    target = eval_target_selector(branch, args[0])[0]
+    target = _resolve_target(branch, args[0])
     objective = args[1]
-    range_spec = args[3]
-    start, end = parse_range(range_spec)
+    start, end = args[3].start, args[3].end
     if start is None:
         start = 0
     if end is None:
         end = 1000000
-    if objective not in scoreboards:
-        scoreboards[objective] = {}
-    if target not in scoreboards[objective]:
-        scoreboards[objective][target] = 0
-    value = scoreboards[objective][target]
+    value = scoreboards.score(objective, target)
     if not (start <= value < end):
         branch.skip_over()
 
 def _set_objective_target(objective, arg1, target, branch):
-    if objective not in scoreboards:
-        scoreboards[objective] = {}
-    scoreboards[objective][target] = arg1
+    scoreboards.set_score(objective, target, arg1)
     return None
 
-def run(root:Branch, functions:dict, namespace:str):
-    global branches
+# Python tier
+
+# Calls after which a function is compiled to Python (None: always interpret,
+# except functions loaded with a compiled version, see exporter.py).
+jit_threshold = None
+
+# Tail calls from one compiled function into another followed in one turn.
+JIT_MAX_CHAIN = 100
+
+# Opcodes whose handler may run compiled functions. The fast loop adds the
+# instructions it ran so far to instructions_executed before running them.
+JIT_ENTRIES = frozenset({Instruction.run_func, Instruction.return_run, Superinstruction.guarded_call})
+
+# Limits of the current turn, see _turn_allows(). Set by the run loops.
+turn_end = None       # Value of instructions_executed at which the turn ends
+turn_deadline = None  # perf_counter() time at which the run stops
+
+# Instructions the Python tier runs by calling their handler.
+JIT_HANDLER_CALLS = frozenset({
+    Instruction.add, Instruction.remove, Instruction.set_score, Instruction.get,
+    Instruction.operation, Instruction.reset, Instruction.list_scores,
+    Instruction.say, Instruction.tellraw, Instruction.summon, Instruction.kill,
+    Instruction.tag_add, Instruction.tag_remove, Instruction.positioned,
+})
+
+JIT_OPERATORS = {'>': '>', '<': '<', '>=': '>=', '<=': '<=', '==': '==', '=': '==', '!=': '!=', '<>': '!='}
+
+def function_source(program: Program, factory:str='_factory', runtime:str='') -> str | None:
+    """
+    Python source for a function, or None if it uses an instruction the
+    Python tier can't run.
+
+    The source defines `factory(P)`, which takes the Program and returns a
+    closure taking (branch, caller_pending_store). The closure runs the
+    function as a callee: up to its first kill_branch, which returns to the
+    caller. It returns the number of instructions it ran and, if it ended
+    with a tail call, the (function, args) to call next. Scoreboard updates
+    call the scoreboard methods directly and conditions become if statements.
+
+    Args:
+        runtime: Prefix for the names of this module, e.g. 'vm.' outside of it.
+    """
+    body = []
+
+    def holder(pc: int, index: int) -> str:
+        operand = program[pc][1][index]
+        if operand.__class__ is str:
+            return repr(operand)
+        return f'{runtime}_resolve_target(branch, P[{pc}][1][{index}])'
+
+    def operands(pc: int) -> str:
+        if program[pc][1].__class__ is MacroOperands:
+            return f'P[{pc}][1].bind(branch)'
+        return f'P[{pc}][1]'
+
+    def leave(steps: int, tail='None', indent='', store=True):
+        body.append(f'{indent}branch.last_value = last')
+        if store:
+            body.append(f'{indent}if pending is not None: {runtime}_store_result(pending, last)')
+        body.append(f'{indent}return {steps}, {tail}')
+
+    has_store = False
+    for pc, (opcode, args) in enumerate(program):
+        macro = args.__class__ is MacroOperands
+
+        if opcode == Instruction.kill_branch:
+            leave(pc + 1)
+            break
+
+        if opcode in (Instruction.if_score, Instruction.unless_score) and not macro:
+            if len(args) == 4:
+                start = 0 if args[3].start is None else args[3].start
+                end = 1000000 if args[3].end is None else args[3].end
+                cond = f'{start!r} <= score({args[1]!r}, {holder(pc, 0)}) < {end!r}'
+            elif args[2] in JIT_OPERATORS:
+                cond = (f'score({args[1]!r}, {holder(pc, 0)}) {JIT_OPERATORS[args[2]]} '
+                        f'score({args[4]!r}, {holder(pc, 3)})')
+            else:
+                return None
+            body.append(f'if not ({cond}):' if opcode == Instruction.if_score else f'if {cond}:')
+            # Skips to the next kill_branch, or the end of the function
+            target = program.skip_targets[pc + 1]
+            leave(pc + 2 if target < len(program) else pc + 1, indent='    ')
+
+        elif opcode == Instruction.execute_store and not macro:
+            has_store = True
+            body.append(f'pending = {tuple(args)!r}')
+
+        elif opcode in (Instruction.add, Instruction.remove) and not macro:
+            amount = args[2] if opcode == Instruction.add else -args[2]
+            body.append(f'add_score({args[1]!r}, {holder(pc, 0)}, {amount!r})')
+
+        elif opcode == Instruction.set_score and not macro:
+            body.append(f'set_score({args[1]!r}, {holder(pc, 0)}, {args[2]!r})')
+
+        elif opcode in JIT_HANDLER_CALLS:
+            body.append(f'result = {runtime}HANDLERS[{int(opcode)}](branch, {operands(pc)})  # {opcode.name}')
+            body.append('if result.__class__ is tuple: last = result[1]')
+
+        elif opcode == Instruction.return_run:
+            if pc + 1 >= len(program) or program[pc + 1][0] not in JIT_HANDLER_CALLS:
+                return None
+            body.append(f'result = {runtime}HANDLERS[{int(program[pc + 1][0])}](branch, {operands(pc + 1)})  # {program[pc + 1][0].name}')
+            body.append('if result.__class__ is tuple and len(result) > 1:')
+            body.append('    last = result[1]')
+            body.append(f'    if caller_pending is not None: {runtime}_store_result(caller_pending, last)')
+            leave(pc + 2, store=False)
+            break
+
+        elif opcode == Instruction.run_func and pc in program.tail_calls and not macro and not has_store:
+            leave(pc + 1, tail=f'({args[0]!r}, {list(args[1:])!r})', store=False)
+            break
+
+        else:
+            return None
+    else:
+        leave(len(program))
+
+    return '\n'.join([
+        f'def {factory}(P):',
+        '    def run(branch, caller_pending):',
+        f'        score = {runtime}scoreboards.score',
+        f'        set_score = {runtime}scoreboards.set_score',
+        f'        add_score = {runtime}scoreboards.add_score',
+        '        last = branch.last_value',
+        '        pending = None',
+        *(f'        {line}' for line in body),
+        '    return run',
+    ])
+
+def compile_function(program: Program):
+    """Compile a function to a Python closure, see function_source(). None if it can't be."""
+    source = function_source(program)
+    if source is None:
+        return None
+    namespace = {}
+    exec(compile(source, '<mcfn function>', 'exec'), globals(), namespace)
+    return namespace['_factory'](program)
+
+def _store_result(store: tuple, value):
+    store_type, target, objective = store
+    scoreboards.set_score(objective, target, int(value) if store_type == "result" else (1 if value else 0))
+
+def _hot_function(program: Program):
+    """The compiled version of a called function, if it has one or is hot now, else None."""
+    compiled = program.compiled
+    if compiled is None and jit_threshold is not None:
+        program.calls += 1
+        if program.calls >= jit_threshold:
+            compiled = program.compiled = compile_function(program) or False
+    return compiled or None
+
+def _turn_allows(program: Program) -> bool:
+    """
+    Whether a compiled function may run in the current turn. It runs at most
+    len(program) instructions, as compiled functions don't loop, so those
+    longer than the quantum stay on the interpreter.
+    """
+    if turn_end is not None and instructions_executed + len(program) > turn_end:
+        return False
+    return turn_deadline is None or perf_counter() < turn_deadline
+
+def _run_compiled(branch: Branch, compiled, args: list):
+    """
+    Call a compiled function, following its tail calls into other compiled
+    functions while the turn allows them.
+    """
+    global instructions_executed, tail_calls_eliminated
+
+    # The caller's pending store waits for the return value, as with Branch.call()
+    caller_pending = branch.pending_store
+    branch.pending_store = None
+    caller_vars = branch.vars
+    try:
+        for _ in range(JIT_MAX_CHAIN):
+            branch.vars = args
+            steps, tail = compiled(branch, caller_pending)
+            instructions_executed += steps
+            if tail is None:
+                return
+            tail_calls_eliminated += 1
+            # Only the first function returns to the caller's store, see _run_func()
+            caller_pending = None
+            function, args = tail
+            if function not in functions:
+                raise RuntimeError(
+                    f"Function {function} not found. Functions: {', '.join(functions.keys())}"
+                )
+            program = function_program(function)
+            compiled = _hot_function(program)
+            if compiled is None or not _turn_allows(program):
+                break
+    finally:
+        branch.vars = caller_vars
+
+    # Interpret the rest
+    branch.pending_store = caller_pending
+    branch.call(function, args)
+
+def run(root:Branch, functions:dict, namespace:str, max_instructions:int=None, max_seconds:float=None) -> bool:
+    """
+    Run the main function of an executable.
+
+    With max_instructions or max_seconds, execution stops once that budget
+    is used up and the VM state is left as it is, so resume() can continue.
+
+    Returns:
+        True if the program finished, False if the budget ran out.
+    """
+    global branches, run_start
 
     # Initialize globals
     globals()['namespace'] = namespace
     globals()['functions'] = functions
 
     # Initialize the root branch with the main function
-    main = functions['main']
-    root.program = main
-    branches = [root]
+    root.program = function_program('main')
+    branches = Scheduler([root], scheduling_policy)
+    run_start = (instructions_executed, tail_calls_eliminated)
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    return resume(max_instructions, max_seconds, root)
+
+def resume(max_instructions:int=None, max_seconds:float=None, root:Branch=None) -> bool:
+    """
+    Continue a run that stopped because its budget ran out. See run().
+
+    Returns:
+        True if the program finished, False if the budget ran out again.
+    """
+    if root is None:
+        root = globals()['root']
+
+    budget = None if max_instructions is None else instructions_executed + max_instructions
+    deadline = None if max_seconds is None else perf_counter() + max_seconds
 
     # Main execution loop
+    run_branch = select_branch_runner()
+    out_of_budget = False
     try:
         while branches:
-            process_all_branches()
+            if not process_all_branches(run_branch, budget, deadline):
+                out_of_budget = True
+                break
     except Exception as e:
         log.error(f"VM execution error: {e}")
     finally:
-        if debugHook:
-            debugHook(root, 'quit')
+        run_stats.update(
+            policy=branches.policy,
+            instructions=instructions_executed - run_start[0],
+            tail_calls=tail_calls_eliminated - run_start[1],
+            peak_branches=branches.peak,
+            peak_memory=peak_memory(),
+        )
+        output.flush()
+        if not out_of_budget:
+            branch_pool.trim()
+            if debugHook:
+                debugHook(root, 'quit')
+
+    return not out_of_budget
+
+def peak_memory() -> int | None:
+    """
+    Peak memory use in bytes.
+
+    This is the peak traced by tracemalloc since run() started if it is
+    tracing, else the peak resident size of the process. None if neither
+    is available.
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+
+def select_branch_runner():
+    """
+    Pick the loop that runs a branch until it yields.
 
-def process_all_branches():
-    """Process all branches in sequence"""
-    index = 0
-    while index < len(branches) and index < len(branches):
-        branch = branches[index]
-        if process_branch(branch):
-            # Branch was processed, move to next branch
-            index += 1
+    process_branch() calls the debug hook and handles errors for every
+    instruction; it is only needed when a debug hook is attached or tracing
+    is on. Otherwise run_branch_fast() is used.
+    """
+    if debugHook or trace:
+        return process_branch
+    return run_branch_fast
 
-def process_branch(branch):
+def process_all_branches(run_branch=None, budget:int=None, deadline:float=None) -> bool:
     """
-    Process a branch until it yields or is killed
+    Run one scheduler pass: each branch runs until it yields, is killed or uses up its quantum.
+
+    Args:
+        run_branch: The branch loop, see select_branch_runner()
+        budget: Value of instructions_executed at which to stop
+        deadline: perf_counter() time at which to stop
+
+    Returns:
+        False if the pass stopped because of the budget or deadline with
+        branches left to run. Those that didn't get their turn run first
+        in the next pass.
+    """
+    if run_branch is None:
+        run_branch = select_branch_runner()
+
+    global turn_deadline
+    turn_deadline = deadline
+
+    limit = quantum
+    if deadline is not None and limit is None:
+        limit = DEADLINE_CHECK_INTERVAL
+
+    run_pass = branches.run_pass()
+    try:
+        while True:
+            if budget is not None and instructions_executed >= budget:
+                return not branches
+            if deadline is not None and perf_counter() >= deadline:
+                return not branches
+
+            branch = next(run_pass, None)
+            if branch is None:
+                return True
+
+            branch_limit = limit
+            if budget is not None:
+                remaining = budget - instructions_executed
+                branch_limit = remaining if limit is None else min(limit, remaining)
+
+            if not run_branch(branch, branch_limit):
+                # The debugger quit and reset the VM
+                return True
+    finally:
+        run_pass.close()
+
+def run_branch_fast(branch, limit:int=None):
+    """
+    Run a branch until it yields, is killed or has run `limit` instructions,
+    without debug hook or logging.
+
+    Same semantics as process_branch(), but runs the fused program, so a
+    superinstruction counts as one instruction. Errors are handled once per
+    run instead of once per instruction.
+    """
+    global instructions_executed, turn_end
+    turn_end = None if limit is None else instructions_executed + limit
+    steps = 0
+    try:
+        while True:
+            if steps == limit:
+                return True
+
+            program_counter = branch.program_counter
+            program = branch.program
+            if program_counter >= len(program):
+                branch.finish()
+                return True
+
+            inst, args = program.fused[program_counter]
+            branch.program_counter = program_counter + 1
+            if args.__class__ is MacroOperands:
+                args = args.bind(branch)
+
+            steps += 1
+            if inst in JIT_ENTRIES:
+                # Compiled functions check the count against turn_end
+                instructions_executed += steps
+                if limit is not None:
+                    limit -= steps
+                steps = 0
+            result = HANDLERS[inst](branch, args)
+            if result:
+                if result.__class__ is tuple:
+                    branch.last_value = result[1]
+                return True
+            if branch not in branches:
+                return True
+
+    except Exception as e:
+        log.error(f"Error executing instruction in {branch.function}:{branch.program_counter}: {e}")
+        return True
+    finally:
+        instructions_executed += steps
+
+def process_branch(branch, limit:int=None):
+    """
+    Process a branch until it yields, is killed or has run `limit` instructions
     Returns True if branch yielded or was killed, False otherwise
     """
+    global instructions_executed
     should_yield = False
+    steps = 0
 
     # Process this branch continuously until it yields or is killed
     while not should_yield and branch in branches:
+        if steps == limit:
+            return True
+
         # Handle debug hook
         if handle_debug_hook(branch) == 'quit':
             return False
 
         # Execute one instruction
+        steps += 1
+        instructions_executed += 1
         try:
             result = branch.execute_one()
 